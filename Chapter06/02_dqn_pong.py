@@ -33,20 +33,98 @@ Experience = collections.namedtuple('Experience', field_names=['state', 'action'
 
 
 class ExperienceBuffer:
-    def __init__(self, capacity):
-        self.buffer = collections.deque(maxlen=capacity)
+    """
+    Replay buffer which keeps every frame only once, as uint8 in the preallocated ring. Stacked observations are
+    reconstructed on sampling.
+    Slot k keeps the last frame of the transition's new_state, the transition's state ends in slot k-1. The first
+    observation of the episode gets its own slot marked as episode start, frames before it are zeros in the stack.
+    """
+    def __init__(self, capacity, obs_shape):
+        self.capacity = capacity
+        self.stack_frames = obs_shape[0]
+        self.frames = np.zeros((capacity, ) + tuple(obs_shape[1:]), dtype=np.uint8)
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=np.uint8)
+        # transition ends in the slot
+        self.valid = np.zeros(capacity, dtype=np.bool_)
+        self.episode_start = np.zeros(capacity, dtype=np.bool_)
+        self.pos = 0
+        self.size = 0
+        self.count = 0
+        self._new_episode = True
+        # offsets of the stack's frames from the last one, oldest first
+        self._stack_offsets = np.arange(self.stack_frames - 1, -1, -1)
+        self._batch_size = None
+        self._batch = None
 
     def __len__(self):
-        return len(self.buffer)
+        return self.count
+
+    def _push(self, obs, valid, episode_start):
+        if self.valid[self.pos]:
+            self.count -= 1
+        slot = self.pos
+        # take the last frame of the stack only
+        self.frames[slot] = obs[-1]
+        self.valid[slot] = valid
+        self.episode_start[slot] = episode_start
+        if valid:
+            self.count += 1
+        self.pos = (self.pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return slot
 
     def append(self, experience):
-        self.buffer.append(experience)
+        if self._new_episode:
+            self._push(experience.state, valid=False, episode_start=True)
+        slot = self._push(experience.new_state, valid=True, episode_start=False)
+        self.actions[slot] = experience.action
+        self.rewards[slot] = experience.reward
+        self.dones[slot] = experience.done
+        self._new_episode = experience.done
+
+    def _gather_stacks(self, last_slots, out):
+        """
+        Build stacked observations ending in given slots
+        """
+        indices = (last_slots[:, np.newaxis] - self._stack_offsets) % self.capacity
+        np.take(self.frames, indices, axis=0, out=out)
+        starts = self.episode_start[indices]
+        # frame belongs to the previous episode if the episode start is met later in the stack
+        blocked = np.cumsum(starts[:, :0:-1], axis=1)[:, ::-1] > 0
+        out[:, :-1][blocked] = 0
+
+    def _sample_slots(self, batch_size):
+        slots = np.zeros(0, dtype=np.int64)
+        while len(slots) < batch_size:
+            cand = np.random.randint(0, self.size, size=batch_size)
+            ok = self.valid[cand]
+            if self.size == self.capacity:
+                # oldest frames are overwritten, so, stacks of the oldest transitions are incomplete
+                ok &= (cand - self.pos) % self.capacity >= self.stack_frames
+            slots = np.concatenate((slots, cand[ok]))
+        return slots[:batch_size]
 
     def sample(self, batch_size):
-        indices = np.random.choice(len(self.buffer), batch_size, replace=False)
-        states, actions, rewards, dones, next_states = zip(*[self.buffer[idx] for idx in indices])
-        return np.array(states), np.array(actions), np.array(rewards, dtype=np.float32), \
-               np.array(dones, dtype=np.uint8), np.array(next_states)
+        """
+        Sample batch of transitions (with replacement). Returned arrays are reused by the next call
+        :return: tuple of (states, actions, rewards, dones, next_states), states are uint8
+        """
+        if self._batch_size != batch_size:
+            stack_shape = (batch_size, self.stack_frames) + self.frames.shape[1:]
+            self._batch_size = batch_size
+            self._batch = (np.zeros(stack_shape, dtype=np.uint8), np.zeros(batch_size, dtype=np.int64),
+                           np.zeros(batch_size, dtype=np.float32), np.zeros(batch_size, dtype=np.uint8),
+                           np.zeros(stack_shape, dtype=np.uint8))
+        states, actions, rewards, dones, next_states = self._batch
+        slots = self._sample_slots(batch_size)
+        self._gather_stacks(slots - 1, states)
+        self._gather_stacks(slots, next_states)
+        np.take(self.actions, slots, out=actions)
+        np.take(self.rewards, slots, out=rewards)
+        np.take(self.dones, slots, out=dones)
+        return self._batch
 
 
 class Agent:
@@ -87,6 +165,7 @@ class Agent:
 def calc_loss(batch, net, tgt_net, device="cpu"):
     states, actions, rewards, dones, next_states = batch
 
+    # states are uint8, the network scales them on the device
     states_v = torch.tensor(states).to(device)
     next_states_v = torch.tensor(next_states).to(device)
     actions_v = torch.tensor(actions).to(device)
@@ -119,7 +198,7 @@ if __name__ == "__main__":
     writer = SummaryWriter(comment="-" + args.env)
     print(net)
 
-    buffer = ExperienceBuffer(REPLAY_SIZE)
+    buffer = ExperienceBuffer(REPLAY_SIZE, env.observation_space.shape)
     agent = Agent(env, buffer)
     epsilon = EPSILON_START
 
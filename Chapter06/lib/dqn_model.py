@@ -29,5 +29,7 @@ class DQN(nn.Module):
         return int(np.prod(o.size()))
 
     def forward(self, x):
-        conv_out = self.conv(x).view(x.size()[0], -1)
+        # observations are uint8 frames, scaling is done here to keep them compact outside of the network
+        fx = x.float() / 255.0
+        conv_out = self.conv(fx).view(fx.size()[0], -1)
         return self.fc(conv_out)
@@ -43,7 +43,10 @@ class MaxAndSkipEnv(gym.Wrapper):
             total_reward += reward
             if done:
                 break
-        max_frame = np.max(np.stack(self._obs_buffer), axis=0)
+        if len(self._obs_buffer) > 1:
+            max_frame = np.maximum(self._obs_buffer[0], self._obs_buffer[1])
+        else:
+            max_frame = self._obs_buffer[0]
         return max_frame, total_reward, done, info
 
     def reset(self):
@@ -64,25 +67,32 @@ class ProcessFrame84(gym.ObservationWrapper):
 
     @staticmethod
     def process(frame):
-        if frame.size == 210 * 160 * 3:
-            img = np.reshape(frame, [210, 160, 3]).astype(np.float32)
-        elif frame.size == 250 * 160 * 3:
-            img = np.reshape(frame, [250, 160, 3]).astype(np.float32)
-        else:
-            assert False, "Unknown resolution."
-        img = img[:, :, 0] * 0.299 + img[:, :, 1] * 0.587 + img[:, :, 2] * 0.114
-        resized_screen = cv2.resize(img, (84, 110), interpolation=cv2.INTER_AREA)
-        x_t = resized_screen[18:102, :]
-        x_t = np.reshape(x_t, [84, 84, 1])
-        return x_t.astype(np.uint8)
+        return ProcessFrame84.process_batch(frame[np.newaxis])[0]
+
+    @staticmethod
+    def process_batch(frames):
+        """
+        Convert batch of RGB frames into 84x84 grayscale, everything is done in uint8.
+        Frames are put one under another into the single tall image, so, every cv2 call processes the whole batch.
+        Resize doesn't mix frames, as the scale is the same for every frame and border rows are cropped.
+        :param frames: array of shape (N, height, 160, 3), height is 210 or 250
+        :return: array of shape (N, 84, 84, 1)
+        """
+        count, height = frames.shape[:2]
+        assert height in (210, 250) and frames.shape[2:] == (160, 3), "Unknown resolution."
+        img = np.ascontiguousarray(frames, dtype=np.uint8).reshape(count * height, 160, 3)
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        img = cv2.resize(img, (84, 110 * count), interpolation=cv2.INTER_AREA)
+        img = img.reshape(count, 110, 84)[:, 18:102, :]
+        return img[..., np.newaxis]
 
 
 class ImageToPyTorch(gym.ObservationWrapper):
     def __init__(self, env):
         super(ImageToPyTorch, self).__init__(env)
         old_shape = self.observation_space.shape
-        self.observation_space = gym.spaces.Box(low=0.0, high=1.0, shape=(old_shape[-1], old_shape[0], old_shape[1]),
-                                                dtype=np.float32)
+        self.observation_space = gym.spaces.Box(low=0, high=255, shape=(old_shape[-1], old_shape[0], old_shape[1]),
+                                                dtype=self.observation_space.dtype)
 
     def observation(self, observation):
         return np.moveaxis(observation, 2, 0)
@@ -93,22 +103,62 @@ class ScaledFloatFrame(gym.ObservationWrapper):
         return np.array(obs).astype(np.float32) / 255.0
 
 
+class FrameRing:
+    """
+    Stacks of the last n_steps frames for several environments, kept in the ring of double length: every frame
+    is written twice (at pos and pos + n_steps), so, the stack is always the contiguous slice, without shifting.
+    Returned stacks are views, valid until the next push (which overwrites only their oldest frame).
+    """
+    def __init__(self, n_envs, n_steps, frame_shape, dtype=np.uint8):
+        self.n_steps = n_steps
+        self.buffer = np.zeros((n_envs, 2 * n_steps) + tuple(frame_shape), dtype=dtype)
+        self.pos = 0
+
+    def _stacks(self):
+        return self.buffer[:, self.pos + 1:self.pos + 1 + self.n_steps]
+
+    def push(self, frames):
+        """
+        Add frames of all environments
+        :param frames: array of shape (n_envs, ) + frame_shape
+        :return: stacks of shape (n_envs, n_steps) + frame_shape, oldest frame first
+        """
+        self.pos = (self.pos + 1) % self.n_steps
+        self.buffer[:, self.pos] = frames
+        self.buffer[:, self.pos + self.n_steps] = frames
+        return self._stacks()
+
+    def reset(self, env_idx, frame):
+        """
+        Start the new stack for the environment with single frame, older frames are zeros
+        :return: stack of the environment
+        """
+        self.buffer[env_idx] = 0
+        self.buffer[env_idx, self.pos] = frame
+        self.buffer[env_idx, self.pos + self.n_steps] = frame
+        return self._stacks()[env_idx]
+
+
 class BufferWrapper(gym.ObservationWrapper):
-    def __init__(self, env, n_steps, dtype=np.float32):
+    """
+    Stack of the last n_steps observations. Returned observation is the view of the internal ring, valid until the
+    next step.
+    """
+    def __init__(self, env, n_steps, dtype=np.uint8):
         super(BufferWrapper, self).__init__(env)
         self.dtype = dtype
         old_space = env.observation_space
         self.observation_space = gym.spaces.Box(old_space.low.repeat(n_steps, axis=0),
                                                 old_space.high.repeat(n_steps, axis=0), dtype=dtype)
+        assert old_space.shape[0] == 1, "Only single channel frames could be stacked"
+        self.ring = FrameRing(1, n_steps, old_space.shape[1:], dtype=dtype)
 
     def reset(self):
-        self.buffer = np.zeros_like(self.observation_space.low, dtype=self.dtype)
-        return self.observation(self.env.reset())
+        obs = self.env.reset()
+        return self.ring.reset(0, obs[0])
 
     def observation(self, observation):
-        self.buffer[:-1] = self.buffer[1:]
-        self.buffer[-1] = observation
-        return self.buffer
+        return self.ring.push(observation[np.newaxis, 0])[0]
 
 
 def make_env(env_name):
@@ -117,5 +167,5 @@ def make_env(env_name):
     env = FireResetEnv(env)
     env = ProcessFrame84(env)
     env = ImageToPyTorch(env)
-    env = BufferWrapper(env, 4)
-    return ScaledFloatFrame(env)
+    # observations are kept uint8, the network scales them
+    return BufferWrapper(env, 4)
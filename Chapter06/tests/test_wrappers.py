@@ -0,0 +1,48 @@
+from unittest import TestCase
+import numpy as np
+
+from lib import wrappers
+
+
+class TestProcessFrame84(TestCase):
+    def check_batch(self, height):
+        np.random.seed(height)
+        frames = np.random.randint(256, size=(5, height, 160, 3), dtype=np.uint8)
+        res = wrappers.ProcessFrame84.process_batch(frames)
+        self.assertEqual(res.shape, (5, 84, 84, 1))
+        self.assertEqual(res.dtype, np.uint8)
+        # frames of the batch don't influence each other
+        for frame, frame_res in zip(frames, res):
+            np.testing.assert_array_equal(wrappers.ProcessFrame84.process(frame), frame_res)
+
+    def test_batch(self):
+        self.check_batch(210)
+
+    def test_batch_250(self):
+        self.check_batch(250)
+
+    def test_unknown_resolution(self):
+        with self.assertRaises(AssertionError):
+            wrappers.ProcessFrame84.process(np.zeros((200, 160, 3), dtype=np.uint8))
+
+
+class TestFrameRing(TestCase):
+    def test_shifting_buffer(self):
+        n_envs, n_steps = 3, 4
+        ring = wrappers.FrameRing(n_envs, n_steps, (2, 2))
+        # stacks of the former BufferWrapper, which shifted the whole buffer on every frame
+        expected = np.zeros((n_envs, n_steps, 2, 2), dtype=np.uint8)
+        np.random.seed(0)
+        for step in range(20):
+            frames = np.random.randint(256, size=(n_envs, 2, 2), dtype=np.uint8)
+            reset_env = step % 7 if step % 7 < n_envs else None
+            if reset_env is None:
+                stacks = ring.push(frames)
+                expected[:, :-1] = expected[:, 1:]
+                expected[:, -1] = frames
+                np.testing.assert_array_equal(stacks, expected)
+            else:
+                stack = ring.reset(reset_env, frames[reset_env])
+                expected[reset_env] = 0
+                expected[reset_env, -1] = frames[reset_env]
+                np.testing.assert_array_equal(stack, expected[reset_env])
@@ -2,13 +2,15 @@
 import gym
 import ptan
 import argparse
+import numpy as np
 
 import torch
 import torch.optim as optim
+import torch.multiprocessing as mp
 
 from tensorboardX import SummaryWriter
 
-from lib import dqn_model, common
+from lib import dqn_model, common, replay, actors
 
 REWARD_STEPS_DEFAULT = 2
 
@@ -18,8 +20,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--cuda", default=False, action="store_true", help="Enable cuda")
     parser.add_argument("-n", default=REWARD_STEPS_DEFAULT, type=int, help="Count of steps to unroll Bellman")
+    parser.add_argument("--actors", default=0, type=int,
+                        help="Count of actor processes, by default environment is stepped in the training loop")
     args = parser.parse_args()
     device = torch.device("cuda" if args.cuda else "cpu")
+    if args.actors:
+        mp.set_start_method('spawn')
 
     env = gym.make(params['env_name'])
     env = ptan.common.wrappers.wrap_dqn(env)
@@ -33,20 +39,23 @@ if __name__ == "__main__":
     agent = ptan.agent.DQNAgent(net, selector, device=device)
 
     exp_source = ptan.experience.ExperienceSourceFirstLast(env, agent, gamma=params['gamma'], steps_count=args.n)
-    buffer = ptan.experience.ExperienceReplayBuffer(exp_source, buffer_size=params['replay_size'])
+    if args.actors:
+        exp_source = actors.ActorPool(net, selector, params, args.actors, steps_count=args.n)
+    buffer = replay.ArrayReplayBuffer(exp_source, params['replay_size'], device=device, pin_memory=args.cuda)
     optimizer = optim.Adam(net.parameters(), lr=params['learning_rate'])
 
     frame_idx = 0
 
     with common.RewardTracker(writer, params['stop_reward']) as reward_tracker:
         while True:
-            frame_idx += 1
-            buffer.populate(1)
+            new_frames = exp_source.wait_ready() if args.actors else 1
+            frame_idx += new_frames
+            buffer.populate(new_frames)
             epsilon_tracker.frame(frame_idx)
 
             new_rewards = exp_source.pop_total_rewards()
             if new_rewards:
-                if reward_tracker.reward(new_rewards[0], frame_idx, selector.epsilon):
+                if reward_tracker.reward(np.mean(new_rewards), frame_idx, selector.epsilon):
                     break
 
             if len(buffer) < params['replay_initial']:
@@ -59,5 +68,5 @@ if __name__ == "__main__":
             loss_v.backward()
             optimizer.step()
 
-            if frame_idx % params['target_net_sync'] == 0:
+            if frame_idx % params['target_net_sync'] < new_frames:
                 tgt_net.sync()
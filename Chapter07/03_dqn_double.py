@@ -7,23 +7,18 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.multiprocessing as mp
 
 from tensorboardX import SummaryWriter
 
-from lib import dqn_model, common
+from lib import dqn_model, common, replay, actors
 
 STATES_TO_EVALUATE = 1000
 EVAL_EVERY_FRAME = 100
 
 
 def calc_loss(batch, net, tgt_net, gamma, device="cpu", double=True):
-    states, actions, rewards, dones, next_states = common.unpack_batch(batch)
-
-    states_v = torch.tensor(states).to(device)
-    next_states_v = torch.tensor(next_states).to(device)
-    actions_v = torch.tensor(actions).to(device)
-    rewards_v = torch.tensor(rewards).to(device)
-    done_mask = torch.ByteTensor(dones).to(device)
+    states_v, actions_v, rewards_v, done_mask, next_states_v = common.unpack_batch_t(batch, device)
 
     state_action_values = net(states_v).gather(1, actions_v.unsqueeze(-1)).squeeze(-1)
     if double:
@@ -51,9 +46,13 @@ if __name__ == "__main__":
     params = common.HYPERPARAMS['pong']
     parser = argparse.ArgumentParser()
     parser.add_argument("--cuda", default=False, action="store_true", help="Enable cuda")
+    parser.add_argument("--actors", default=0, type=int,
+                        help="Count of actor processes, by default environment is stepped in the training loop")
     parser.add_argument("--double", default=False, action="store_true", help="Enable double DQN")
     args = parser.parse_args()
     device = torch.device("cuda" if args.cuda else "cpu")
+    if args.actors:
+        mp.set_start_method('spawn')
 
     env = gym.make(params['env_name'])
     env = ptan.common.wrappers.wrap_dqn(env)
@@ -67,7 +66,9 @@ if __name__ == "__main__":
     agent = ptan.agent.DQNAgent(net, selector, device=device)
 
     exp_source = ptan.experience.ExperienceSourceFirstLast(env, agent, gamma=params['gamma'], steps_count=1)
-    buffer = ptan.experience.ExperienceReplayBuffer(exp_source, buffer_size=params['replay_size'])
+    if args.actors:
+        exp_source = actors.ActorPool(net, selector, params, args.actors, steps_count=1)
+    buffer = replay.ArrayReplayBuffer(exp_source, params['replay_size'], device=device, pin_memory=args.cuda)
     optimizer = optim.Adam(net.parameters(), lr=params['learning_rate'])
 
     frame_idx = 0
@@ -75,21 +76,20 @@ if __name__ == "__main__":
 
     with common.RewardTracker(writer, params['stop_reward']) as reward_tracker:
         while True:
-            frame_idx += 1
-            buffer.populate(1)
+            new_frames = exp_source.wait_ready() if args.actors else 1
+            frame_idx += new_frames
+            buffer.populate(new_frames)
             epsilon_tracker.frame(frame_idx)
 
             new_rewards = exp_source.pop_total_rewards()
             if new_rewards:
-                if reward_tracker.reward(new_rewards[0], frame_idx, selector.epsilon):
+                if reward_tracker.reward(np.mean(new_rewards), frame_idx, selector.epsilon):
                     break
 
             if len(buffer) < params['replay_initial']:
                 continue
             if eval_states is None:
-                eval_states = buffer.sample(STATES_TO_EVALUATE)
-                eval_states = [np.array(transition.state, copy=False) for transition in eval_states]
-                eval_states = np.array(eval_states, copy=False)
+                eval_states = buffer.sample(STATES_TO_EVALUATE).states.cpu().numpy()
 
             optimizer.zero_grad()
             batch = buffer.sample(params['batch_size'])
@@ -98,9 +98,9 @@ if __name__ == "__main__":
             loss_v.backward()
             optimizer.step()
 
-            if frame_idx % params['target_net_sync'] == 0:
+            if frame_idx % params['target_net_sync'] < new_frames:
                 tgt_net.sync()
-            if frame_idx % EVAL_EVERY_FRAME == 0:
+            if frame_idx % EVAL_EVERY_FRAME < new_frames:
                 mean_val = calc_values_of_states(eval_states, net, device=device)
                 writer.add_scalar("values_mean", mean_val, frame_idx)
 
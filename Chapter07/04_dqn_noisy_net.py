@@ -7,11 +7,12 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.multiprocessing as mp
 from torch.autograd import Variable
 
 from tensorboardX import SummaryWriter
 
-from lib import dqn_model, common
+from lib import dqn_model, common, replay, actors
 
 
 class NoisyDQN(nn.Module):
@@ -58,8 +59,12 @@ if __name__ == "__main__":
     params = common.HYPERPARAMS['pong']
     parser = argparse.ArgumentParser()
     parser.add_argument("--cuda", default=False, action="store_true", help="Enable cuda")
+    parser.add_argument("--actors", default=0, type=int,
+                        help="Count of actor processes, by default environment is stepped in the training loop")
     args = parser.parse_args()
     device = torch.device("cuda" if args.cuda else "cpu")
+    if args.actors:
+        mp.set_start_method('spawn')
 
     env = gym.make(params['env_name'])
     env = ptan.common.wrappers.wrap_dqn(env)
@@ -67,22 +72,26 @@ if __name__ == "__main__":
     writer = SummaryWriter(comment="-" + params['run_name'] + "-noisy-net")
     net = NoisyDQN(env.observation_space.shape, env.action_space.n).to(device)
     tgt_net = ptan.agent.TargetNet(net)
-    agent = ptan.agent.DQNAgent(net, ptan.actions.ArgmaxActionSelector(), device=device)
+    selector = ptan.actions.ArgmaxActionSelector()
+    agent = ptan.agent.DQNAgent(net, selector, device=device)
 
     exp_source = ptan.experience.ExperienceSourceFirstLast(env, agent, gamma=params['gamma'], steps_count=1)
-    buffer = ptan.experience.ExperienceReplayBuffer(exp_source, buffer_size=params['replay_size'])
+    if args.actors:
+        exp_source = actors.ActorPool(net, selector, params, args.actors, steps_count=1)
+    buffer = replay.ArrayReplayBuffer(exp_source, params['replay_size'], device=device, pin_memory=args.cuda)
     optimizer = optim.Adam(net.parameters(), lr=params['learning_rate'])
 
     frame_idx = 0
 
     with common.RewardTracker(writer, params['stop_reward']) as reward_tracker:
         while True:
-            frame_idx += 1
-            buffer.populate(1)
+            new_frames = exp_source.wait_ready() if args.actors else 1
+            frame_idx += new_frames
+            buffer.populate(new_frames)
 
             new_rewards = exp_source.pop_total_rewards()
             if new_rewards:
-                if reward_tracker.reward(new_rewards[0], frame_idx):
+                if reward_tracker.reward(np.mean(new_rewards), frame_idx):
                     break
 
             if len(buffer) < params['replay_initial']:
@@ -94,10 +103,10 @@ if __name__ == "__main__":
             loss_v.backward()
             optimizer.step()
 
-            if frame_idx % params['target_net_sync'] == 0:
+            if frame_idx % params['target_net_sync'] < new_frames:
                 tgt_net.sync()
 
-            if frame_idx % 500 == 0:
+            if frame_idx % 500 < new_frames:
                 for layer_idx, sigma_l2 in enumerate(net.noisy_layers_sigma_snr()):
                     writer.add_scalar("sigma_snr_layer_%d" % (layer_idx+1),
                                       sigma_l2, frame_idx)
@@ -8,10 +8,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.multiprocessing as mp
 
 from tensorboardX import SummaryWriter
 
-from lib import common
+from lib import common, replay, actors
 
 SAVE_STATES_IMG = False
 SAVE_TRANSITIONS_IMG = False
@@ -130,33 +131,28 @@ def save_transition_images(batch_size, predicted, projected, next_distr, dones,
 
 
 def calc_loss(batch, net, tgt_net, gamma, device="cpu", save_prefix=None):
-    states, actions, rewards, dones, next_states = common.unpack_batch(batch)
-    batch_size = len(batch)
-
-    states_v = torch.tensor(states).to(device)
-    actions_v = torch.tensor(actions).to(device)
-    next_states_v = torch.tensor(next_states).to(device)
+    states_v, actions_v, rewards_v, dones_v, next_states_v = common.unpack_batch_t(batch, device)
+    batch_size = states_v.size(0)
 
     # next state distribution
     next_distr_v, next_qvals_v = tgt_net.both(next_states_v)
-    next_actions = next_qvals_v.max(1)[1].data.cpu().numpy()
-    next_distr = tgt_net.apply_softmax(next_distr_v).data.cpu().numpy()
-
-    next_best_distr = next_distr[range(batch_size), next_actions]
-    dones = dones.astype(np.bool)
+    next_actions_v = next_qvals_v.max(1)[1]
+    next_distr_v = tgt_net.apply_softmax(next_distr_v)
+    next_best_distr_v = next_distr_v[range(batch_size), next_actions_v.data]
 
     # project our distribution using Bellman update
-    proj_distr = common.distr_projection(next_best_distr, rewards, dones, Vmin, Vmax, N_ATOMS, gamma)
+    proj_distr_v = common.distr_projection_t(next_best_distr_v, rewards_v, dones_v, Vmin, Vmax, N_ATOMS, gamma)
 
     # calculate net output
     distr_v = net(states_v)
     state_action_values = distr_v[range(batch_size), actions_v.data]
     state_log_sm_v = F.log_softmax(state_action_values, dim=1)
-    proj_distr_v = torch.tensor(proj_distr).to(device)
 
     if save_prefix is not None:
         pred = F.softmax(state_action_values, dim=1).data.cpu().numpy()
-        save_transition_images(batch_size, pred, proj_distr, next_best_distr, dones, rewards, save_prefix)
+        save_transition_images(batch_size, pred, proj_distr_v.data.cpu().numpy(),
+                               next_best_distr_v.data.cpu().numpy(), dones_v.cpu().numpy().astype(np.bool),
+                               rewards_v.cpu().numpy(), save_prefix)
 
     loss_v = -state_log_sm_v * proj_distr_v
     return loss_v.sum(dim=1).mean()
@@ -167,8 +163,12 @@ if __name__ == "__main__":
 #    params['epsilon_frames'] *= 2
     parser = argparse.ArgumentParser()
     parser.add_argument("--cuda", default=False, action="store_true", help="Enable cuda")
+    parser.add_argument("--actors", default=0, type=int,
+                        help="Count of actor processes, by default environment is stepped in the training loop")
     args = parser.parse_args()
     device = torch.device("cuda" if args.cuda else "cpu")
+    if args.actors:
+        mp.set_start_method('spawn')
 
     env = gym.make(params['env_name'])
     env = ptan.common.wrappers.wrap_dqn(env)
@@ -182,7 +182,9 @@ if __name__ == "__main__":
     agent = ptan.agent.DQNAgent(lambda x: net.qvals(x), selector, device=device)
 
     exp_source = ptan.experience.ExperienceSourceFirstLast(env, agent, gamma=params['gamma'], steps_count=1)
-    buffer = ptan.experience.ExperienceReplayBuffer(exp_source, buffer_size=params['replay_size'])
+    if args.actors:
+        exp_source = actors.ActorPool(net, selector, params, args.actors, steps_count=1, qvals=True)
+    buffer = replay.ArrayReplayBuffer(exp_source, params['replay_size'], device=device, pin_memory=args.cuda)
     optimizer = optim.Adam(net.parameters(), lr=params['learning_rate'])
 
     frame_idx = 0
@@ -192,29 +194,28 @@ if __name__ == "__main__":
 
     with common.RewardTracker(writer, params['stop_reward']) as reward_tracker:
         while True:
-            frame_idx += 1
-            buffer.populate(1)
+            new_frames = exp_source.wait_ready() if args.actors else 1
+            frame_idx += new_frames
+            buffer.populate(new_frames)
             epsilon_tracker.frame(frame_idx)
 
             new_rewards = exp_source.pop_total_rewards()
             if new_rewards:
-                if reward_tracker.reward(new_rewards[0], frame_idx, selector.epsilon):
+                if reward_tracker.reward(np.mean(new_rewards), frame_idx, selector.epsilon):
                     break
 
             if len(buffer) < params['replay_initial']:
                 continue
 
             if eval_states is None:
-                eval_states = buffer.sample(STATES_TO_EVALUATE)
-                eval_states = [np.array(transition.state, copy=False) for transition in eval_states]
-                eval_states = np.array(eval_states, copy=False)
+                eval_states = buffer.sample(STATES_TO_EVALUATE).states.cpu().numpy()
 
             optimizer.zero_grad()
             batch = buffer.sample(params['batch_size'])
 
             save_prefix = None
             if SAVE_TRANSITIONS_IMG:
-                interesting = any(map(lambda s: s.last_state is None or s.reward != 0.0, batch))
+                interesting = bool(batch.dones.any()) or bool((batch.rewards != 0.0).any())
                 if interesting and frame_idx // 30000 > prev_save:
                     save_prefix = "images/img_%08d" % frame_idx
                     prev_save = frame_idx // 30000
@@ -224,12 +225,12 @@ if __name__ == "__main__":
             loss_v.backward()
             optimizer.step()
 
-            if frame_idx % params['target_net_sync'] == 0:
+            if frame_idx % params['target_net_sync'] < new_frames:
                 tgt_net.sync()
 
-            if frame_idx % EVAL_EVERY_FRAME == 0:
+            if frame_idx % EVAL_EVERY_FRAME < new_frames:
                 mean_val = calc_values_of_states(eval_states, net, device=device)
                 writer.add_scalar("values_mean", mean_val, frame_idx)
 
-            if SAVE_STATES_IMG and frame_idx % 10000 == 0:
+            if SAVE_STATES_IMG and frame_idx % 10000 < new_frames:
                 save_state_images(frame_idx, eval_states, net, device=device)
@@ -9,10 +9,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import torch.optim as optim
+import torch.multiprocessing as mp
 
 from tensorboardX import SummaryWriter
 
-from lib import dqn_model, common
+from lib import dqn_model, common, replay, actors
 
 # n-step
 REWARD_STEPS = 2
@@ -86,12 +87,8 @@ class RainbowDQN(nn.Module):
 
 
 def calc_loss(batch, batch_weights, net, tgt_net, gamma, device="cpu"):
-    states, actions, rewards, dones, next_states = common.unpack_batch(batch)
-    batch_size = len(batch)
-
-    states_v = torch.tensor(states).to(device)
-    actions_v = torch.tensor(actions).to(device)
-    next_states_v = torch.tensor(next_states).to(device)
+    states_v, actions_v, rewards_v, dones_v, next_states_v = common.unpack_batch_t(batch, device)
+    batch_size = states_v.size(0)
     batch_weights_v = torch.tensor(batch_weights).to(device)
 
     # next state distribution
@@ -106,17 +103,13 @@ def calc_loss(batch, batch_weights, net, tgt_net, gamma, device="cpu"):
     next_distr_v = tgt_net(next_states_v)
     next_best_distr_v = next_distr_v[range(batch_size), next_actions_v.data]
     next_best_distr_v = tgt_net.apply_softmax(next_best_distr_v)
-    next_best_distr = next_best_distr_v.data.cpu().numpy()
-
-    dones = dones.astype(np.bool)
 
     # project our distribution using Bellman update
-    proj_distr = common.distr_projection(next_best_distr, rewards, dones, Vmin, Vmax, N_ATOMS, gamma)
+    proj_distr_v = common.distr_projection_t(next_best_distr_v, rewards_v, dones_v, Vmin, Vmax, N_ATOMS, gamma)
 
     # calculate net output
     state_action_values = distr_v[range(batch_size), actions_v.data]
     state_log_sm_v = F.log_softmax(state_action_values, dim=1)
-    proj_distr_v = torch.tensor(proj_distr).to(device)
 
     loss_v = -state_log_sm_v * proj_distr_v
     loss_v = batch_weights_v * loss_v.sum(dim=1)
@@ -128,8 +121,12 @@ if __name__ == "__main__":
     params['epsilon_frames'] *= 2
     parser = argparse.ArgumentParser()
     parser.add_argument("--cuda", default=False, action="store_true", help="Enable cuda")
+    parser.add_argument("--actors", default=0, type=int,
+                        help="Count of actor processes, by default environment is stepped in the training loop")
     args = parser.parse_args()
     device = torch.device("cuda" if args.cuda else "cpu")
+    if args.actors:
+        mp.set_start_method('spawn')
 
     env = gym.make(params['env_name'])
     env = ptan.common.wrappers.wrap_dqn(env)
@@ -137,36 +134,42 @@ if __name__ == "__main__":
     writer = SummaryWriter(comment="-" + params['run_name'] + "-rainbow")
     net = RainbowDQN(env.observation_space.shape, env.action_space.n).to(device)
     tgt_net = ptan.agent.TargetNet(net)
-    agent = ptan.agent.DQNAgent(lambda x: net.qvals(x), ptan.actions.ArgmaxActionSelector(), device=device)
+    selector = ptan.actions.ArgmaxActionSelector()
+    agent = ptan.agent.DQNAgent(lambda x: net.qvals(x), selector, device=device)
 
     exp_source = ptan.experience.ExperienceSourceFirstLast(env, agent, gamma=params['gamma'], steps_count=REWARD_STEPS)
-    buffer = ptan.experience.PrioritizedReplayBuffer(exp_source, params['replay_size'], PRIO_REPLAY_ALPHA)
+    if args.actors:
+        exp_source = actors.ActorPool(net, selector, params, args.actors, steps_count=REWARD_STEPS, qvals=True)
+    buffer = replay.ArrayPrioReplayBuffer(exp_source, params['replay_size'], PRIO_REPLAY_ALPHA,
+                                          device=device, pin_memory=args.cuda)
     optimizer = optim.Adam(net.parameters(), lr=params['learning_rate'])
 
     frame_idx = 0
     beta = BETA_START
 
-    with common.RewardTracker(writer, params['stop_reward']) as reward_tracker:
+    with common.RewardTracker(writer, params['stop_reward']) as reward_tracker, \
+            replay.BatchPrefetcher(buffer, params['batch_size'], beta=beta) as prefetcher:
         while True:
-            frame_idx += 1
-            buffer.populate(1)
+            new_frames = exp_source.wait_ready() if args.actors else 1
+            frame_idx += new_frames
+            prefetcher.populate(new_frames)
             beta = min(1.0, BETA_START + frame_idx * (1.0 - BETA_START) / BETA_FRAMES)
 
             new_rewards = exp_source.pop_total_rewards()
             if new_rewards:
-                if reward_tracker.reward(new_rewards[0], frame_idx):
+                if reward_tracker.reward(np.mean(new_rewards), frame_idx):
                     break
 
-            if len(buffer) < params['replay_initial']:
+            if len(prefetcher) < params['replay_initial']:
                 continue
 
             optimizer.zero_grad()
-            batch, batch_indices, batch_weights = buffer.sample(params['batch_size'], beta)
+            batch, batch_indices, batch_weights = prefetcher.sample(beta=beta)
             loss_v, sample_prios_v = calc_loss(batch, batch_weights, net, tgt_net.target_model,
                                                params['gamma'] ** REWARD_STEPS, device=device)
             loss_v.backward()
             optimizer.step()
-            buffer.update_priorities(batch_indices, sample_prios_v.data.cpu().numpy())
+            prefetcher.update_priorities(batch_indices, sample_prios_v.data.cpu().numpy())
 
-            if frame_idx % params['target_net_sync'] == 0:
+            if frame_idx % params['target_net_sync'] < new_frames:
                 tgt_net.sync()
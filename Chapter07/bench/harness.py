@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for replay buffers: discovers buffer classes in benchmark modules, measures throughput of
+append, sample and update of priorities and peak memory, saves results as JSON and compares them with the baseline.
+
+Should be started from the chapter directory, like: ./bench/harness.py -o results.json --baseline baseline.json
+"""
+import sys
+import json
+import time
+import inspect
+import argparse
+import resource
+import importlib
+import multiprocessing
+import numpy as np
+
+MODULES = ["simple_buffer_bench", "prio_buffer_bench"]
+SIZES = [10**n for n in (3, 4, 5)]
+BATCH_SIZES = [4, 8, 16, 32]
+DATA_SHAPE = (84, 84, 4)
+REPEAT_NUMBER = 10
+# relative change of the metric which is reported as regression
+TOLERANCE = 0.1
+# smaller growth of peak RSS is allocator noise and never reported
+RSS_FLOOR_MB = 5.0
+
+
+def discover(module_names):
+    """
+    Find replay buffer classes defined in modules: every class which has append and sample methods
+    :return: dict with full name of the class -> class
+    """
+    result = {}
+    for module_name in module_names:
+        module = importlib.import_module(module_name)
+        for name, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ != module.__name__:
+                continue
+            if callable(getattr(cls, "append", None)) and callable(getattr(cls, "sample", None)):
+                result["%s.%s" % (module_name, name)] = cls
+    return result
+
+
+def find_class(full_name):
+    module_name, name = full_name.rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), name)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux, but in bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss /= 1024
+    return rss / 1024
+
+
+def throughput(func, count, repeat):
+    """
+    Call func repeat times and return count of items processed per second
+    """
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return count * repeat / (time.perf_counter() - started)
+
+
+def bench_one(full_name, size, batch_sizes, repeat):
+    """
+    Benchmark the buffer of one size. Called in fresh process, so peak RSS belongs to this buffer only.
+    """
+    buf_class = find_class(full_name)
+    rss_start = peak_rss_mb()
+
+    def fill(buf):
+        # every item gets its own observation, as it comes from the environment, so, memory of stored items counts
+        for idx in range(size):
+            buf.append(np.full(DATA_SHAPE, idx % 256, dtype=np.uint8))
+
+    res = {
+        "buffer": full_name,
+        "size": size,
+        "fill": throughput(lambda: fill(buf_class(size)), size, repeat),
+    }
+    buf = buf_class(size)
+    fill(buf)
+    res["append"] = throughput(lambda: fill(buf), size, repeat)
+    res["sample"] = {}
+    for batch_size in batch_sizes:
+        res["sample"][str(batch_size)] = throughput(lambda: buf.sample(batch_size), 1, repeat*100)
+    if callable(getattr(buf, "update_priorities", None)):
+        res["update"] = {}
+        for batch_size in batch_sizes:
+            prios = np.random.uniform(size=batch_size)
+            update = lambda: buf.update_priorities(np.random.randint(len(buf), size=batch_size), prios)
+            res["update"][str(batch_size)] = throughput(update, 1, repeat*100)
+    res["peak_rss_mb"] = peak_rss_mb() - rss_start
+    return res
+
+
+def run(buffers, sizes, batch_sizes, repeat, log=print):
+    """
+    Benchmark every buffer at every size, each in the separate process
+    :param buffers: list of full class names
+    :return: list of result dicts
+    """
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for full_name in buffers:
+        log("Benchmarking %s" % full_name)
+        for size in sizes:
+            with ctx.Pool(processes=1) as pool:
+                res = pool.apply(bench_one, (full_name, size, batch_sizes, repeat))
+            log("  Test size %d" % size)
+            log("  * Initial fill:\t%.2f items/s" % res["fill"])
+            log("  * Append:\t\t%.2f items/s" % res["append"])
+            for batch_size, val in res["sample"].items():
+                log("  * Sample %s:\t\t%.2f items/s" % (batch_size, val))
+            for batch_size, val in res.get("update", {}).items():
+                log("  * Update %s:\t\t%.2f items/s" % (batch_size, val))
+            log("  * Peak RSS:\t\t%.2f MB" % res["peak_rss_mb"])
+            results.append(res)
+    return results
+
+
+def flatten(res):
+    """
+    Convert one result into dict of metric name -> (value, bigger_is_better)
+    """
+    metrics = {
+        "fill": (res["fill"], True),
+        "append": (res["append"], True),
+        "peak_rss_mb": (res["peak_rss_mb"], False),
+    }
+    for kind in ("sample", "update"):
+        for batch_size, val in res.get(kind, {}).items():
+            metrics["%s_%s" % (kind, batch_size)] = (val, True)
+    return metrics
+
+
+def compare(results, baseline, tolerance=TOLERANCE, rss_floor=RSS_FLOOR_MB):
+    """
+    Compare results with the baseline, only buffers and sizes present in both are checked
+    :param rss_floor: growth of peak RSS in MB below which it is not reported regardless of tolerance
+    :return: list of regression dicts
+    """
+    base = {(r["buffer"], r["size"]): r for r in baseline}
+    regressions = []
+    for res in results:
+        base_res = base.get((res["buffer"], res["size"]))
+        if base_res is None:
+            continue
+        base_metrics = flatten(base_res)
+        for metric, (val, bigger_better) in flatten(res).items():
+            if metric not in base_metrics:
+                continue
+            base_val = base_metrics[metric][0]
+            if metric == "peak_rss_mb" and val - base_val < rss_floor:
+                continue
+            if bigger_better:
+                failed = val < base_val * (1 - tolerance)
+            else:
+                failed = val > base_val * (1 + tolerance)
+            if failed:
+                regressions.append({
+                    "buffer": res["buffer"],
+                    "size": res["size"],
+                    "metric": metric,
+                    "baseline": base_val,
+                    "value": val,
+                })
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--module", action="append", help="Module to discover buffers in, default=" +
+                                                                 ",".join(MODULES))
+    parser.add_argument("-b", "--buffer", action="append",
+                        help="Name of buffer class to benchmark (could be repeated), default=all discovered")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="Comma-separated buffer sizes")
+    parser.add_argument("--batches", default=",".join(map(str, BATCH_SIZES)), help="Comma-separated batch sizes")
+    parser.add_argument("--repeat", type=int, default=REPEAT_NUMBER, help="Count of repeats, default=%d" %
+                                                                           REPEAT_NUMBER)
+    parser.add_argument("-o", "--output", help="File to save results as JSON")
+    parser.add_argument("--baseline", help="JSON file with results to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="Relative change reported as regression, default=%.2f" % TOLERANCE)
+    parser.add_argument("--rss-floor", type=float, default=RSS_FLOOR_MB,
+                        help="Growth of peak RSS in MB never reported as regression, default=%.1f" % RSS_FLOOR_MB)
+    parser.add_argument("--list", default=False, action="store_true", help="List discovered buffers and exit")
+    args = parser.parse_args()
+
+    buffers = discover(args.module or MODULES)
+    if args.list:
+        for name in sorted(buffers):
+            print(name)
+        sys.exit(0)
+    names = sorted(buffers)
+    if args.buffer:
+        names = [name for name in names if name in args.buffer or name.rsplit(".", 1)[1] in args.buffer]
+        if not names:
+            print("No buffers matched, use --list to see available ones")
+            sys.exit(1)
+    sizes = [int(s) for s in args.sizes.split(",")]
+    batch_sizes = [int(s) for s in args.batches.split(",")]
+
+    results = run(names, sizes, batch_sizes, args.repeat)
+    if args.output:
+        with open(args.output, "wt", encoding='utf-8') as fd:
+            json.dump({
+                "data_shape": DATA_SHAPE,
+                "repeat": args.repeat,
+                "results": results,
+            }, fd, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "rt", encoding='utf-8') as fd:
+            baseline = json.load(fd)["results"]
+        regressions = compare(results, baseline, args.tolerance, args.rss_floor)
+        for reg in regressions:
+            print("Regression: %s, size %d, %s: %.2f -> %.2f" % (
+                reg["buffer"], reg["size"], reg["metric"], reg["baseline"], reg["value"]))
+        if regressions:
+            sys.exit(1)
+        print("No regressions found")
@@ -2,13 +2,15 @@
 """
 Benchmark various Priority Replay Buffer variants
 """
-import timeit
+import sys
 import numpy as np
 import collections
 
-SIZES = [10**n for n in (3, 4, 5)]
-DATA_SHAPE = (84, 84, 4)
-REPEAT_NUMBER = 10
+sys.path.append(".")
+from lib import replay
+
+import harness
+from harness import SIZES, BATCH_SIZES, REPEAT_NUMBER
 
 
 class PrioReplayBufferDeque:
@@ -80,37 +82,12 @@ class PrioReplayBufferList:
             self.priorities[idx] = prio
 
 
-def fill_buf(buf, size):
-    for _ in range(size):
-        buf.append(np.zeros(DATA_SHAPE, dtype=np.uint8))
-
-
-def bench_buffer(buf_class):
-    print("Benchmarking %s" % buf_class.__name__)
-
-    for size in SIZES:
-        print("  Test size %d" % size)
-        ns = globals()
-        ns.update(locals())
-        t = timeit.timeit('fill_buf(buf, size)', setup='buf = buf_class(size)', number=REPEAT_NUMBER, globals=ns)
-        print("  * Initial fill:\t%.2f items/s" % (size*REPEAT_NUMBER / t))
-        buf = buf_class(size)
-        fill_buf(buf, size)
-        ns.update(locals())
-        t = timeit.timeit('fill_buf(buf, size)', number=REPEAT_NUMBER, globals=ns)
-        print("  * Append:\t\t%.2f items/s" % (size*REPEAT_NUMBER / t))
-        t = timeit.timeit('buf.sample(4)', number=REPEAT_NUMBER*100, globals=ns)
-        print("  * Sample 4:\t\t%.2f items/s" % (REPEAT_NUMBER*100 / t))
-        t = timeit.timeit('buf.sample(8)', number=REPEAT_NUMBER*100, globals=ns)
-        print("  * Sample 8:\t\t%.2f items/s" % (REPEAT_NUMBER*100 / t))
-        t = timeit.timeit('buf.sample(16)', number=REPEAT_NUMBER*100, globals=ns)
-        print("  * Sample 16:\t\t%.2f items/s" % (REPEAT_NUMBER*100 / t))
-        t = timeit.timeit('buf.sample(32)', number=REPEAT_NUMBER*100, globals=ns)
-        print("  * Sample 32:\t\t%.2f items/s" % (REPEAT_NUMBER*100 / t))
-
+class PrioReplayBufferTree(replay.PrioReplayBuffer):
+    def __init__(self, buf_size, prob_alpha=0.6):
+        super(PrioReplayBufferTree, self).__init__(None, buf_size, prob_alpha)
 
 
 if __name__ == "__main__":
-    bench_buffer(PrioReplayBufferList)
-    bench_buffer(PrioReplayBufferDeque)
-    pass
+    harness.run(["prio_buffer_bench.PrioReplayBufferTree",
+                 "prio_buffer_bench.PrioReplayBufferList",
+                 "prio_buffer_bench.PrioReplayBufferDeque"], SIZES, BATCH_SIZES, REPEAT_NUMBER)
@@ -0,0 +1,112 @@
+"""
+Actor processes for decoupled (Ape-X like) training: actors play with the copy of the network and send
+transitions to the learner, which keeps the replay buffer and trains all the time.
+"""
+import gym
+import ptan
+import copy
+import queue
+import collections
+
+import torch
+import torch.multiprocessing as mp
+
+from . import common
+
+# how often (in frames) learner's weights are copied to actors
+SYNC_FRAMES = 1000
+# transitions buffered per actor before actors are blocked
+QUEUE_SIZE = 64
+
+EpisodeEnded = collections.namedtuple('EpisodeEnded', field_names=('reward', ))
+
+
+def actor_func(net, selector, epsilon, params, steps_count, qvals, exp_queue):
+    # we have several processes, so, one thread per process is enough
+    torch.set_num_threads(1)
+    env = ptan.common.wrappers.wrap_dqn(gym.make(params['env_name']))
+    agent = ptan.agent.DQNAgent(net.qvals if qvals else net, selector)
+    exp_source = ptan.experience.ExperienceSourceFirstLast(env, agent, gamma=params['gamma'],
+                                                           steps_count=steps_count)
+    for exp in exp_source:
+        if epsilon is not None:
+            selector.epsilon = epsilon.value
+        new_rewards = exp_source.pop_total_rewards()
+        if new_rewards:
+            exp_queue.put(EpisodeEnded(reward=new_rewards[0]))
+        exp_queue.put(exp)
+
+
+class ActorPool:
+    """
+    Replacement of experience source, which gets transitions from actor processes. Actors use the copy of
+    the network in shared memory, refreshed every SYNC_FRAMES frames, and epsilon of the learner's selector.
+    Processes use spawn start method, so, it should be set in the main module.
+    """
+    def __init__(self, net, selector, params, count, steps_count=1, sync_frames=SYNC_FRAMES, qvals=False):
+        """
+        :param qvals: actions are chosen by net.qvals() instead of net's output, like for distributional nets
+        """
+        self.net = net
+        self.selector = selector
+        self.sync_frames = sync_frames
+        self.actor_net = copy.deepcopy(net).cpu()
+        self.actor_net.share_memory()
+        self.epsilon = None
+        if isinstance(selector, ptan.actions.EpsilonGreedyActionSelector):
+            self.epsilon = mp.Value('d', selector.epsilon)
+        self.max_ready = count * QUEUE_SIZE
+        self.queue = mp.Queue(maxsize=self.max_ready)
+        self.ready = collections.deque()
+        self.total_rewards = []
+        self.frames = 0
+        self.sync_frame = 0
+        self.processes = []
+        for _ in range(count):
+            proc = mp.Process(target=actor_func, daemon=True,
+                              args=(self.actor_net, copy.copy(selector), self.epsilon, params, steps_count,
+                                    qvals, self.queue))
+            proc.start()
+            self.processes.append(proc)
+
+    def __iter__(self):
+        while True:
+            if not self.ready:
+                self._receive(block=True)
+            yield self.ready.popleft()
+
+    def _receive(self, block):
+        """
+        Get all available entries from the queue
+        :param block: wait for the first transition
+        """
+        while True:
+            try:
+                entry = self.queue.get(block=block and not self.ready)
+            except queue.Empty:
+                return
+            if isinstance(entry, EpisodeEnded):
+                self.total_rewards.append(entry.reward)
+            else:
+                self.ready.append(entry)
+                self.frames += 1
+                if len(self.ready) >= self.max_ready:
+                    return
+
+    def pop_total_rewards(self):
+        res = self.total_rewards
+        self.total_rewards = []
+        return res
+
+    def wait_ready(self):
+        """
+        Wait for transitions from actors, share epsilon and refresh weights of actors if needed
+        :return: count of transitions ready to be taken
+        """
+        self._receive(block=True)
+        if self.epsilon is not None:
+            self.epsilon.value = self.selector.epsilon
+        if self.frames - self.sync_frame >= self.sync_frames:
+            self.actor_net.load_state_dict(self.net.state_dict())
+            self.sync_frame = self.frames
+        return len(self.ready)
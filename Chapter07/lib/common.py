@@ -4,6 +4,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 
+from . import replay
 
 HYPERPARAMS = {
     'pong': {
@@ -81,14 +82,21 @@ def unpack_batch(batch):
            np.array(dones, dtype=np.uint8), np.array(last_states, copy=False)
 
 
-def calc_loss_dqn(batch, net, tgt_net, gamma, device="cpu"):
-    states, actions, rewards, dones, next_states = unpack_batch(batch)
+def unpack_batch_t(batch, device="cpu"):
+    """
+    Convert batch into tensors on the device. Batch from array-backed replay buffers is already stacked, so, it's
+    just moved to the device, list of experience entries is unpacked first.
+    :return: tuple of tensors (states, actions, rewards, dones, last_states)
+    """
+    if isinstance(batch, replay.Batch):
+        return tuple(t.to(device) for t in batch)
+    states, actions, rewards, dones, last_states = unpack_batch(batch)
+    return torch.tensor(states).to(device), torch.tensor(actions).to(device), torch.tensor(rewards).to(device), \
+           torch.ByteTensor(dones).to(device), torch.tensor(last_states).to(device)
+
 
-    states_v = torch.tensor(states).to(device)
-    next_states_v = torch.tensor(next_states).to(device)
-    actions_v = torch.tensor(actions).to(device)
-    rewards_v = torch.tensor(rewards).to(device)
-    done_mask = torch.ByteTensor(dones).to(device)
+def calc_loss_dqn(batch, net, tgt_net, gamma, device="cpu"):
+    states_v, actions_v, rewards_v, done_mask, next_states_v = unpack_batch_t(batch, device)
 
     state_action_values = net(states_v).gather(1, actions_v.unsqueeze(-1)).squeeze(-1)
     next_state_values = tgt_net(next_states_v).max(1)[0]
@@ -150,36 +158,55 @@ class EpsilonTracker:
 def distr_projection(next_distr, rewards, dones, Vmin, Vmax, n_atoms, gamma):
     """
     Perform distribution projection aka Catergorical Algorithm from the
-    "A Distributional Perspective on RL" paper
+    "A Distributional Perspective on RL" paper.
+    All atoms are projected at once: every atom shares its probability between neighbour atoms l and u of
+    the shifted support. Done episodes are projected as the single atom with probability 1 and zero discount.
     """
     batch_size = len(rewards)
-    proj_distr = np.zeros((batch_size, n_atoms), dtype=np.float32)
     delta_z = (Vmax - Vmin) / (n_atoms - 1)
-    for atom in range(n_atoms):
-        tz_j = np.minimum(Vmax, np.maximum(Vmin, rewards + (Vmin + atom * delta_z) * gamma))
-        b_j = (tz_j - Vmin) / delta_z
-        l = np.floor(b_j).astype(np.int64)
-        u = np.ceil(b_j).astype(np.int64)
-        eq_mask = u == l
-        proj_distr[eq_mask, l[eq_mask]] += next_distr[eq_mask, atom]
-        ne_mask = u != l
-        proj_distr[ne_mask, l[ne_mask]] += next_distr[ne_mask, atom] * (u - b_j)[ne_mask]
-        proj_distr[ne_mask, u[ne_mask]] += next_distr[ne_mask, atom] * (b_j - l)[ne_mask]
-    if dones.any():
-        proj_distr[dones] = 0.0
-        tz_j = np.minimum(Vmax, np.maximum(Vmin, rewards[dones]))
-        b_j = (tz_j - Vmin) / delta_z
-        l = np.floor(b_j).astype(np.int64)
-        u = np.ceil(b_j).astype(np.int64)
-        eq_mask = u == l
-        eq_dones = dones.copy()
-        eq_dones[dones] = eq_mask
-        if eq_dones.any():
-            proj_distr[eq_dones, l[eq_mask]] = 1.0
-        ne_mask = u != l
-        ne_dones = dones.copy()
-        ne_dones[dones] = ne_mask
-        if ne_dones.any():
-            proj_distr[ne_dones, l[ne_mask]] = (u - b_j)[ne_mask]
-            proj_distr[ne_dones, u[ne_mask]] = (b_j - l)[ne_mask]
-    return proj_distr
+    dones = np.asarray(dones, dtype=bool)
+    next_distr = np.array(next_distr, dtype=np.float32)
+    next_distr[dones] = 0.0
+    next_distr[dones, 0] = 1.0
+    gammas = np.where(dones, 0.0, gamma)
+
+    atoms = Vmin + np.arange(n_atoms) * delta_z
+    tz_j = np.clip(rewards[:, np.newaxis] + gammas[:, np.newaxis] * atoms, Vmin, Vmax)
+    b_j = (tz_j - Vmin) / delta_z
+    l = np.floor(b_j)
+    u = np.ceil(b_j)
+    # when b_j hits the atom exactly, all the probability goes to it
+    l_share = u - b_j + (u == l)
+    u_share = b_j - l
+
+    offsets = np.arange(batch_size)[:, np.newaxis] * n_atoms
+    proj_distr = np.zeros(batch_size * n_atoms, dtype=np.float32)
+    np.add.at(proj_distr, (l.astype(np.int64) + offsets).ravel(), (next_distr * l_share).ravel())
+    np.add.at(proj_distr, (u.astype(np.int64) + offsets).ravel(), (next_distr * u_share).ravel())
+    return proj_distr.reshape(batch_size, n_atoms)
+
+
+def distr_projection_t(next_distr_v, rewards_v, dones_v, Vmin, Vmax, n_atoms, gamma):
+    """
+    The same projection as distr_projection, but on torch tensors, so, it stays on the device of the arguments
+    """
+    batch_size = rewards_v.size(0)
+    device = rewards_v.device
+    delta_z = (Vmax - Vmin) / (n_atoms - 1)
+    dones_v = dones_v.float().unsqueeze(-1)
+    next_distr_v = next_distr_v.detach() * (1.0 - dones_v)
+    next_distr_v[:, 0] += dones_v.squeeze(-1)
+
+    atoms_v = Vmin + torch.arange(n_atoms, dtype=torch.float32, device=device) * delta_z
+    tz_v = rewards_v.float().unsqueeze(-1) + gamma * (1.0 - dones_v) * atoms_v.unsqueeze(0)
+    b_v = (tz_v.clamp(Vmin, Vmax) - Vmin) / delta_z
+    l_v = b_v.floor()
+    u_v = b_v.ceil()
+    l_share_v = u_v - b_v + (u_v == l_v).float()
+    u_share_v = b_v - l_v
+
+    offsets_v = torch.arange(batch_size, device=device).unsqueeze(-1) * n_atoms
+    proj_distr_v = torch.zeros(batch_size * n_atoms, dtype=torch.float32, device=device)
+    proj_distr_v.index_add_(0, (l_v.long() + offsets_v).view(-1), (next_distr_v * l_share_v).view(-1))
+    proj_distr_v.index_add_(0, (u_v.long() + offsets_v).view(-1), (next_distr_v * u_share_v).view(-1))
+    return proj_distr_v.view(batch_size, n_atoms)
@@ -0,0 +1,501 @@
+"""
+Replay buffers backed by numpy arrays
+"""
+import queue
+import operator
+import threading
+import collections
+import numpy as np
+import torch
+
+
+# batch of experience fields, stacked into tensors
+Batch = collections.namedtuple('Batch', field_names=['states', 'actions', 'rewards', 'dones', 'last_states'])
+
+
+class SegmentTree:
+    """
+    Binary tree over the array of values, kept in the flat numpy array: node i has children 2i and 2i+1,
+    leaves (values itself) start at index size. Every node keeps the operation applied to its children, so
+    the root contains the operation over the whole array. All the methods work on batches of indices.
+    """
+    def __init__(self, capacity, operation, scalar_operation, neutral):
+        """
+        :param capacity: count of values, rounded up to the power of two
+        :param operation: numpy ufunc combining children, like np.add or np.minimum
+        :param scalar_operation: the same operation for single values, it is much faster than ufunc on scalars
+        :param neutral: neutral element of the operation, initial value of leaves
+        """
+        size, depth = 1, 0
+        while size < capacity:
+            size *= 2
+            depth += 1
+        self.size = size
+        self.depth = depth
+        self.operation = operation
+        self.scalar_operation = scalar_operation
+        self.tree = np.full(2 * size, neutral, dtype=np.float64)
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.size]
+
+    def __setitem__(self, index, value):
+        tree = self.tree
+        node = index + self.size
+        tree[node] = value
+        node //= 2
+        while node >= 1:
+            tree[node] = self.scalar_operation(tree[2 * node], tree[2 * node + 1])
+            node //= 2
+
+    def update(self, indices, values):
+        """
+        Set values of leaves and recalculate their ancestors, level by level. Duplicate nodes on the level are
+        recalculated several times, which is cheaper than removing them.
+        """
+        nodes = np.asarray(indices, dtype=np.int64) + self.size
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            nodes //= 2
+            self.tree[nodes] = self.operation(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+
+    def root(self):
+        return self.tree[1]
+
+
+class SumTree(SegmentTree):
+    def __init__(self, capacity):
+        super(SumTree, self).__init__(capacity, np.add, operator.add, 0.0)
+
+    def find_prefixsum_idx(self, prefix_sums):
+        """
+        Find indices of leaves where the cumulative sum of values exceeds given prefix sums.
+        All the prefix sums descend the tree together.
+        :param prefix_sums: numpy array with values in [0, root())
+        :return: numpy array with indices
+        """
+        values = np.array(prefix_sums, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.size:
+            left = self.tree[2 * nodes]
+            go_right = values >= left
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self.size
+
+
+class MinTree(SegmentTree):
+    def __init__(self, capacity):
+        super(MinTree, self).__init__(capacity, np.minimum, min, np.inf)
+
+
+class PrioReplayBuffer:
+    """
+    Proportional prioritized replay buffer. Priorities are kept in the sum-tree (for sampling) and the min-tree
+    (for max weight), so, sampling and updates of priorities take O(log N) per sample.
+    """
+    def __init__(self, exp_source, buf_size, prob_alpha=0.6):
+        self.exp_source_iter = iter(exp_source) if exp_source is not None else None
+        self.prob_alpha = prob_alpha
+        self.capacity = buf_size
+        self.pos = 0
+        self.buffer = []
+        self.sum_tree = SumTree(buf_size)
+        self.min_tree = MinTree(buf_size)
+        self.max_priority = 1.0
+        # total count of appended samples
+        self.appended = 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def _put(self, sample):
+        if len(self.buffer) < self.capacity:
+            self.buffer.append(sample)
+        else:
+            self.buffer[self.pos] = sample
+
+    def _get(self, indices):
+        return [self.buffer[idx] for idx in indices]
+
+    def append(self, sample):
+        self._put(sample)
+        prio = self.max_priority ** self.prob_alpha
+        self.sum_tree[self.pos] = prio
+        self.min_tree[self.pos] = prio
+        self.pos = (self.pos + 1) % self.capacity
+        self.appended += 1
+
+    def populate(self, count):
+        for _ in range(count):
+            self.append(next(self.exp_source_iter))
+
+    def sample(self, batch_size, beta=0.4):
+        """
+        Stratified sampling: total priority is split into batch_size equal segments, one sample from every segment
+        :return: tuple of (samples, indices, weights)
+        """
+        indices, (_, weights) = self.sample_indices(batch_size, beta)
+        return self.gather(indices), indices, weights
+
+    def sample_indices(self, batch_size, beta=0.4):
+        """
+        Choose indices of the batch without gathering the samples
+        :return: tuple of (indices, extra), where extra is (indices, weights) tuple returned after samples
+        """
+        total = self.sum_tree.root()
+        segment = total / batch_size
+        prefix_sums = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * segment
+        indices = self.sum_tree.find_prefixsum_idx(prefix_sums)
+        # float rounding could lead us past the filled part of the buffer
+        count = len(self)
+        indices = np.minimum(indices, count - 1)
+
+        probs = self.sum_tree[indices] / total
+        min_prob = self.min_tree.root() / total
+        weights = (count * probs) ** (-beta) / (count * min_prob) ** (-beta)
+        return indices, (indices, weights.astype(np.float32))
+
+    def gather(self, indices):
+        return self._get(indices)
+
+    def overwritten(self, indices, appended):
+        return _overwritten(indices, self.pos, self.capacity, self.appended - appended)
+
+    def update_priorities(self, batch_indices, batch_priorities):
+        batch_priorities = np.asarray(batch_priorities, dtype=np.float64)
+        prios = batch_priorities ** self.prob_alpha
+        self.sum_tree.update(batch_indices, prios)
+        self.min_tree.update(batch_indices, prios)
+        self.max_priority = max(self.max_priority, float(batch_priorities.max()))
+
+
+class FrameStore:
+    """
+    Pool of observation frames kept in the numpy array. Frames are deduplicated by content, so, stacked
+    observations of consecutive steps share their frames, like LazyFrames do. Rows are reference counted and
+    reused when they are not needed anymore, pool grows if all the rows are used.
+    """
+    def __init__(self, frame, size):
+        self.frames = np.empty((size, ) + frame.shape, dtype=frame.dtype)
+        self.refs = np.zeros(size, dtype=np.int64)
+        # content hash -> row and the hash of the row, if it is kept in the index
+        self.index = {}
+        self.row_keys = [None] * size
+        self.free_rows = list(range(size-1, -1, -1))
+
+    def __len__(self):
+        return len(self.frames) - len(self.free_rows)
+
+    def _grow(self):
+        size = len(self.frames)
+        new_size = size + size // 4 + 1
+        frames = np.empty((new_size, ) + self.frames.shape[1:], dtype=self.frames.dtype)
+        frames[:size] = self.frames
+        self.frames = frames
+        self.refs = np.concatenate((self.refs, np.zeros(new_size - size, dtype=np.int64)))
+        self.row_keys.extend([None] * (new_size - size))
+        self.free_rows.extend(range(new_size-1, size-1, -1))
+
+    def add(self, obs):
+        """
+        Add frames of the observation (slices over the first axis)
+        :return: numpy array with rows of the frames
+        """
+        rows = np.empty(len(obs), dtype=np.int64)
+        for idx, frame in enumerate(obs):
+            key = hash(frame.tobytes())
+            row = self.index.get(key)
+            if row is None or not np.array_equal(self.frames[row], frame):
+                if not self.free_rows:
+                    self._grow()
+                row = self.free_rows.pop()
+                self.frames[row] = frame
+                # on hash collision the frame is kept without deduplication
+                if key not in self.index:
+                    self.index[key] = row
+                    self.row_keys[row] = key
+            self.refs[row] += 1
+            rows[idx] = row
+        return rows
+
+    def retain(self, rows):
+        np.add.at(self.refs, rows, 1)
+
+    def release(self, rows):
+        for row in rows.tolist():
+            self.refs[row] -= 1
+            if self.refs[row] == 0:
+                key = self.row_keys[row]
+                if key is not None:
+                    del self.index[key]
+                    self.row_keys[row] = None
+                self.free_rows.append(row)
+
+
+def _overwritten(indices, pos, capacity, written):
+    """
+    Check which entries of the ring buffer were overwritten by the last appends
+    :param pos: position of the next append
+    :param written: count of the last appends
+    :return: numpy array of bools
+    """
+    indices = np.asarray(indices)
+    if written >= capacity:
+        return np.ones(len(indices), dtype=bool)
+    return (pos - 1 - indices) % capacity < written
+
+
+class ExperienceArrays:
+    """
+    Fields of ExperienceFirstLast entries kept in preallocated numpy arrays, so, batch could be gathered by
+    indices without python loop over samples. Observations are split into frames over the first axis (stacked
+    frames of Atari wrappers), every frame is kept once in FrameStore and entries keep only rows of their frames.
+    Arrays are allocated on the first entry, when shape and dtype of observations are known.
+    """
+    def __init__(self, capacity, pin_memory=False):
+        """
+        :param pin_memory: gather batches into page-locked tensors, which are reused, so, device has to be CUDA
+        """
+        self.capacity = capacity
+        self.pin_memory = pin_memory
+        self.count = 0
+        self.frames = None
+        # batch size -> pinned tensors of batch fields
+        self._pinned = {}
+        self._copy_event = None
+
+    def __len__(self):
+        return self.count
+
+    def _allocate(self, state):
+        # in the stream of transitions every observation brings one new frame, some room is left for the frames of
+        # episode starts and n-step last states
+        self.frames = FrameStore(state[0], self.capacity + self.capacity // 16 + 2 * len(state))
+        self.state_rows = np.empty((self.capacity, len(state)), dtype=np.int64)
+        self.last_state_rows = np.empty_like(self.state_rows)
+        self.actions = np.empty(self.capacity, dtype=np.int64)
+        self.rewards = np.empty(self.capacity, dtype=np.float32)
+        self.dones = np.empty(self.capacity, dtype=np.uint8)
+
+    def put(self, pos, exp):
+        state = np.asarray(exp.state)
+        if self.frames is None:
+            self._allocate(state)
+        if pos < self.count:
+            self.frames.release(self.state_rows[pos])
+            self.frames.release(self.last_state_rows[pos])
+        self.state_rows[pos] = self.frames.add(state)
+        self.actions[pos] = exp.action
+        self.rewards[pos] = exp.reward
+        if exp.last_state is None:
+            self.dones[pos] = 1
+            # the result will be masked anyway
+            self.last_state_rows[pos] = self.state_rows[pos]
+            self.frames.retain(self.state_rows[pos])
+        else:
+            self.dones[pos] = 0
+            self.last_state_rows[pos] = self.frames.add(np.asarray(exp.last_state))
+        self.count = max(self.count, pos + 1)
+
+    def _outputs(self, batch_size):
+        """
+        Arrays to gather the batch into. Pinned tensors are reused, so, the previous copy to GPU has to be finished
+        :return: list of tensors and list of numpy arrays sharing memory with them
+        """
+        frames = self.frames.frames
+        shapes = [(batch_size, self.state_rows.shape[1]) + frames.shape[1:], (batch_size, ), (batch_size, ),
+                  (batch_size, ), (batch_size, self.state_rows.shape[1]) + frames.shape[1:]]
+        dtypes = [frames.dtype, self.actions.dtype, self.rewards.dtype, self.dones.dtype, frames.dtype]
+        if not self.pin_memory:
+            arrays = [np.empty(shape, dtype=dtype) for shape, dtype in zip(shapes, dtypes)]
+            return [torch.from_numpy(arr) for arr in arrays], arrays
+        tensors = self._pinned.get(batch_size)
+        if tensors is None:
+            # page-locked memory allows asynchronous copy to GPU
+            tensors = [torch.from_numpy(np.empty(shape, dtype=dtype)).pin_memory()
+                       for shape, dtype in zip(shapes, dtypes)]
+            self._pinned[batch_size] = tensors
+        elif self._copy_event is not None:
+            self._copy_event.synchronize()
+        return tensors, [t.numpy() for t in tensors]
+
+    def get(self, indices, device="cpu"):
+        """
+        Gather entries into the batch of tensors on the device
+        :return: Batch
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        tensors, arrays = self._outputs(len(indices))
+        np.take(self.frames.frames, self.state_rows[indices], axis=0, out=arrays[0])
+        np.take(self.actions, indices, out=arrays[1])
+        np.take(self.rewards, indices, out=arrays[2])
+        np.take(self.dones, indices, out=arrays[3])
+        np.take(self.frames.frames, self.last_state_rows[indices], axis=0, out=arrays[4])
+        if not self.pin_memory:
+            return Batch(*[t.to(device) for t in tensors])
+        res = Batch(*[t.to(device, non_blocking=True) for t in tensors])
+        self._copy_event = torch.cuda.Event()
+        self._copy_event.record()
+        return res
+
+
+class ArrayReplayBuffer:
+    """
+    Uniform replay buffer with experience kept in ExperienceArrays. Sample returns Batch of tensors.
+    """
+    def __init__(self, exp_source, buffer_size, device="cpu", pin_memory=False):
+        self.exp_source_iter = iter(exp_source) if exp_source is not None else None
+        self.capacity = buffer_size
+        self.device = device
+        self.pos = 0
+        self.appended = 0
+        self.arrays = ExperienceArrays(buffer_size, pin_memory=pin_memory)
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def append(self, sample):
+        self.arrays.put(self.pos, sample)
+        self.pos = (self.pos + 1) % self.capacity
+        self.appended += 1
+
+    def populate(self, count):
+        for _ in range(count):
+            self.append(next(self.exp_source_iter))
+
+    def sample(self, batch_size):
+        indices, _ = self.sample_indices(batch_size)
+        return self.gather(indices)
+
+    def sample_indices(self, batch_size):
+        """
+        :return: tuple of (indices, extra), extra is None as only samples are returned by sample()
+        """
+        return np.random.randint(len(self), size=batch_size), None
+
+    def gather(self, indices):
+        return self.arrays.get(indices, self.device)
+
+    def overwritten(self, indices, appended):
+        """
+        Check which entries were overwritten since the given count of appended samples
+        """
+        return _overwritten(indices, self.pos, self.capacity, self.appended - appended)
+
+
+class ArrayPrioReplayBuffer(PrioReplayBuffer):
+    """
+    Prioritized replay buffer with experience kept in ExperienceArrays. Sample returns Batch of tensors in place
+    of samples list.
+    """
+    def __init__(self, exp_source, buf_size, prob_alpha=0.6, device="cpu", pin_memory=False):
+        super(ArrayPrioReplayBuffer, self).__init__(exp_source, buf_size, prob_alpha)
+        self.device = device
+        self.arrays = ExperienceArrays(buf_size, pin_memory=pin_memory)
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def _put(self, sample):
+        self.arrays.put(self.pos, sample)
+
+    def _get(self, indices):
+        return self.arrays.get(indices, self.device)
+
+
+class BatchPrefetcher:
+    """
+    Samples batches from the replay buffer in the background thread and keeps up to count of them ready, so, the
+    training step doesn't wait for sampling and collation. Buffer is shared with the training loop, so, it
+    should be populated and updated only through the prefetcher, which serializes access with the lock.
+    If the buffer has sample_indices() and gather() methods, only indices are chosen under the lock and samples
+    are gathered without it, entries overwritten by populate meanwhile are gathered again.
+    With prioritized buffer the ready batches are sampled before the latest priorities update, which is the
+    price for the prefetch.
+    """
+    def __init__(self, buffer, batch_size, count=2, collate=None, **sample_kwargs):
+        """
+        :param buffer: replay buffer with populate() and sample(batch_size, ...) methods
+        :param count: maximum amount of ready batches
+        :param collate: optional function applied to samples in the background thread, like conversion
+        to tensors. With prioritized buffer only samples are passed to it, indices and weights are kept.
+        :param sample_kwargs: extra arguments of buffer's sample, could be changed by sample() call
+        """
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.collate = collate
+        self.sample_kwargs = sample_kwargs
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=count)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def populate(self, count):
+        with self.lock:
+            self.buffer.populate(count)
+
+    def update_priorities(self, batch_indices, batch_priorities):
+        with self.lock:
+            self.buffer.update_priorities(batch_indices, batch_priorities)
+
+    def _sample(self):
+        if not hasattr(self.buffer, "sample_indices"):
+            with self.lock:
+                res = self.buffer.sample(self.batch_size, **self.sample_kwargs)
+            samples, extra = (res[0], res[1:]) if isinstance(res, tuple) else (res, None)
+        else:
+            with self.lock:
+                indices, extra = self.buffer.sample_indices(self.batch_size, **self.sample_kwargs)
+                appended = self.buffer.appended
+            samples = self.buffer.gather(indices)
+            with self.lock:
+                if self.buffer.overwritten(indices, appended).any():
+                    samples = self.buffer.gather(indices)
+        if self.collate is not None:
+            samples = self.collate(samples)
+        return samples if extra is None else (samples, ) + extra
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                res = self._sample()
+            except Exception as e:
+                res = e
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(res, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(res, Exception):
+                break
+
+    def sample(self, **sample_kwargs):
+        """
+        Return the next ready batch, background sampling is started on the first call
+        :param sample_kwargs: new arguments of buffer's sample, like beta, used for the following batches
+        """
+        self.sample_kwargs.update(sample_kwargs)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        res = self.queue.get()
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,84 @@
+from unittest import TestCase
+import numpy as np
+import torch
+
+from lib import common
+
+Vmax = 10
+Vmin = -10
+N_ATOMS = 51
+
+
+def distr_projection_loop(next_distr, rewards, dones, Vmin, Vmax, n_atoms, gamma):
+    """
+    Original per-atom implementation of the projection, used as reference
+    """
+    batch_size = len(rewards)
+    proj_distr = np.zeros((batch_size, n_atoms), dtype=np.float32)
+    delta_z = (Vmax - Vmin) / (n_atoms - 1)
+    for atom in range(n_atoms):
+        tz_j = np.minimum(Vmax, np.maximum(Vmin, rewards + (Vmin + atom * delta_z) * gamma))
+        b_j = (tz_j - Vmin) / delta_z
+        l = np.floor(b_j).astype(np.int64)
+        u = np.ceil(b_j).astype(np.int64)
+        eq_mask = u == l
+        proj_distr[eq_mask, l[eq_mask]] += next_distr[eq_mask, atom]
+        ne_mask = u != l
+        proj_distr[ne_mask, l[ne_mask]] += next_distr[ne_mask, atom] * (u - b_j)[ne_mask]
+        proj_distr[ne_mask, u[ne_mask]] += next_distr[ne_mask, atom] * (b_j - l)[ne_mask]
+    if dones.any():
+        proj_distr[dones] = 0.0
+        tz_j = np.minimum(Vmax, np.maximum(Vmin, rewards[dones]))
+        b_j = (tz_j - Vmin) / delta_z
+        l = np.floor(b_j).astype(np.int64)
+        u = np.ceil(b_j).astype(np.int64)
+        eq_mask = u == l
+        eq_dones = dones.copy()
+        eq_dones[dones] = eq_mask
+        if eq_dones.any():
+            proj_distr[eq_dones, l[eq_mask]] = 1.0
+        ne_mask = u != l
+        ne_dones = dones.copy()
+        ne_dones[dones] = ne_mask
+        if ne_dones.any():
+            proj_distr[ne_dones, l[ne_mask]] = (u - b_j)[ne_mask]
+            proj_distr[ne_dones, u[ne_mask]] = (b_j - l)[ne_mask]
+    return proj_distr
+
+
+class TestDistrProjection(TestCase):
+    def setUp(self):
+        np.random.seed(123)
+        batch_size = 64
+        distr = np.random.uniform(size=(batch_size, N_ATOMS)).astype(np.float32)
+        self.distr = distr / distr.sum(axis=1, keepdims=True)
+        # integer rewards hit atoms exactly, others fall between them, large ones are clipped
+        self.rewards = np.concatenate([
+            np.random.randint(-2, 3, size=batch_size // 4),
+            np.random.uniform(-3, 3, size=batch_size // 2),
+            np.random.choice([-15, 15], size=batch_size // 4),
+        ]).astype(np.float32)
+        self.dones = np.random.uniform(size=batch_size) < 0.3
+
+    def test_numpy(self):
+        for gamma in (0.9, 0.99, 1.0):
+            ref = distr_projection_loop(self.distr, self.rewards, self.dones, Vmin, Vmax, N_ATOMS, gamma)
+            res = common.distr_projection(self.distr, self.rewards, self.dones, Vmin, Vmax, N_ATOMS, gamma)
+            np.testing.assert_allclose(res, ref, atol=1e-5)
+            np.testing.assert_allclose(res.sum(axis=1), 1.0, atol=1e-5)
+
+    def test_torch(self):
+        for gamma in (0.9, 0.99, 1.0):
+            ref = distr_projection_loop(self.distr, self.rewards, self.dones, Vmin, Vmax, N_ATOMS, gamma)
+            res_v = common.distr_projection_t(torch.tensor(self.distr), torch.tensor(self.rewards),
+                                              torch.tensor(self.dones.astype(np.uint8)),
+                                              Vmin, Vmax, N_ATOMS, gamma)
+            np.testing.assert_allclose(res_v.numpy(), ref, atol=1e-5)
+
+    def test_single_peak(self):
+        distr = np.zeros((1, N_ATOMS), dtype=np.float32)
+        distr[0, N_ATOMS // 2] = 1.0
+        res = common.distr_projection(distr, np.array([2], dtype=np.float32), np.array([False]),
+                                      Vmin, Vmax, N_ATOMS, gamma=0.9)
+        # atom at zero value moves to the reward
+        self.assertAlmostEqual(res[0, N_ATOMS // 2 + 5], 1.0, places=5)
@@ -0,0 +1,103 @@
+import collections
+from unittest import TestCase
+import numpy as np
+
+from lib import common, replay
+
+Experience = collections.namedtuple('Experience', field_names=['state', 'action', 'reward', 'last_state'])
+
+
+def make_exp(idx, done=False):
+    state = np.full((2, 3), idx, dtype=np.uint8)
+    last_state = None if done else state + 1
+    return Experience(state=state, action=idx % 4, reward=float(idx), last_state=last_state)
+
+
+class TestArrayReplayBuffer(TestCase):
+    def test_sample(self):
+        buf = replay.ArrayReplayBuffer(None, 4)
+        for idx in range(6):
+            buf.append(make_exp(idx, done=idx == 5))
+        self.assertEqual(len(buf), 4)
+        batch = buf.sample(16)
+        self.assertIsInstance(batch, replay.Batch)
+        self.assertEqual(tuple(batch.states.size()), (16, 2, 3))
+        states = batch.states.numpy()[:, 0, 0]
+        # two oldest entries were overwritten
+        self.assertTrue(set(states.tolist()) <= {2, 3, 4, 5})
+        np.testing.assert_equal(batch.rewards.numpy(), states.astype(np.float32))
+        np.testing.assert_equal(batch.actions.numpy(), states % 4)
+        np.testing.assert_equal(batch.dones.numpy(), states == 5)
+
+    def test_overwritten(self):
+        buf = replay.ArrayReplayBuffer(None, 4)
+        for idx in range(3):
+            buf.append(make_exp(idx))
+        appended = buf.appended
+        buf.append(make_exp(3))
+        buf.append(make_exp(4))
+        np.testing.assert_equal(buf.overwritten([0, 1, 2, 3], appended), [True, False, False, True])
+        self.assertTrue(buf.overwritten([1, 2], appended - 4).all())
+
+    def test_same_as_unpack(self):
+        exps = [make_exp(idx, done=idx == 2) for idx in range(4)]
+        arrays = replay.ExperienceArrays(4)
+        for idx, exp in enumerate(exps):
+            arrays.put(idx, exp)
+        batch = arrays.get([3, 2, 0])
+        ref = common.unpack_batch([exps[3], exps[2], exps[0]])
+        for res_v, ref_arr in zip(common.unpack_batch_t(batch), ref):
+            np.testing.assert_equal(res_v.numpy(), ref_arr)
+
+
+class TestFrameStore(TestCase):
+    def test_shared_frames(self):
+        frames = [np.full((2, 2), idx, dtype=np.uint8) for idx in range(10)]
+        stack = lambda idx: np.stack(frames[idx:idx+3])
+        arrays = replay.ExperienceArrays(4)
+        for idx in range(6):
+            arrays.put(idx % 4, Experience(state=stack(idx), action=0, reward=0.0, last_state=stack(idx+1)))
+        # entries 2..5 are left, their stacks share frames 2..8
+        self.assertEqual(len(arrays.frames), 7)
+        batch = arrays.get([0, 1, 2, 3])
+        np.testing.assert_equal(batch.states.numpy()[:, :, 0, 0], [stack(idx)[:, 0, 0] for idx in (4, 5, 2, 3)])
+        np.testing.assert_equal(batch.last_states.numpy()[:, -1, 0, 0], [7, 8, 5, 6])
+        # done entry doesn't add frames of the last state
+        arrays.put(0, Experience(state=stack(6), action=0, reward=0.0, last_state=None))
+        self.assertEqual(len(arrays.frames), 7)
+
+
+class TestPrioReplayBuffer(TestCase):
+    def test_priorities(self):
+        np.random.seed(123)
+        buf = replay.ArrayPrioReplayBuffer(None, 8, prob_alpha=1.0)
+        for idx in range(5):
+            buf.append(make_exp(idx))
+        buf.update_priorities(np.arange(5), [1.0, 1.0, 1.0, 1.0, 96.0])
+        batch, indices, weights = buf.sample(10, beta=1.0)
+        self.assertGreaterEqual((indices == 4).sum(), 9)
+        np.testing.assert_equal(batch.states.numpy()[:, 0, 0], indices)
+        # weights are normalized by the weight of the least probable sample
+        self.assertLessEqual(weights.max(), 1.0)
+        self.assertTrue(np.all(weights[indices == 4] < 1.0))
+
+
+class TestBatchPrefetcher(TestCase):
+    def test_prio_sample(self):
+        buf = replay.ArrayPrioReplayBuffer(None, 8)
+        for idx in range(8):
+            buf.append(make_exp(idx))
+        with replay.BatchPrefetcher(buf, 4, count=2, beta=0.4) as prefetcher:
+            for _ in range(5):
+                batch, indices, weights = prefetcher.sample(beta=1.0)
+                np.testing.assert_equal(batch.states.numpy()[:, 0, 0], indices)
+                prefetcher.update_priorities(indices, np.ones_like(weights))
+        self.assertIsNone(prefetcher.thread)
+
+    def test_error(self):
+        buf = replay.ArrayReplayBuffer(None, 8)
+        prefetcher = replay.BatchPrefetcher(buf, 4, collate=lambda b: 1 / 0)
+        buf.append(make_exp(0))
+        with self.assertRaises(ZeroDivisionError):
+            prefetcher.sample()
+        prefetcher.stop()
@@ -0,0 +1,94 @@
+"""
+Vectorized backtest of the model on one instrument, producing the same rewards as stepping StocksEnv
+with reset_on_close=False and reward_on_close=False bar by bar.
+
+Without position observation depends only on the bar, so, actions for all bars are obtained in large batches.
+With position, observation includes profit from the open price, so, after every Buy, observations of the
+following bars are built for this open price and evaluated in growing chunks until the first Close.
+"""
+import numpy as np
+
+import torch
+
+from lib import environ
+
+# max count of observations passed to the network at once
+CHUNK_SIZE = 4096
+# first chunk evaluated after the position is opened, doubled until the position is closed
+HOLD_CHUNK_SIZE = 16
+
+
+def _best_actions(net, obs, device, chunk_size):
+    res = []
+    with torch.no_grad():
+        for ofs in range(0, len(obs), chunk_size):
+            obs_v = torch.tensor(obs[ofs:ofs+chunk_size]).to(device)
+            res.append(net(obs_v).max(dim=1)[1].cpu().numpy())
+    return np.concatenate(res)
+
+
+def backtest(net, prices, bars_count, commission=environ.DEFAULT_COMMISSION_PERC, state_1d=False,
+             volumes=False, epsilon=0.0, device="cpu", chunk_size=CHUNK_SIZE):
+    """
+    Run the model over all the bars of prices
+    :param prices: relative prices of the instrument
+    :param epsilon: probability of random action on every bar
+    :return: array of rewards for every step
+    """
+    # episode starts at offset bars_count and ends when the last bar is reached
+    offsets = np.arange(bars_count, len(prices.close) - 1)
+    count = len(offsets)
+    if count == 0:
+        return np.zeros(0, dtype=np.float64)
+    state_class = environ.State1D if state_1d else environ.State
+    state = state_class(bars_count, commission, reset_on_close=False, reward_on_close=False, volumes=volumes)
+    windows = state._make_windows(prices)
+    closes = prices.open * (1.0 + prices.close)
+    rows = offsets - bars_count + 1
+
+    # random actions are drawn beforehand, so, they don't depend on evaluation order
+    random_mask = np.random.random(size=count) < epsilon
+    random_actions = np.random.randint(len(environ.Actions), size=count)
+
+    obs = state.encode_batch(windows[rows], np.zeros(count, dtype=bool), np.zeros(count))
+    actions = _best_actions(net, obs, device, chunk_size)
+    actions = np.where(random_mask, random_actions, actions)
+    buy_steps = np.flatnonzero(actions == environ.Actions.Buy.value)
+
+    rewards = np.zeros(count, dtype=np.float64)
+    holding = np.zeros(count, dtype=bool)
+    step = 0
+    while True:
+        # next Buy without position
+        idx = np.searchsorted(buy_steps, step)
+        if idx >= len(buy_steps):
+            break
+        step = buy_steps[idx]
+        rewards[step] -= commission
+        open_price = closes[offsets[step]]
+
+        # find the first Close after the Buy, position is held till the end if there is none
+        close_step = count
+        start, hold_chunk = step + 1, HOLD_CHUNK_SIZE
+        while start < count:
+            stop = min(start + hold_chunk, count)
+            profit = (closes[offsets[start:stop]] - open_price) / open_price
+            obs = state.encode_batch(windows[rows[start:stop]], np.ones(stop - start, dtype=bool), profit)
+            hold_actions = _best_actions(net, obs, device, chunk_size)
+            hold_actions = np.where(random_mask[start:stop], random_actions[start:stop], hold_actions)
+            closed = np.flatnonzero(hold_actions == environ.Actions.Close.value)
+            if len(closed):
+                close_step = start + closed[0]
+                break
+            start, hold_chunk = stop, min(hold_chunk * 2, chunk_size)
+
+        holding[step:close_step] = True
+        if close_step < count:
+            rewards[close_step] -= commission
+        step = close_step + 1
+
+    # price change of the bar is rewarded if position is held after the action
+    prev_close = closes[offsets]
+    change = 100.0 * (closes[offsets + 1] - prev_close) / prev_close
+    rewards[holding] += change[holding]
+    return rewards
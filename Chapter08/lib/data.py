@@ -1,12 +1,19 @@
 import os
 import csv
 import glob
+import json
 import numpy as np
 import collections
 
 
 Prices = collections.namedtuple('Prices', field_names=['open', 'high', 'low', 'close', 'volume'])
 
+# cache of relative prices is kept in this subdirectory of the data directory
+CACHE_DIR = ".prices_cache"
+# npy file of relative prices with json index of csv files appended
+CACHE_FILE = "cache.npy"
+CACHE_INDEX_LEN_BYTES = 8
+
 
 def read_csv(file_name, sep=',', filter_data=True, fix_open_price=False):
     print("Reading", file_name)
@@ -66,8 +73,115 @@ def prices_to_relative(prices):
     return Prices(open=prices.open, high=rh, low=rl, close=rc, volume=prices.volume)
 
 
-def load_relative(csv_file):
-    return prices_to_relative(read_csv(csv_file))
+def _read_cache(dir_name):
+    """
+    Open the cache of the directory
+    :return: tuple of (index, data), data is memory-mapped array of shape (5, bars) with Prices fields as rows,
+    index maps csv file name into dict with offset, count of bars, mtime and size of the file
+    """
+    path = os.path.join(dir_name, CACHE_DIR, CACHE_FILE)
+    try:
+        # index is stored after the array data, followed by its length
+        with open(path, "rb") as fd:
+            fd.seek(-CACHE_INDEX_LEN_BYTES, os.SEEK_END)
+            index_len = int.from_bytes(fd.read(CACHE_INDEX_LEN_BYTES), "little")
+            fd.seek(-CACHE_INDEX_LEN_BYTES - index_len, os.SEEK_END)
+            index = json.loads(fd.read(index_len).decode('utf-8'))
+        data = np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        return {}, None
+    return index, data
+
+
+def _file_stat(path):
+    st = os.stat(path)
+    return {"mtime": st.st_mtime, "size": st.st_size}
+
+
+def _write_cache(dir_name, prices_dict):
+    """
+    Write the cache of the directory from dict of csv file name -> relative Prices.
+    Index and data are kept in one file, replaced atomically, so, readers never see half-written or mismatched cache
+    """
+    cache_dir = os.path.join(dir_name, CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    names = sorted(prices_dict)
+    total = sum(len(prices_dict[name].open) for name in names)
+    data = np.empty((len(Prices._fields), total), dtype=np.float32)
+    index = {}
+    ofs = 0
+    for name in names:
+        prices = prices_dict[name]
+        count = len(prices.open)
+        data[:, ofs:ofs+count] = prices
+        index[name] = dict(offset=ofs, count=count, **_file_stat(os.path.join(dir_name, name)))
+        ofs += count
+    path = os.path.join(cache_dir, CACHE_FILE)
+    index_data = json.dumps(index).encode('utf-8')
+    with open(path + ".tmp", "wb") as fd:
+        np.save(fd, data)
+        fd.write(index_data)
+        fd.write(len(index_data).to_bytes(CACHE_INDEX_LEN_BYTES, "little"))
+    os.replace(path + ".tmp", path)
+
+
+def _is_stale(dir_name, name, index):
+    if name not in index:
+        return True
+    entry = index[name]
+    return _file_stat(os.path.join(dir_name, name)) != {"mtime": entry["mtime"], "size": entry.get("size")}
+
+
+def _load_dir_relative(dir_name, names):
+    """
+    Load relative prices of csv files from one directory using the cache, which is updated if some files
+    are missing in it or modified since they were cached
+    """
+    index, data = _read_cache(dir_name)
+    stale = [name for name in names if _is_stale(dir_name, name, index)]
+    if stale:
+        prices_dict = {}
+        for name, entry in index.items():
+            if name not in stale and os.path.exists(os.path.join(dir_name, name)):
+                ofs, count = entry["offset"], entry["count"]
+                prices_dict[name] = Prices(*np.array(data[:, ofs:ofs+count]))
+        for name in stale:
+            prices_dict[name] = prices_to_relative(read_csv(os.path.join(dir_name, name)))
+        try:
+            _write_cache(dir_name, prices_dict)
+        except OSError as e:
+            print("Prices cache in %s is not updated: %s" % (dir_name, e))
+            return {name: prices_dict[name] for name in names}
+        index, data = _read_cache(dir_name)
+    result = {}
+    for name in names:
+        ofs, count = index[name]["offset"], index[name]["count"]
+        result[name] = Prices(*data[:, ofs:ofs+count])
+    return result
+
+
+def load_relative_files(csv_files, use_cache=True):
+    """
+    Load relative prices of several csv files. With use_cache, parsed prices are kept in the columnar cache in the
+    directory of files, memory-mapped on the next load and refreshed when csv is modified.
+    :return: dict with csv file -> Prices
+    """
+    if not use_cache:
+        return {path: prices_to_relative(read_csv(path)) for path in csv_files}
+    by_dir = collections.defaultdict(list)
+    for path in csv_files:
+        by_dir[os.path.dirname(path)].append(path)
+    result = {}
+    for dir_name, paths in by_dir.items():
+        names = [os.path.basename(path) for path in paths]
+        loaded = _load_dir_relative(dir_name or ".", names)
+        for path, name in zip(paths, names):
+            result[path] = loaded[name]
+    return result
+
+
+def load_relative(csv_file, use_cache=True):
+    return load_relative_files([csv_file], use_cache=use_cache)[csv_file]
 
 
 def price_files(dir_name):
@@ -79,7 +193,4 @@ def price_files(dir_name):
 
 def load_year_data(year, basedir='data'):
     y = str(year)[-2:]
-    result = {}
-    for path in glob.glob(os.path.join(basedir, "*_%s*.csv" % y)):
-        result[path] = load_relative(path)
-    return result
+    return load_relative_files(glob.glob(os.path.join(basedir, "*_%s*.csv" % y)))
@@ -3,6 +3,7 @@ import gym.spaces
 from gym.utils import seeding
 import enum
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 from . import data
 
@@ -29,6 +30,8 @@ class State:
         self.reset_on_close = reset_on_close
         self.reward_on_close = reward_on_close
         self.volumes = volumes
+        # prices object -> (prices, windows), windows are built once per instrument
+        self._windows_cache = {}
 
     def reset(self, prices, offset):
         assert isinstance(prices, data.Prices)
@@ -37,6 +40,27 @@ class State:
         self.open_price = 0.0
         self._prices = prices
         self._offset = offset
+        cached = self._windows_cache.get(id(prices))
+        if cached is None or cached[0] is not prices:
+            cached = (prices, self._make_windows(prices))
+            self._windows_cache[id(prices)] = cached
+        self._windows = cached[1]
+
+    def _columns(self, prices):
+        if self.volumes:
+            return prices.high, prices.low, prices.close, prices.volume
+        return prices.high, prices.low, prices.close
+
+    def _make_windows(self, prices):
+        """
+        Build read-only view with observation prices for every offset: row i contains bars i..i+bars_count-1
+        with [h, l, c, v] of every bar in sequence
+        """
+        bars = np.ascontiguousarray(np.stack(self._columns(prices), axis=1), dtype=np.float32)
+        count, fields = bars.shape
+        item = bars.itemsize
+        return as_strided(bars, shape=(count - self.bars_count + 1, self.bars_count * fields),
+                          strides=(fields * item, item), writeable=False)
 
     @property
     def shape(self):
@@ -51,23 +75,26 @@ class State:
         Convert current state into numpy array.
         """
         res = np.ndarray(shape=self.shape, dtype=np.float32)
-        shift = 0
-        for bar_idx in range(-self.bars_count+1, 1):
-            res[shift] = self._prices.high[self._offset + bar_idx]
-            shift += 1
-            res[shift] = self._prices.low[self._offset + bar_idx]
-            shift += 1
-            res[shift] = self._prices.close[self._offset + bar_idx]
-            shift += 1
-            if self.volumes:
-                res[shift] = self._prices.volume[self._offset + bar_idx]
-                shift += 1
-        res[shift] = float(self.have_position)
-        shift += 1
+        res[:-2] = self._windows[self._offset - self.bars_count + 1]
+        res[-2] = float(self.have_position)
         if not self.have_position:
-            res[shift] = 0.0
+            res[-1] = 0.0
         else:
-            res[shift] = (self._cur_close() - self.open_price) / self.open_price
+            res[-1] = (self._cur_close() - self.open_price) / self.open_price
+        return res
+
+    def encode_batch(self, windows, have_position, profit):
+        """
+        Build observations for many states at once
+        :param windows: rows of windows view for the states
+        :param have_position: array of position flags
+        :param profit: array of relative profits, ignored without position
+        :return: array of shape (len(windows), ) + shape
+        """
+        res = np.zeros((len(windows), ) + self.shape, dtype=np.float32)
+        res[:, :-2] = windows
+        res[:, -2] = have_position
+        res[:, -1] = np.where(have_position, profit, 0.0)
         return res
 
     def _cur_close(self):
@@ -123,22 +150,35 @@ class State1D(State):
         else:
             return (5, self.bars_count)
 
+    def _make_windows(self, prices):
+        """
+        Build read-only view with observation prices for every offset: element i has the row of
+        bars i..i+bars_count-1 for every price column
+        """
+        columns = np.ascontiguousarray(np.stack(self._columns(prices)), dtype=np.float32)
+        fields, count = columns.shape
+        item = columns.itemsize
+        return as_strided(columns, shape=(count - self.bars_count + 1, fields, self.bars_count),
+                          strides=(item, count * item, item), writeable=False)
+
     def encode(self):
         res = np.zeros(shape=self.shape, dtype=np.float32)
-        ofs = self.bars_count-1
-        res[0] = self._prices.high[self._offset-ofs:self._offset+1]
-        res[1] = self._prices.low[self._offset-ofs:self._offset+1]
-        res[2] = self._prices.close[self._offset-ofs:self._offset+1]
-        if self.volumes:
-            res[3] = self._prices.volume[self._offset-ofs:self._offset+1]
-            dst = 4
-        else:
-            dst = 3
+        window = self._windows[self._offset - self.bars_count + 1]
+        dst = len(window)
+        res[:dst] = window
         if self.have_position:
             res[dst] = 1.0
             res[dst+1] = (self._cur_close() - self.open_price) / self.open_price
         return res
 
+    def encode_batch(self, windows, have_position, profit):
+        res = np.zeros((len(windows), ) + self.shape, dtype=np.float32)
+        dst = windows.shape[1]
+        res[:, :dst] = windows
+        res[:, dst] = np.asarray(have_position)[:, np.newaxis]
+        res[:, dst+1] = np.where(have_position, profit, 0.0)[:, np.newaxis]
+        return res
+
 
 class StocksEnv(gym.Env):
     metadata = {'render.modes': ['human']}
@@ -191,5 +231,130 @@ class StocksEnv(gym.Env):
 
     @classmethod
     def from_dir(cls, data_dir, **kwargs):
-        prices = {file: data.load_relative(file) for file in data.price_files(data_dir)}
+        prices = data.load_relative_files(data.price_files(data_dir))
         return StocksEnv(prices, **kwargs)
+
+
+class VectorStocksEnv:
+    """
+    Batch of independent StocksEnv episodes, stepped together with numpy operations. Prices of all instruments
+    are concatenated, so, the episode is described by global offset of the current bar, position flag and open
+    price. Finished episodes are reset automatically, observation returned for them is the first one of the new
+    episode.
+    """
+    def __init__(self, prices, batch_size, bars_count=DEFAULT_BARS_COUNT,
+                 commission=DEFAULT_COMMISSION_PERC, reset_on_close=True, state_1d=False,
+                 random_ofs_on_reset=True, reward_on_close=False, volumes=False):
+        assert isinstance(prices, dict)
+        self.batch_size = batch_size
+        self.bars_count = bars_count
+        self.commission_perc = commission
+        self.reset_on_close = reset_on_close
+        self.reward_on_close = reward_on_close
+        self.random_ofs_on_reset = random_ofs_on_reset
+        self.state_1d = state_1d
+        state_class = State1D if state_1d else State
+        self._state = state_class(bars_count, commission, reset_on_close, reward_on_close=reward_on_close,
+                                  volumes=volumes)
+        self.action_space = gym.spaces.Discrete(n=len(Actions))
+        self.observation_space = gym.spaces.Box(low=-np.inf, high=np.inf, shape=self._state.shape, dtype=np.float32)
+
+        self.instruments = list(prices.keys())
+        lens = np.array([len(prices[name].close) for name in self.instruments], dtype=np.int64)
+        if random_ofs_on_reset:
+            assert (lens > bars_count * 10).all(), "Instruments should have more than bars_count*10 bars"
+        self._lens = lens
+        self._starts = np.concatenate(([0], np.cumsum(lens)[:-1]))
+        all_prices = data.Prices(*[np.concatenate([prices[name][idx] for name in self.instruments])
+                                   for idx in range(len(data.Prices._fields))])
+        self._closes = all_prices.open * (1.0 + all_prices.close)
+        # windows over the concatenated prices, cross-instrument windows are never used
+        self._windows = self._state._make_windows(all_prices)
+
+        self._instrument = np.zeros(batch_size, dtype=np.int64)
+        self._offset = np.zeros(batch_size, dtype=np.int64)
+        self.have_position = np.zeros(batch_size, dtype=bool)
+        self.open_price = np.zeros(batch_size, dtype=np.float64)
+        self.seed()
+
+    def seed(self, seed=None):
+        self.np_random, seed1 = seeding.np_random(seed)
+        seed2 = seeding.hash_seed(seed1 + 1) % 2 ** 31
+        return [seed1, seed2]
+
+    def _reset_mask(self, mask):
+        count = int(mask.sum())
+        if not count:
+            return
+        instrument = self.np_random.choice(len(self.instruments), size=count)
+        bars = self.bars_count
+        if self.random_ofs_on_reset:
+            ofs = (self.np_random.uniform(size=count) * (self._lens[instrument] - bars*10)).astype(np.int64) + bars
+        else:
+            ofs = np.full(count, bars, dtype=np.int64)
+        self._instrument[mask] = instrument
+        self._offset[mask] = self._starts[instrument] + ofs
+        self.have_position[mask] = False
+        self.open_price[mask] = 0.0
+
+    def reset(self):
+        self._reset_mask(np.ones(self.batch_size, dtype=bool))
+        return self.encode()
+
+    def encode(self):
+        """
+        :return: observations of all episodes, array of shape (batch_size, ) + state shape
+        """
+        windows = self._windows[self._offset - self.bars_count + 1]
+        profit = np.zeros(self.batch_size, dtype=np.float64)
+        pos = self.have_position
+        profit[pos] = (self._closes[self._offset[pos]] - self.open_price[pos]) / self.open_price[pos]
+        return self._state.encode_batch(windows, pos, profit)
+
+    def cur_close(self):
+        """
+        :return: real close prices of the current bars of all episodes
+        """
+        return self._closes[self._offset]
+
+    def step(self, actions):
+        """
+        Perform actions in all the episodes
+        :param actions: array of action indices
+        :return: tuple of (observations, rewards, dones, info)
+        """
+        actions = np.asarray(actions)
+        reward = np.zeros(self.batch_size, dtype=np.float64)
+        close = self.cur_close()
+
+        buy = (actions == Actions.Buy.value) & ~self.have_position
+        self.have_position[buy] = True
+        self.open_price[buy] = close[buy]
+        reward[buy] -= self.commission_perc
+
+        sell = (actions == Actions.Close.value) & self.have_position
+        reward[sell] -= self.commission_perc
+        done = sell & self.reset_on_close
+        if self.reward_on_close:
+            reward[sell] += 100.0 * (close[sell] - self.open_price[sell]) / self.open_price[sell]
+        self.have_position[sell] = False
+        self.open_price[sell] = 0.0
+
+        self._offset += 1
+        prev_close = close
+        close = self._closes[self._offset]
+        local_offset = self._offset - self._starts[self._instrument]
+        done |= local_offset >= self._lens[self._instrument] - 1
+
+        if not self.reward_on_close:
+            pos = self.have_position
+            reward[pos] += 100.0 * (close[pos] - prev_close[pos]) / prev_close[pos]
+
+        info = {"instrument": self._instrument.copy(), "offset": local_offset}
+        self._reset_mask(done)
+        return self.encode(), reward, done, info
+
+    @classmethod
+    def from_dir(cls, data_dir, batch_size, **kwargs):
+        prices = data.load_relative_files(data.price_files(data_dir))
+        return VectorStocksEnv(prices, batch_size, **kwargs)
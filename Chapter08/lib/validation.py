@@ -4,8 +4,12 @@ import torch
 
 from lib import environ
 
+DEFAULT_EPISODES = 100
 
-def validation_run(env, net, episodes=100, device="cpu", epsilon=0.02, comission=0.1):
+
+def validation_run(env, net, episodes=DEFAULT_EPISODES, device="cpu", epsilon=0.02, comission=0.1):
+    if isinstance(env, environ.VectorStocksEnv):
+        return validation_run_vec(env, net, episodes=episodes, device=device, epsilon=epsilon, comission=comission)
     stats = {
         'episode_reward': [],
         'episode_steps': [],
@@ -60,3 +64,68 @@ def validation_run(env, net, episodes=100, device="cpu", epsilon=0.02, comission
         stats['episode_steps'].append(episode_steps)
 
     return { key: np.mean(vals) for key, vals in stats.items() }
+
+
+def _order_profit(close_price, position, comission):
+    profit = close_price - position - (close_price + position) * comission / 100
+    return 100.0 * profit / position
+
+
+def validation_run_vec(env, net, episodes=DEFAULT_EPISODES, device="cpu", epsilon=0.02, comission=0.1):
+    """
+    Run validation episodes in lockstep on VectorStocksEnv, batch_size episodes at a time, with one network
+    call per step. Statistics are the same as in validation_run.
+    """
+    stats = {
+        'episode_reward': [],
+        'episode_steps': [],
+        'order_profits': [],
+        'order_steps': [],
+    }
+    n_actions = env.action_space.n
+
+    while len(stats['episode_reward']) < episodes:
+        count = min(env.batch_size, episodes - len(stats['episode_reward']))
+        obs = env.reset()
+        active = np.zeros(env.batch_size, dtype=bool)
+        active[:count] = True
+        total_reward = np.zeros(env.batch_size, dtype=np.float64)
+        episode_steps = np.zeros(env.batch_size, dtype=np.int64)
+        # open price of the position or nan without position
+        position = np.full(env.batch_size, np.nan)
+        position_steps = np.zeros(env.batch_size, dtype=np.int64)
+
+        while active.any():
+            actions = np.full(env.batch_size, environ.Actions.Skip.value, dtype=np.int64)
+            with torch.no_grad():
+                out_v = net(torch.tensor(obs[active]).to(device))
+            actions[active] = out_v.max(dim=1)[1].cpu().numpy()
+            rand_mask = active & (np.random.random(size=env.batch_size) < epsilon)
+            actions[rand_mask] = np.random.randint(n_actions, size=rand_mask.sum())
+
+            close_price = env.cur_close()
+            have_pos = ~np.isnan(position)
+            buy = active & (actions == environ.Actions.Buy.value) & ~have_pos
+            position[buy] = close_price[buy]
+            position_steps[buy] = 0
+            close = active & (actions == environ.Actions.Close.value) & have_pos
+            stats['order_profits'].extend(_order_profit(close_price[close], position[close], comission))
+            stats['order_steps'].extend(position_steps[close])
+            position[close] = np.nan
+
+            obs, reward, done, _ = env.step(actions)
+            have_pos = ~np.isnan(position)
+            total_reward[active] += reward[active]
+            episode_steps[active] += 1
+            position_steps[active & have_pos] += 1
+
+            finished = active & done
+            left_open = finished & have_pos
+            stats['order_profits'].extend(_order_profit(close_price[left_open], position[left_open], comission))
+            stats['order_steps'].extend(position_steps[left_open])
+            stats['episode_reward'].extend(total_reward[finished])
+            stats['episode_steps'].extend(episode_steps[finished])
+            position[finished] = np.nan
+            active &= ~done
+
+    return { key: np.mean(vals) for key, vals in stats.items() }
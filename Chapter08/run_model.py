@@ -2,7 +2,7 @@
 import argparse
 import numpy as np
 
-from lib import environ, data, models
+from lib import environ, data, models, backtest
 
 import torch
 
@@ -22,6 +22,8 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--name", required=True, help="Name to use in output images")
     parser.add_argument("--commission", type=float, default=0.1, help="Commission size in percent, default=0.1")
     parser.add_argument("--conv", default=False, action="store_true", help="Use convolution model instead of FF")
+    parser.add_argument("--backtest", default=False, action="store_true",
+                        help="Evaluate all the bars in batches instead of stepping the environment")
     args = parser.parse_args()
 
     prices = data.load_relative(args.data)
@@ -34,29 +36,34 @@ if __name__ == "__main__":
 
     net.load_state_dict(torch.load(args.model, map_location=lambda storage, loc: storage))
 
-    obs = env.reset()
-    start_price = env._state._cur_close()
+    if args.backtest:
+        rewards = np.cumsum(backtest.backtest(net, prices, args.bars, commission=args.commission,
+                                              state_1d=args.conv, volumes=False, epsilon=EPSILON))
+        print("%d: reward=%.3f" % (len(rewards), rewards[-1] if len(rewards) else 0.0))
+    else:
+        obs = env.reset()
+        start_price = env._state._cur_close()
 
-    total_reward = 0.0
-    step_idx = 0
-    rewards = []
+        total_reward = 0.0
+        step_idx = 0
+        rewards = []
 
-    while True:
-        step_idx += 1
-        obs_v = torch.tensor([obs])
-        out_v = net(obs_v)
-        action_idx = out_v.max(dim=1)[1].item()
-        if np.random.random() < EPSILON:
-            action_idx = env.action_space.sample()
-        action = environ.Actions(action_idx)
+        while True:
+            step_idx += 1
+            obs_v = torch.tensor([obs])
+            out_v = net(obs_v)
+            action_idx = out_v.max(dim=1)[1].item()
+            if np.random.random() < EPSILON:
+                action_idx = env.action_space.sample()
+            action = environ.Actions(action_idx)
 
-        obs, reward, done, _ = env.step(action_idx)
-        total_reward += reward
-        rewards.append(total_reward)
-        if step_idx % 100 == 0:
-            print("%d: reward=%.3f" % (step_idx, total_reward))
-        if done:
-            break
+            obs, reward, done, _ = env.step(action_idx)
+            total_reward += reward
+            rewards.append(total_reward)
+            if step_idx % 100 == 0:
+                print("%d: reward=%.3f" % (step_idx, total_reward))
+            if done:
+                break
 
     plt.clf()
     plt.plot(rewards)
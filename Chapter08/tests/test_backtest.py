@@ -0,0 +1,49 @@
+import unittest
+import numpy as np
+import torch
+
+from lib import data, environ, backtest
+
+
+def take_profit_net(obs_v):
+    """
+    Buys without position and closes it when profit is above 5%
+    """
+    q = torch.zeros(obs_v.size(0), len(environ.Actions))
+    have_pos = obs_v[:, -2] > 0.5
+    q[~have_pos, environ.Actions.Buy.value] = 1.0
+    q[have_pos & (obs_v[:, -1] > 0.05), environ.Actions.Close.value] = 1.0
+    q[have_pos & (obs_v[:, -1] <= 0.05), environ.Actions.Skip.value] = 1.0
+    return q
+
+
+class TestBacktest(unittest.TestCase):
+    def test_same_as_env(self):
+        np.random.seed(1)
+        count = 200
+        p = data.Prices(open=np.random.uniform(1.0, 2.0, size=count).astype(np.float32),
+                        high=np.full(count, 2.0, dtype=np.float32),
+                        low=np.full(count, 0.5, dtype=np.float32),
+                        close=np.random.uniform(1.0, 2.0, size=count).astype(np.float32),
+                        volume=np.ones(count, dtype=np.float32))
+        prices = data.prices_to_relative(p)
+        env = environ.StocksEnv({"TST": prices}, bars_count=3, reset_on_close=False,
+                                random_ofs_on_reset=False, reward_on_close=False)
+        obs = env.reset()
+        ref = []
+        while True:
+            action = take_profit_net(torch.tensor([obs])).max(dim=1)[1].item()
+            obs, reward, done, _ = env.step(action)
+            ref.append(reward)
+            if done:
+                break
+        # small chunks check evaluation across chunk boundaries
+        for chunk_size in (2, backtest.CHUNK_SIZE):
+            res = backtest.backtest(take_profit_net, prices, 3, commission=environ.DEFAULT_COMMISSION_PERC,
+                                    chunk_size=chunk_size)
+            np.testing.assert_allclose(res, ref, rtol=1e-4, atol=1e-4)
+
+    def test_short_prices(self):
+        p = data.Prices(*[np.ones(3, dtype=np.float32) for _ in data.Prices._fields])
+        rewards = backtest.backtest(take_profit_net, data.prices_to_relative(p), bars_count=3)
+        self.assertEqual(len(rewards), 0)
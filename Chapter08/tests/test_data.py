@@ -1,7 +1,19 @@
+import os
+import time
+import tempfile
 from unittest import TestCase
 import numpy as np
 from lib import data
 
+CSV_HEADER = "<DATE>,<TIME>,<OPEN>,<HIGH>,<LOW>,<CLOSE>,<VOL>\n"
+
+
+def write_csv(path, rows):
+    with open(path, "wt", encoding='utf-8') as fd:
+        fd.write(CSV_HEADER)
+        for idx, (o, h, l, c, v) in enumerate(rows):
+            fd.write("20160101,%06d,%f,%f,%f,%f,%d\n" % (100000 + idx * 100, o, h, l, c, v))
+
 
 class TestMisc(TestCase):
     def test_read_csv(self):
@@ -25,3 +37,45 @@ class TestMisc(TestCase):
         files = data.price_files("data")
         self.assertTrue(len(files) > 0)
 
+
+class TestCache(TestCase):
+    def test_load_relative(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path_a = os.path.join(tmp, "A_160101_161231.csv")
+            path_b = os.path.join(tmp, "B_160101_161231.csv")
+            write_csv(path_a, [(1.0, 3.0, 0.5, 2.0, 10), (2.0, 4.0, 1.0, 3.0, 20)])
+            write_csv(path_b, [(10.0, 12.0, 5.0, 11.0, 1)])
+
+            res = data.load_relative_files([path_a, path_b])
+            self.assertEqual(os.listdir(os.path.join(tmp, data.CACHE_DIR)), [data.CACHE_FILE])
+            for path in (path_a, path_b):
+                ref = data.load_relative(path, use_cache=False)
+                for val, ref_val in zip(res[path], ref):
+                    np.testing.assert_equal(np.asarray(val), ref_val)
+
+            # second load comes from the memory-mapped cache
+            cached = data.load_relative(path_a)
+            self.assertIsInstance(cached.open, np.memmap)
+            np.testing.assert_equal(np.asarray(cached.close), np.array([1.0, 0.5], dtype=np.float32))
+
+            # modified csv is parsed again, other entries are kept
+            time.sleep(0.01)
+            write_csv(path_a, [(4.0, 8.0, 2.0, 6.0, 1)])
+            os.utime(path_a, (time.time() + 10, time.time() + 10))
+            cached = data.load_relative(path_a)
+            np.testing.assert_equal(np.asarray(cached.high), np.array([1.0], dtype=np.float32))
+            cached = data.load_relative(path_b)
+            np.testing.assert_equal(np.asarray(cached.open), np.array([10.0], dtype=np.float32))
+
+            # csv restored with older mtime is detected too
+            write_csv(path_a, [(1.0, 3.0, 0.5, 2.0, 10), (2.0, 4.0, 1.0, 3.0, 20)])
+            os.utime(path_a, (time.time() - 1000, time.time() - 1000))
+            cached = data.load_relative(path_a)
+            np.testing.assert_equal(np.asarray(cached.close), np.array([1.0, 0.5], dtype=np.float32))
+
+            # as well as changed size with the same mtime
+            mtime = os.path.getmtime(path_a)
+            write_csv(path_a, [(4.0, 8.0, 2.0, 6.0, 1)])
+            os.utime(path_a, (mtime, mtime))
+            cached = data.load_relative(path_a)
+            np.testing.assert_equal(np.asarray(cached.high), np.array([1.0], dtype=np.float32))
@@ -102,3 +102,101 @@ class TestStates(unittest.TestCase):
         self.assertTrue(done)
         self.assertAlmostEqual(r, -50.0)
         self.assertAlmostEqual(s._cur_close(), 2.0)
+
+    def test_encode_windows(self):
+        prices = self.prices['TST']
+        for volumes in (False, True):
+            s = environ.State(bars_count=2, commission_perc=0.0, reset_on_close=False, volumes=volumes)
+            s1d = environ.State1D(bars_count=2, commission_perc=0.0, reset_on_close=False, volumes=volumes)
+            columns = [prices.high, prices.low, prices.close]
+            if volumes:
+                columns.append(prices.volume)
+            for offset in (1, 2, 3):
+                s.reset(prices, offset)
+                s1d.reset(prices, offset)
+                expected = np.array([col[offset-1:offset+1] for col in columns], dtype=np.float32)
+                d = s.encode()
+                np.testing.assert_equal(d[:-2], expected.T.ravel())
+                np.testing.assert_equal(d[-2:], [0.0, 0.0])
+                d = s1d.encode()
+                np.testing.assert_equal(d[:len(columns)], expected)
+                np.testing.assert_equal(d[len(columns):], 0.0)
+
+
+class TestVectorEnv(unittest.TestCase):
+    def test_same_as_state(self):
+        p = data.Prices(open=np.array([1.0, 2.0, 3.0, 1.0, 2.0, 4.0], dtype=np.float32),
+                        high=np.array([2.0, 3.0, 4.0, 2.0, 3.0, 5.0], dtype=np.float32),
+                        low=np.array([0.0, 1.0, 2.0, 0.0, 1.0, 3.0], dtype=np.float32),
+                        close=np.array([2.0, 3.0, 1.0, 2.0, 3.0, 4.0], dtype=np.float32),
+                        volume=np.array([10.0, 10.0, 10.0, 10.0, 10.0, 10.0], dtype=np.float32))
+        prices = data.prices_to_relative(p)
+        actions = np.array([[1, 0, 2, 0], [0, 1, 0, 0], [2, 1, 1, 2]])
+        for reward_on_close in (False, True):
+            for state_1d in (False, True):
+                env = environ.VectorStocksEnv({"TST": prices}, batch_size=len(actions), bars_count=2,
+                                              commission=0.1, reset_on_close=True, state_1d=state_1d,
+                                              random_ofs_on_reset=False, reward_on_close=reward_on_close)
+                state_class = environ.State1D if state_1d else environ.State
+                states = [state_class(2, 0.1, True, reward_on_close=reward_on_close, volumes=False)
+                          for _ in actions]
+                for s in states:
+                    s.reset(prices, 2)
+                obs = env.reset()
+                for step_idx in range(actions.shape[1]):
+                    for s, o in zip(states, obs):
+                        np.testing.assert_allclose(o, s.encode(), rtol=1e-6)
+                    obs, rewards, dones, _ = env.step(actions[:, step_idx])
+                    for idx, s in enumerate(states):
+                        r, done = s.step(environ.Actions(actions[idx, step_idx]))
+                        self.assertAlmostEqual(rewards[idx], r, places=4)
+                        self.assertEqual(dones[idx], done)
+                        if done:
+                            s.reset(prices, 2)
+
+    def test_two_instruments(self):
+        # episodes run till the last bar of the instrument, so, both boundaries of concatenated prices are crossed
+        prices = {
+            "A": data.prices_to_relative(data.Prices(
+                open=np.array([1.0, 2.0, 3.0, 1.0, 2.0, 4.0], dtype=np.float32),
+                high=np.array([2.0, 3.0, 4.0, 2.0, 3.0, 5.0], dtype=np.float32),
+                low=np.array([0.0, 1.0, 2.0, 0.0, 1.0, 3.0], dtype=np.float32),
+                close=np.array([2.0, 3.0, 1.0, 2.0, 3.0, 4.0], dtype=np.float32),
+                volume=np.array([10.0, 10.0, 10.0, 10.0, 10.0, 10.0], dtype=np.float32))),
+            "B": data.prices_to_relative(data.Prices(
+                open=np.array([10.0, 20.0, 30.0, 40.0, 50.0], dtype=np.float32),
+                high=np.array([30.0, 40.0, 50.0, 60.0, 70.0], dtype=np.float32),
+                low=np.array([5.0, 10.0, 15.0, 20.0, 25.0], dtype=np.float32),
+                close=np.array([20.0, 10.0, 40.0, 30.0, 60.0], dtype=np.float32),
+                volume=np.array([1.0, 2.0, 3.0, 4.0, 5.0], dtype=np.float32))),
+        }
+        batch_size = 8
+        env = environ.VectorStocksEnv(prices, batch_size=batch_size, bars_count=2, commission=0.1,
+                                      reset_on_close=False, random_ofs_on_reset=False, volumes=True)
+        env.seed(0)
+        np.random.seed(0)
+        states = [environ.State(2, 0.1, False, reward_on_close=False, volumes=True)
+                  for _ in range(batch_size)]
+        obs = env.reset()
+        for s, instrument in zip(states, env._instrument):
+            s.reset(prices[env.instruments[instrument]], 2)
+        used = set(env._instrument.tolist())
+        for _ in range(20):
+            for s, o in zip(states, obs):
+                np.testing.assert_allclose(o, s.encode(), rtol=1e-6)
+            actions = np.random.randint(len(environ.Actions), size=batch_size)
+            obs, rewards, dones, _ = env.step(actions)
+            for idx, s in enumerate(states):
+                r, done = s.step(environ.Actions(actions[idx]))
+                self.assertAlmostEqual(rewards[idx], r, places=4)
+                self.assertEqual(dones[idx], done)
+                if done:
+                    s.reset(prices[env.instruments[env._instrument[idx]]], 2)
+            used.update(env._instrument.tolist())
+        self.assertEqual(used, {0, 1})
+
+    def test_short_instrument(self):
+        p = data.Prices(*[np.ones(15, dtype=np.float32) for _ in data.Prices._fields])
+        with self.assertRaises(AssertionError):
+            environ.VectorStocksEnv({"TST": p}, batch_size=1, bars_count=2)
+        environ.VectorStocksEnv({"TST": p}, batch_size=1, bars_count=2, random_ofs_on_reset=False)
@@ -0,0 +1,36 @@
+import unittest
+import numpy as np
+import torch
+
+from lib import data, environ, validation
+
+
+def buy_and_hold_net(obs_v):
+    """
+    Buys without position and closes it in three bars, when profit is above 10%
+    """
+    q = torch.zeros(obs_v.size(0), len(environ.Actions))
+    have_pos = obs_v[:, -2] > 0.5
+    q[~have_pos, environ.Actions.Buy.value] = 1.0
+    q[have_pos & (obs_v[:, -1] > 0.1), environ.Actions.Close.value] = 1.0
+    q[have_pos & (obs_v[:, -1] <= 0.1), environ.Actions.Skip.value] = 1.0
+    return q
+
+
+class TestValidation(unittest.TestCase):
+    def test_vec_same_as_sequential(self):
+        np.random.seed(1)
+        count = 50
+        p = data.Prices(open=np.random.uniform(1.0, 2.0, size=count).astype(np.float32),
+                        high=np.full(count, 2.0, dtype=np.float32),
+                        low=np.full(count, 0.5, dtype=np.float32),
+                        close=np.random.uniform(1.0, 2.0, size=count).astype(np.float32),
+                        volume=np.ones(count, dtype=np.float32))
+        prices = {"TST": data.prices_to_relative(p)}
+        env = environ.StocksEnv(prices, bars_count=2, random_ofs_on_reset=False)
+        vec_env = environ.VectorStocksEnv(prices, 4, bars_count=2, random_ofs_on_reset=False)
+        res = validation.validation_run(env, buy_and_hold_net, episodes=10, epsilon=0.0)
+        res_vec = validation.validation_run(vec_env, buy_and_hold_net, episodes=10, epsilon=0.0)
+        self.assertEqual(set(res.keys()), set(res_vec.keys()))
+        for key, val in res.items():
+            self.assertAlmostEqual(val, res_vec[key], places=4)
@@ -57,16 +57,19 @@ if __name__ == "__main__":
         else:
             stock_data = {"YNDX": data.load_relative(args.data)}
         env = environ.StocksEnv(stock_data, bars_count=BARS_COUNT, reset_on_close=True, state_1d=True, volumes=False)
-        env_tst = environ.StocksEnv(stock_data, bars_count=BARS_COUNT, reset_on_close=True, state_1d=True)
+        env_tst = environ.VectorStocksEnv(stock_data, validation.DEFAULT_EPISODES, bars_count=BARS_COUNT,
+                                          reset_on_close=True, state_1d=True)
     elif os.path.isdir(args.data):
         env = environ.StocksEnv.from_dir(args.data, bars_count=BARS_COUNT, reset_on_close=True, state_1d=True)
-        env_tst = environ.StocksEnv.from_dir(args.data, bars_count=BARS_COUNT, reset_on_close=True, state_1d=True)
+        env_tst = environ.VectorStocksEnv.from_dir(args.data, validation.DEFAULT_EPISODES, bars_count=BARS_COUNT,
+                                                   reset_on_close=True, state_1d=True)
     else:
         raise RuntimeError("No data to train on")
     env = gym.wrappers.TimeLimit(env, max_episode_steps=1000)
 
     val_data = {"YNDX": data.load_relative(args.valdata)}
-    env_val = environ.StocksEnv(val_data, bars_count=BARS_COUNT, reset_on_close=True, state_1d=True)
+    env_val = environ.VectorStocksEnv(val_data, validation.DEFAULT_EPISODES, bars_count=BARS_COUNT,
+                                      reset_on_close=True, state_1d=True)
 
     writer = SummaryWriter(comment="-conv-" + args.run)
     net = models.DQNConv1D(env.observation_space.shape, env.action_space.n).to(device)
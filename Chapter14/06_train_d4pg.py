@@ -50,41 +50,28 @@ def test_net(net, env, count=10, device="cpu"):
 
 
 def distr_projection(next_distr_v, rewards_v, dones_mask_t, gamma, device="cpu"):
-    next_distr = next_distr_v.data.cpu().numpy()
-    rewards = rewards_v.data.cpu().numpy()
-    dones_mask = dones_mask_t.cpu().numpy().astype(np.bool)
-    batch_size = len(rewards)
-    proj_distr = np.zeros((batch_size, N_ATOMS), dtype=np.float32)
-
-    for atom in range(N_ATOMS):
-        tz_j = np.minimum(Vmax, np.maximum(Vmin, rewards + (Vmin + atom * DELTA_Z) * gamma))
-        b_j = (tz_j - Vmin) / DELTA_Z
-        l = np.floor(b_j).astype(np.int64)
-        u = np.ceil(b_j).astype(np.int64)
-        eq_mask = u == l
-        proj_distr[eq_mask, l[eq_mask]] += next_distr[eq_mask, atom]
-        ne_mask = u != l
-        proj_distr[ne_mask, l[ne_mask]] += next_distr[ne_mask, atom] * (u - b_j)[ne_mask]
-        proj_distr[ne_mask, u[ne_mask]] += next_distr[ne_mask, atom] * (b_j - l)[ne_mask]
-
-    if dones_mask.any():
-        proj_distr[dones_mask] = 0.0
-        tz_j = np.minimum(Vmax, np.maximum(Vmin, rewards[dones_mask]))
-        b_j = (tz_j - Vmin) / DELTA_Z
-        l = np.floor(b_j).astype(np.int64)
-        u = np.ceil(b_j).astype(np.int64)
-        eq_mask = u == l
-        eq_dones = dones_mask.copy()
-        eq_dones[dones_mask] = eq_mask
-        if eq_dones.any():
-            proj_distr[eq_dones, l[eq_mask]] = 1.0
-        ne_mask = u != l
-        ne_dones = dones_mask.copy()
-        ne_dones[dones_mask] = ne_mask
-        if ne_dones.any():
-            proj_distr[ne_dones, l[ne_mask]] = (u - b_j)[ne_mask]
-            proj_distr[ne_dones, u[ne_mask]] = (b_j - l)[ne_mask]
-    return torch.FloatTensor(proj_distr).to(device)
+    """
+    Categorical projection of the whole batch at once, stays on the device of arguments
+    """
+    batch_size = rewards_v.size(0)
+    done_v = dones_mask_t.float().unsqueeze(-1).to(device)
+    next_distr_v = next_distr_v.detach() * (1.0 - done_v)
+    next_distr_v[:, 0] += done_v.squeeze(-1)
+
+    atoms_v = Vmin + torch.arange(N_ATOMS, dtype=torch.float32, device=device) * DELTA_Z
+    tz_v = rewards_v.float().unsqueeze(-1) + gamma * (1.0 - done_v) * atoms_v.unsqueeze(0)
+    b_v = (tz_v.clamp(Vmin, Vmax) - Vmin) / DELTA_Z
+    l_v = b_v.floor()
+    u_v = b_v.ceil()
+    # when b_v hits the atom exactly, all the probability goes to it
+    l_share_v = u_v - b_v + (u_v == l_v).float()
+    u_share_v = b_v - l_v
+
+    offsets_v = torch.arange(batch_size, device=device).unsqueeze(-1) * N_ATOMS
+    proj_distr_v = torch.zeros(batch_size * N_ATOMS, dtype=torch.float32, device=device)
+    proj_distr_v.index_add_(0, (l_v.long() + offsets_v).view(-1), (next_distr_v * l_share_v).view(-1))
+    proj_distr_v.index_add_(0, (u_v.long() + offsets_v).view(-1), (next_distr_v * u_share_v).view(-1))
+    return proj_distr_v.view(batch_size, N_ATOMS)
 
 
 if __name__ == "__main__":
@@ -116,22 +103,22 @@ if __name__ == "__main__":
 
     frame_idx = 0
     best_reward = None
-    with ptan.common.utils.RewardTracker(writer) as tracker:
+    prefetcher = common.BatchPrefetcher(buffer, BATCH_SIZE, collate=lambda b: common.unpack_batch_ddqn(b, device))
+    with ptan.common.utils.RewardTracker(writer) as tracker, prefetcher:
         with ptan.common.utils.TBMeanTracker(writer, batch_size=10) as tb_tracker:
             while True:
                 frame_idx += 1
-                buffer.populate(1)
+                prefetcher.populate(1)
                 rewards_steps = exp_source.pop_rewards_steps()
                 if rewards_steps:
                     rewards, steps = zip(*rewards_steps)
                     tb_tracker.track("episode_steps", steps[0], frame_idx)
                     tracker.reward(rewards[0], frame_idx)
 
-                if len(buffer) < REPLAY_INITIAL:
+                if len(prefetcher) < REPLAY_INITIAL:
                     continue
 
-                batch = buffer.sample(BATCH_SIZE)
-                states_v, actions_v, rewards_v, dones_mask, last_states_v = common.unpack_batch_ddqn(batch, device)
+                states_v, actions_v, rewards_v, dones_mask, last_states_v = prefetcher.sample()
 
                 # train critic
                 crt_opt.zero_grad()
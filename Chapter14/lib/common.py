@@ -1,3 +1,5 @@
+import queue
+import threading
 import numpy as np
 import torch
 from torch.autograd import Variable
@@ -56,3 +58,69 @@ def unpack_batch_ddqn(batch, device="cpu"):
     last_states_v = ptan.agent.float32_preprocessor(last_states).to(device)
     dones_t = torch.ByteTensor(dones).to(device)
     return states_v, actions_v, rewards_v, dones_t, last_states_v
+
+
+class BatchPrefetcher:
+    """
+    Reduced version of Chapter07's BatchPrefetcher for the uniform replay buffer: batches are sampled and collated
+    into tensors in the background thread, up to count of them are kept ready. Buffer has to be populated only
+    through the prefetcher, which serializes access with the lock. Only picking of samples is done under the lock,
+    conversion to tensors is not.
+    """
+    def __init__(self, buffer, batch_size, count=2, collate=None):
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.collate = collate
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=count)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def populate(self, count):
+        with self.lock:
+            self.buffer.populate(count)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                with self.lock:
+                    res = self.buffer.sample(self.batch_size)
+                if self.collate is not None:
+                    res = self.collate(res)
+            except Exception as e:
+                res = e
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(res, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(res, Exception):
+                break
+
+    def sample(self):
+        """
+        Return the next ready batch, background sampling is started on the first call
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        res = self.queue.get()
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
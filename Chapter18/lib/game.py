@@ -118,50 +118,54 @@ def decode_binary(state_int):
     return res
 
 
+# positions of column bits and free counters in the state_int
+FIELD_SHIFTS = [(GAME_COLS - col - 1) * GAME_ROWS + GAME_COLS * BITS_IN_LEN for col in range(GAME_COLS)]
+LEN_SHIFTS = [(GAME_COLS - col - 1) * BITS_IN_LEN for col in range(GAME_COLS)]
+_COL_MASK = (1 << GAME_ROWS) - 1
+LEN_MASK = (1 << BITS_IN_LEN) - 1
+
+
 def possible_moves(state_int):
     """
-    This function could be calculated directly from bits, but I'm too lazy
+    List columns which are not full yet, calculated directly from the free counters
     :param state_int: field representation
     :return: the list of columns which we can make a move
     """
     assert isinstance(state_int, int)
-    field = decode_binary(state_int)
-    return [idx for idx, col in enumerate(field) if len(col) < GAME_ROWS]
+    return [col for col, shift in enumerate(LEN_SHIFTS) if (state_int >> shift) & LEN_MASK]
+
 
+# directions of lines through the cell, every line is also walked in the opposite direction
+_LINE_DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
 
-def _check_won(field, col, delta_row):
+
+def _cell_player(state_int, col, row):
     """
-    Check for horisontal/diagonal win condition for the last player moved in the column
-    :param field: list of lists
-    :param col: column index
-    :param delta_row: if 0, checks for horisonal won, 1 for rising diagonal, -1 for falling
-    :return: True if won, False if not
+    Get the piece at the cell
+    :return: player index or None if the cell is empty or outside of the field
     """
-    player = field[col][-1]
-    coord = len(field[col])-1
-    total = 1
-    # negative dir
-    cur_coord = coord - delta_row
-    for c in range(col-1, -1, -1):
-        if len(field[c]) <= cur_coord or cur_coord < 0 or cur_coord >= GAME_ROWS:
-            break
-        if field[c][cur_coord] != player:
-            break
-        total += 1
-        if total == COUNT_TO_WIN:
-            return True
-        cur_coord -= delta_row
-    # positive dir
-    cur_coord = coord + delta_row
-    for c in range(col+1, GAME_COLS):
-        if len(field[c]) <= cur_coord or cur_coord < 0 or cur_coord >= GAME_ROWS:
-            break
-        if field[c][cur_coord] != player:
-            break
-        total += 1
-        if total == COUNT_TO_WIN:
+    if not (0 <= col < GAME_COLS and 0 <= row < GAME_ROWS):
+        return None
+    if row >= GAME_ROWS - ((state_int >> LEN_SHIFTS[col]) & LEN_MASK):
+        return None
+    return (state_int >> (FIELD_SHIFTS[col] + GAME_ROWS - 1 - row)) & 1
+
+
+def _won_through(state_int, col, row, player):
+    """
+    Check lines passing through the cell for COUNT_TO_WIN pieces of the player, at most
+    (COUNT_TO_WIN-1) cells are checked in every direction
+    """
+    for d_col, d_row in _LINE_DIRECTIONS:
+        count = 1
+        for sign in (1, -1):
+            c, r = col + sign * d_col, row + sign * d_row
+            while count < COUNT_TO_WIN and _cell_player(state_int, c, r) == player:
+                count += 1
+                c += sign * d_col
+                r += sign * d_row
+        if count >= COUNT_TO_WIN:
             return True
-        cur_coord += delta_row
     return False
 
 
@@ -178,18 +182,30 @@ def move(state_int, col, player):
     assert isinstance(col, int)
     assert 0 <= col < GAME_COLS
     assert player == PLAYER_BLACK or player == PLAYER_WHITE
-    field = decode_binary(state_int)
-    assert len(field[col]) < GAME_ROWS
-    field[col].append(player)
-    # check for victory: the simplest vertical case
-    suff = field[col][-COUNT_TO_WIN:]
-    won = suff == [player] * COUNT_TO_WIN
-    if not won:
-        won = _check_won(field, col, 0) or _check_won(field, col, 1) or _check_won(field, col, -1)
-    state_new = encode_lists(field)
+    free = (state_int >> LEN_SHIFTS[col]) & LEN_MASK
+    assert free > 0
+    # piece's bit is zero for the white player, so, only free counter needs to be decremented
+    state_new = state_int - (1 << LEN_SHIFTS[col])
+    if player == PLAYER_BLACK:
+        state_new |= 1 << (FIELD_SHIFTS[col] + free - 1)
+    won = _won_through(state_new, col, GAME_ROWS - free, player)
     return state_new, won
 
 
+def mirror(state_int):
+    """
+    Mirror the field left to right. As the game is symmetric, mirrored state has the same value and mirrored policy
+    :param state_int: field representation
+    :return: state_int of the mirrored field
+    """
+    res = 0
+    for col in range(GAME_COLS):
+        m_col = GAME_COLS - col - 1
+        res |= ((state_int >> FIELD_SHIFTS[col]) & _COL_MASK) << FIELD_SHIFTS[m_col]
+        res |= ((state_int >> LEN_SHIFTS[col]) & LEN_MASK) << LEN_SHIFTS[m_col]
+    return res
+
+
 def render(state_int):
     state_list = decode_binary(state_int)
     data = [[' '] * GAME_COLS for _ in range(GAME_ROWS)]
@@ -0,0 +1,264 @@
+"""
+Batched evaluation of game states by the network, shared by many concurrent searches
+"""
+import time
+import queue
+import threading
+import collections
+
+import numpy as np
+
+from lib import game, model
+
+
+class Evaluator:
+    """
+    Base class for objects which could be used by MCTS instead of the network
+    """
+    def evaluate(self, state_ints, who_moves):
+        """
+        Evaluate game states
+        :param state_ints: list of states
+        :param who_moves: list of players to move in those states
+        :return: tuple of numpy arrays (probs, values)
+        """
+        raise NotImplementedError
+
+
+class InferenceClient(Evaluator):
+    """
+    Sends states to the InferenceServer and waits for the results. Could be passed to another process if server was
+    created with multiprocessing context
+    """
+    def __init__(self, client_id, request_queue, reply_queue):
+        self.client_id = client_id
+        self.request_queue = request_queue
+        self.reply_queue = reply_queue
+
+    def evaluate(self, state_ints, who_moves):
+        self.request_queue.put((self.client_id, list(state_ints), list(who_moves)))
+        reply = self.reply_queue.get()
+        # server sends the exception if evaluation of the batch failed
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+class InferenceServer:
+    """
+    Evaluates states sent by clients with the single network. Requests are coalesced into large batches: after the
+    first request, server waits for more until max_batch states are collected or max_latency seconds passed.
+    """
+    def __init__(self, net, device="cpu", max_batch=256, max_latency=0.005, mp_context=None, lock=None):
+        """
+        :param net: network to evaluate states
+        :param max_batch: limit of states in one batch
+        :param max_latency: time in seconds to wait for more requests
+        :param mp_context: if not None, multiprocessing context (or module) to create queues usable by clients in
+        other processes. Otherwise, server is usable only by threads of this process
+        :param lock: if given, held during forward passes, so, the owner could update weights of the net under it
+        """
+        self.net = net
+        self.device = device
+        self.lock = lock
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._queue_factory = queue.Queue if mp_context is None else mp_context.Queue
+        self.request_queue = self._queue_factory()
+        # client id -> reply queue
+        self._reply_queues = {}
+        self._next_client_id = 0
+        self._thread = None
+        # statistics: count of forward passes and evaluated states
+        self.batches = 0
+        self.states = 0
+
+    def client(self):
+        """
+        Create new client. Client is supposed to be used by one search at a time
+        """
+        reply_queue = self._queue_factory()
+        client_id = self._next_client_id
+        self._next_client_id += 1
+        self._reply_queues[client_id] = reply_queue
+        return InferenceClient(client_id, self.request_queue, reply_queue)
+
+    def release(self, client):
+        """
+        Forget the client which won't be used anymore. Client must not have the request in progress
+        """
+        self._reply_queues.pop(client.client_id, None)
+
+    def _collect(self):
+        """
+        Wait for requests to process
+        :return: list of requests or None if the server was stopped
+        """
+        request = self.request_queue.get()
+        if request is None:
+            return None
+        requests = [request]
+        count = len(request[1])
+        deadline = time.time() + self.max_latency
+        while count < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.request_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # process already collected requests and stop on the next call
+                self.request_queue.put(None)
+                break
+            requests.append(request)
+            count += len(request[1])
+        return requests
+
+    def _reply(self, client_id, reply):
+        reply_queue = self._reply_queues.get(client_id)
+        # released client doesn't wait for the reply anymore
+        if reply_queue is not None:
+            reply_queue.put(reply)
+
+    def serve(self):
+        """
+        Process requests until stop() is called
+        """
+        while True:
+            requests = self._collect()
+            if requests is None:
+                break
+            state_ints, who_moves = [], []
+            for _, req_states, req_players in requests:
+                state_ints.extend(req_states)
+                who_moves.extend(req_players)
+            try:
+                if self.lock is None:
+                    probs, values = model.evaluate_states(self.net, state_ints, who_moves, self.device)
+                else:
+                    with self.lock:
+                        probs, values = model.evaluate_states(self.net, state_ints, who_moves, self.device)
+            except Exception as e:
+                # waiting clients get the error instead of the result, server continues with the next batch
+                for client_id, _, _ in requests:
+                    self._reply(client_id, e)
+                continue
+            self.batches += 1
+            self.states += len(state_ints)
+            ofs = 0
+            for client_id, req_states, _ in requests:
+                size = len(req_states)
+                self._reply(client_id, (probs[ofs:ofs+size], values[ofs:ofs+size]))
+                ofs += size
+
+    def start(self):
+        """
+        Start serving requests in the background thread
+        """
+        assert self._thread is None
+        self._thread = threading.Thread(target=self.serve, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.request_queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class EvalCache:
+    """
+    Bounded LRU cache of network evaluations, keyed by state and player to move. State and its mirror share the same
+    entry. Entries are valid only for the model version they were calculated with.
+    """
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.version = None
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def set_version(self, version):
+        """
+        Set version of the model, all entries are dropped if it differs from the current one
+        """
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    @staticmethod
+    def _key(state_int, who_move):
+        """
+        :return: tuple of (key, mirrored) where mirrored is True if the key corresponds to the mirrored state
+        """
+        mirror_state = game.mirror(state_int)
+        if mirror_state < state_int:
+            return (mirror_state, who_move), True
+        return (state_int, who_move), False
+
+    def get(self, state_int, who_move):
+        """
+        :return: tuple (probs, value) or None if state is not in the cache
+        """
+        key, mirrored = self._key(state_int, who_move)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+        probs, value = entry
+        return (probs[::-1] if mirrored else probs), value
+
+    def put(self, state_int, who_move, probs, value):
+        key, mirrored = self._key(state_int, who_move)
+        probs = np.array(probs[::-1] if mirrored else probs, dtype=np.float32)
+        with self._lock:
+            self._data[key] = (probs, float(value))
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+
+class CachedEvaluator(Evaluator):
+    """
+    Evaluates states with the network (or another evaluator) through the EvalCache
+    """
+    def __init__(self, net, cache, device="cpu"):
+        self.net = net
+        self.cache = cache
+        self.device = device
+
+    def evaluate(self, state_ints, who_moves):
+        probs = np.zeros((len(state_ints), game.GAME_COLS), dtype=np.float32)
+        values = np.zeros(len(state_ints), dtype=np.float32)
+        missed = []
+        for idx, (state_int, who_move) in enumerate(zip(state_ints, who_moves)):
+            entry = self.cache.get(state_int, who_move)
+            if entry is None:
+                missed.append(idx)
+            else:
+                probs[idx], values[idx] = entry
+        if missed:
+            missed_states = [state_ints[idx] for idx in missed]
+            missed_players = [who_moves[idx] for idx in missed]
+            if isinstance(self.net, Evaluator):
+                net_probs, net_values = self.net.evaluate(missed_states, missed_players)
+            else:
+                net_probs, net_values = model.evaluate_states(self.net, missed_states, missed_players, self.device)
+            probs[missed] = net_probs
+            values[missed] = net_values
+            for state_int, who_move, prob, value in zip(missed_states, missed_players, net_probs, net_values):
+                self.cache.put(state_int, who_move, prob, value)
+        return probs, values
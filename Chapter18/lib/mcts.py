@@ -1,37 +1,179 @@
 """
 Monte-Carlo Tree Search
 """
+import time
 import math as m
 import numpy as np
 
-from lib import game, model
-
-import torch.nn.functional as F
+from lib import game, model, inference
 
 
 class MCTS:
     """
-    Class keeps statistics for every state encountered during the search
+    Class keeps statistics for every state encountered during the search.
+    Statistics of the node are stored in the row of numpy arrays, mapping state_int -> row is kept in the dict.
+    If capacity is given, least recently visited nodes are evicted when the store is full. As nodes are visited
+    only through their parents, descendants are never more recent than the node itself, so, whole old subtrees go
+    away first. Nodes visited by the current search (including the path from the root) are never evicted.
     """
-    def __init__(self, c_puct=1.0):
+    def __init__(self, c_puct=1.0, initial_size=1024, capacity=None):
+        assert capacity is None or capacity > 0
         self.c_puct = c_puct
-        # count of visits, state_int -> [N(s, a)]
-        self.visit_count = {}
-        # total value of the state's action, state_int -> [W(s, a)]
-        self.value = {}
-        # average value of actions, state_int -> [Q(s, a)]
-        self.value_avg = {}
-        # prior probability of actions, state_int -> [P(s,a)]
-        self.probs = {}
+        self.capacity = capacity
+        if capacity is not None:
+            initial_size = min(initial_size, capacity)
+        # state_int -> row in the arrays below
+        self.index = {}
+        # count of visits, N(s, a)
+        self.visit_count = np.zeros((initial_size, game.GAME_COLS), dtype=np.int32)
+        # total value of the state's action, W(s, a)
+        self.value = np.zeros((initial_size, game.GAME_COLS), dtype=np.float32)
+        # average value of actions, Q(s, a)
+        self.value_avg = np.zeros((initial_size, game.GAME_COLS), dtype=np.float32)
+        # prior probability of actions, P(s,a)
+        self.probs = np.zeros((initial_size, game.GAME_COLS), dtype=np.float32)
+        # actions allowed in the state
+        self.legal = np.zeros((initial_size, game.GAME_COLS), dtype=np.bool_)
+        # state kept in the row and the search index this row was used the last time
+        self.row_state = np.zeros(initial_size, dtype=np.int64)
+        self.last_visit = np.zeros(initial_size, dtype=np.int64)
+        self.used = np.zeros(initial_size, dtype=np.bool_)
+        self._rows_used = 0
+        self._free_rows = []
+        self._tick = 0
+        self._noise_state = None
+        self._noise = None
+        # statistics: stored nodes reused by minibatches of searches, nodes created and nodes evicted
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def clear(self):
-        self.visit_count.clear()
-        self.value.clear()
-        self.value_avg.clear()
-        self.probs.clear()
+        self.index.clear()
+        self.used[:] = False
+        self._rows_used = 0
+        self._free_rows = []
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def __len__(self):
-        return len(self.value)
+        return len(self.index)
+
+    def _grow(self, size):
+        """
+        Enlarge arrays to keep at least size rows
+        """
+        new_size = 2 * len(self.visit_count)
+        if self.capacity is not None:
+            new_size = min(new_size, self.capacity)
+        # capacity could be exceeded if all the nodes belong to the current search
+        new_size = max(size, new_size)
+        for name in ('visit_count', 'value', 'value_avg', 'probs', 'legal', 'row_state', 'last_visit', 'used'):
+            arr = getattr(self, name)
+            new_arr = np.zeros((new_size,) + arr.shape[1:], dtype=arr.dtype)
+            new_arr[:len(arr)] = arr
+            setattr(self, name, new_arr)
+
+    def _evict(self, count):
+        """
+        Free at least count rows (if possible) occupied by the least recently visited nodes
+        """
+        # evict in chunks to not repeat the scan on every expansion
+        count = max(count, self.capacity // 10)
+        rows = np.nonzero(self.used[:self._rows_used] & (self.last_visit[:self._rows_used] < self._tick))[0]
+        if len(rows) > count:
+            rows = rows[np.argpartition(self.last_visit[rows], count-1)[:count]]
+        self._free(rows)
+        self.evictions += len(rows)
+
+    def _free(self, rows):
+        """
+        Remove nodes kept in given rows
+        """
+        for state_int in self.row_state[rows].tolist():
+            del self.index[state_int]
+        self.used[rows] = False
+        self._free_rows.extend(rows.tolist())
+
+    def prune(self, state_int, player):
+        """
+        Make the state the new root of the tree: statistics of its subtree are kept, all the nodes which are not
+        reachable from it are dropped
+        :param state_int: new root state
+        :param player: player to move in the new root
+        :return: count of nodes dropped
+        """
+        root_row = self.index.get(state_int)
+        if root_row is None:
+            count = len(self.index)
+            self.clear()
+            return count
+        keep = np.zeros(len(self.used), dtype=np.bool_)
+        keep[root_row] = True
+        queue = [(state_int, root_row, player)]
+        while queue:
+            cur_state, row, cur_player = queue.pop()
+            # children could be expanded only if the action was taken at least once
+            for action in np.nonzero(self.visit_count[row])[0].tolist():
+                child_state, _ = game.move(cur_state, action, cur_player)
+                child_row = self.index.get(child_state)
+                if child_row is None or keep[child_row]:
+                    continue
+                keep[child_row] = True
+                queue.append((child_state, child_row, 1-cur_player))
+        rows = np.nonzero(self.used & ~keep)[0]
+        self._free(rows)
+        return len(rows)
+
+    def root_visits(self, state_int):
+        """
+        Count of searches already performed from the state
+        """
+        row = self.index.get(state_int)
+        if row is None:
+            return 0
+        return int(self.visit_count[row].sum())
+
+    def _root_noise(self, state_int):
+        """
+        Dirichlet noise added to the root's prior probabilities, generated once for every new root
+        """
+        if self._noise_state != state_int:
+            self._noise_state = state_int
+            self._noise = np.random.dirichlet([0.03] * game.GAME_COLS)
+        return self._noise
+
+    def _alloc_rows(self, states):
+        """
+        Allocate and reset rows for new nodes
+        :param states: list of state_ints to add
+        :return: numpy array with rows indices
+        """
+        count = len(states)
+        if self.capacity is not None and len(self.index) + count > self.capacity:
+            self._evict(len(self.index) + count - self.capacity)
+        rows = self._free_rows[-count:] if count <= len(self._free_rows) else list(self._free_rows)
+        del self._free_rows[len(self._free_rows)-len(rows):]
+        new_count = count - len(rows)
+        if new_count > 0:
+            if self._rows_used + new_count > len(self.visit_count):
+                self._grow(self._rows_used + new_count)
+            rows.extend(range(self._rows_used, self._rows_used + new_count))
+            self._rows_used += new_count
+        for state_int, row in zip(states, rows):
+            self.index[state_int] = row
+        rows = np.array(rows, dtype=np.int64)
+        self.row_state[rows] = states
+        self.last_visit[rows] = self._tick
+        self.used[rows] = True
+        self.visit_count[rows] = 0
+        self.value[rows] = 0.0
+        self.value_avg[rows] = 0.0
+        self.misses += count
+        return rows
 
     def find_leaf(self, state_int, player):
         """
@@ -51,23 +193,25 @@ class MCTS:
         cur_player = player
         value = None
 
-        while not self.is_leaf(cur_state):
+        while True:
+            row = self.index.get(cur_state)
+            if row is None:
+                break
             states.append(cur_state)
+            # node kept in the store is counted once per minibatch, not on every traversal
+            if self.last_visit[row] != self._tick:
+                self.last_visit[row] = self._tick
+                self.hits += 1
 
-            counts = self.visit_count[cur_state]
-            total_sqrt = m.sqrt(sum(counts))
-            probs = self.probs[cur_state]
-            values_avg = self.value_avg[cur_state]
+            counts = self.visit_count[row]
+            total_sqrt = m.sqrt(counts.sum())
+            probs = self.probs[row]
 
             # choose action to take, in the root node add the Dirichlet noise to the probs
             if cur_state == state_int:
-                noises = np.random.dirichlet([0.03] * game.GAME_COLS)
-                probs = [0.75 * prob + 0.25 * noise for prob, noise in zip(probs, noises)]
-            score = [value + self.c_puct * prob * total_sqrt / (1 + count)
-                     for value, prob, count in zip(values_avg, probs, counts)]
-            invalid_actions = set(range(game.GAME_COLS)) - set(game.possible_moves(cur_state))
-            for invalid in invalid_actions:
-                score[invalid] = -np.inf
+                probs = 0.75 * probs + 0.25 * self._root_noise(state_int)
+            score = self.value_avg[row] + self.c_puct * probs * total_sqrt / (1 + counts)
+            score[~self.legal[row]] = -np.inf
             action = int(np.argmax(score))
             actions.append(action)
             cur_state, won = game.move(cur_state, action, cur_player)
@@ -78,25 +222,35 @@ class MCTS:
             # check for the draw
             if value is None and len(game.possible_moves(cur_state)) == 0:
                 value = 0.0
+            if value is not None:
+                break
 
         return value, cur_state, cur_player, states, actions
 
     def is_leaf(self, state_int):
-        return state_int not in self.probs
+        return state_int not in self.index
 
-    def search_batch(self, count, batch_size, state_int, player, net, device="cpu"):
-        for _ in range(count):
+    def search_batch(self, count, batch_size, state_int, player, net, device="cpu", deadline=None):
+        """
+        Perform count minibatches of searches
+        :param deadline: if given, time.time() value after which searching is stopped (at least one minibatch is
+        always performed)
+        """
+        for idx in range(count):
+            if deadline is not None and idx > 0 and time.time() > deadline:
+                break
             self.search_minibatch(batch_size, state_int, player, net, device)
 
     def search_minibatch(self, count, state_int, player, net, device="cpu"):
         """
         Perform several MCTS searches.
+        :param net: network or inference.Evaluator to evaluate leaf states
         """
         backup_queue = []
-        expand_states = []
         expand_players = []
         expand_queue = []
         planned = set()
+        self._tick += 1
         for _ in range(count):
             value, leaf_state, leaf_player, states, actions = self.find_leaf(state_int, player)
             if value is not None:
@@ -104,36 +258,51 @@ class MCTS:
             else:
                 if leaf_state not in planned:
                     planned.add(leaf_state)
-                    leaf_state_lists = game.decode_binary(leaf_state)
-                    expand_states.append(leaf_state_lists)
                     expand_players.append(leaf_player)
                     expand_queue.append((leaf_state, states, actions))
 
         # do expansion of nodes
         if expand_queue:
-            batch_v = model.state_lists_to_batch(expand_states, expand_players, device)
-            logits_v, values_v = net(batch_v)
-            probs_v = F.softmax(logits_v, dim=1)
-            values = values_v.data.cpu().numpy()[:, 0]
-            probs = probs_v.data.cpu().numpy()
+            leaf_states = [leaf_state for leaf_state, _, _ in expand_queue]
+            if isinstance(net, inference.Evaluator):
+                probs, values = net.evaluate(leaf_states, expand_players)
+            else:
+                probs, values = model.evaluate_states(net, leaf_states, expand_players, device)
 
             # create the nodes
-            for (leaf_state, states, actions), value, prob in zip(expand_queue, values, probs):
-                self.visit_count[leaf_state] = [0] * game.GAME_COLS
-                self.value[leaf_state] = [0.0] * game.GAME_COLS
-                self.value_avg[leaf_state] = [0.0] * game.GAME_COLS
-                self.probs[leaf_state] = prob
+            rows = self._alloc_rows(leaf_states)
+            self.probs[rows] = probs
+            self.legal[rows] = False
+            for row, leaf_state in zip(rows.tolist(), leaf_states):
+                self.legal[row, game.possible_moves(leaf_state)] = True
+            for (_, states, actions), value in zip(expand_queue, values):
                 backup_queue.append((value, states, actions))
 
-        # perform backup of the searches
+        self._backup(backup_queue)
+
+    def _backup(self, backup_queue):
+        """
+        Perform backup of the searches, all paths of the minibatch are updated at once
+        :param backup_queue: list of (value, states, actions)
+        """
+        rows = []
+        acts = []
+        vals = []
         for value, states, actions in backup_queue:
             # leaf state is not stored in states and actions, so the value of the leaf will be the value of the opponent
             cur_value = -value
             for state_int, action in zip(states[::-1], actions[::-1]):
-                self.visit_count[state_int][action] += 1
-                self.value[state_int][action] += cur_value
-                self.value_avg[state_int][action] = self.value[state_int][action] / self.visit_count[state_int][action]
+                rows.append(self.index[state_int])
+                acts.append(action)
+                vals.append(cur_value)
                 cur_value = -cur_value
+        if not rows:
+            return
+        rows = np.array(rows)
+        acts = np.array(acts)
+        np.add.at(self.visit_count, (rows, acts), 1)
+        np.add.at(self.value, (rows, acts), np.array(vals, dtype=np.float32))
+        self.value_avg[rows, acts] = self.value[rows, acts] / self.visit_count[rows, acts]
 
     def get_policy_value(self, state_int, tau=1):
         """
@@ -141,13 +310,13 @@ class MCTS:
         :param state_int: state of the board
         :return: (probs, values)
         """
-        counts = self.visit_count[state_int]
+        row = self.index[state_int]
+        counts = self.visit_count[row].astype(np.float64)
         if tau == 0:
             probs = [0.0] * game.GAME_COLS
-            probs[np.argmax(counts)] = 1.0
+            probs[int(np.argmax(counts))] = 1.0
         else:
-            counts = [count ** (1.0 / tau) for count in counts]
-            total = sum(counts)
-            probs = [count / total for count in counts]
-        values = self.value_avg[state_int]
+            counts = counts ** (1.0 / tau)
+            probs = (counts / counts.sum()).tolist()
+        values = self.value_avg[row].tolist()
         return probs, values
@@ -3,13 +3,20 @@ import numpy as np
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from lib import game, mcts
+from lib import game, mcts, inference, replay
 
 
 OBS_SHAPE = (2, game.GAME_ROWS, game.GAME_COLS)
 NUM_FILTERS = 64
 
+# bit of state_int for every cell of the observation: top row first, the column's bottom is the highest bit
+_CELL_SHIFTS = np.array([[game.FIELD_SHIFTS[col] + row for col in range(game.GAME_COLS)]
+                         for row in range(game.GAME_ROWS)], dtype=np.int64)
+_LEN_SHIFTS = np.array(game.LEN_SHIFTS, dtype=np.int64)
+_ROW_INDICES = np.arange(game.GAME_ROWS, dtype=np.int64)[:, None]
+
 
 class Net(nn.Module):
     def __init__(self, input_shape, actions_n):
@@ -131,6 +138,47 @@ def state_lists_to_batch(state_lists, who_moves_lists, device="cpu"):
     return torch.tensor(batch).to(device)
 
 
+def state_ints_to_batch(state_ints, who_moves, device="cpu", out=None):
+    """
+    Convert integer states to batch for network, working directly on bits of the states
+    :param state_ints: list or array of integer states
+    :param who_moves: list or array of player index who moves
+    :param out: optional preallocated (possibly pinned) float tensor with at least len(state_ints) entries
+    :return: tensor with observations on the device
+    """
+    states = np.asarray(state_ints, dtype=np.int64)
+    who = np.asarray(who_moves, dtype=np.int64)
+    cells = (states[:, None, None] >> _CELL_SHIFTS) & 1
+    free = (states[:, None] >> _LEN_SHIFTS) & game.LEN_MASK
+    # cell is occupied if amount of free entries in the column is less than row index from the top
+    occupied = _ROW_INDICES >= free[:, None, :]
+    own = cells == who[:, None, None]
+    batch = np.empty((len(states),) + OBS_SHAPE, dtype=np.float32)
+    np.logical_and(occupied, own, out=batch[:, 0])
+    np.logical_and(occupied, ~own, out=batch[:, 1])
+    batch_t = torch.from_numpy(batch)
+    if out is None:
+        return batch_t.to(device)
+    out_t = out[:len(states)]
+    out_t.copy_(batch_t)
+    return out_t.to(device, non_blocking=True)
+
+
+def evaluate_states(net, state_ints, who_moves, device="cpu"):
+    """
+    Evaluate game states with the network
+    :param net: network to use
+    :param state_ints: list of states
+    :param who_moves: list of players to move in those states
+    :return: tuple of numpy arrays (probs, values)
+    """
+    batch_v = state_ints_to_batch(state_ints, who_moves, device)
+    with torch.no_grad():
+        logits_v, values_v = net(batch_v)
+        probs_v = F.softmax(logits_v, dim=1)
+    return probs_v.data.cpu().numpy(), values_v.data.cpu().numpy()[:, 0]
+
+
 # def play_game(net1, net2, cuda=False):
 #     cur_player = 0
 #     state = game.INITIAL_STATE
@@ -157,19 +205,21 @@ def state_lists_to_batch(state_lists, who_moves_lists, device="cpu"):
 
 
 def play_game(mcts_stores, replay_buffer, net1, net2, steps_before_tau_0, mcts_searches, mcts_batch_size,
-              net1_plays_first=None, device="cpu"):
+              net1_plays_first=None, device="cpu", reuse_tree=False):
     """
     Play one single game, memorizing transitions into the replay buffer
     :param mcts_stores: could be None or single MCTS or two MCTSes for individual net
     :param replay_buffer: queue with (state, probs, values), if None, nothing is stored
-    :param net1: player1
-    :param net2: player2
+    :param net1: player1, Net or inference.Evaluator
+    :param net2: player2, Net or inference.Evaluator
+    :param reuse_tree: if True, subtree of the state after the move is kept in MCTS stores with its statistics
+    (searches already done from the new root are counted in mcts_searches), the rest of the tree is dropped
     :return: value for the game in respect to player1 (+1 if p1 won, -1 if lost, 0 if draw)
     """
-    assert isinstance(replay_buffer, (collections.deque, type(None)))
+    assert isinstance(replay_buffer, (collections.deque, replay.ReplayBuffer, type(None)))
     assert isinstance(mcts_stores, (mcts.MCTS, type(None), list))
-    assert isinstance(net1, Net)
-    assert isinstance(net2, Net)
+    assert isinstance(net1, (Net, inference.Evaluator))
+    assert isinstance(net2, (Net, inference.Evaluator))
     assert isinstance(steps_before_tau_0, int) and steps_before_tau_0 >= 0
     assert isinstance(mcts_searches, int) and mcts_searches > 0
     assert isinstance(mcts_batch_size, int) and mcts_batch_size > 0
@@ -193,7 +243,11 @@ def play_game(mcts_stores, replay_buffer, net1, net2, steps_before_tau_0, mcts_s
     net1_result = None
 
     while result is None:
-        mcts_stores[cur_player].search_batch(mcts_searches, mcts_batch_size, state,
+        searches = mcts_searches
+        if reuse_tree:
+            searches_done = mcts_stores[cur_player].root_visits(state) // mcts_batch_size
+            searches = max(1, mcts_searches - searches_done)
+        mcts_stores[cur_player].search_batch(searches, mcts_batch_size, state,
                                              cur_player, nets[cur_player], device=device)
         probs, _ = mcts_stores[cur_player].get_policy_value(state, tau=tau)
         game_history.append((state, cur_player, probs))
@@ -214,6 +268,10 @@ def play_game(mcts_stores, replay_buffer, net1, net2, steps_before_tau_0, mcts_s
         step += 1
         if step >= steps_before_tau_0:
             tau = 0
+        if reuse_tree:
+            mcts_stores[0].prune(state, cur_player)
+            if mcts_stores[1] is not mcts_stores[0]:
+                mcts_stores[1].prune(state, cur_player)
 
     if replay_buffer is not None:
         for state, cur_player, probs in reversed(game_history):
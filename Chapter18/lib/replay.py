@@ -0,0 +1,89 @@
+"""
+Replay buffer for the training samples
+"""
+import os
+import numpy as np
+
+from lib import game
+
+
+class ReplayBuffer:
+    """
+    Ring buffer of training samples (state_int, who_move, probs, result) stored in numpy arrays
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.states = np.zeros(capacity, dtype=np.uint64)
+        self.who_moves = np.zeros(capacity, dtype=np.uint8)
+        self.probs = np.zeros((capacity, game.GAME_COLS), dtype=np.float32)
+        self.results = np.zeros(capacity, dtype=np.int8)
+        self.pos = 0
+        self.size = 0
+        # arrays for sampled batches, reused between calls
+        self._batch_size = None
+        self._batch = None
+
+    def __len__(self):
+        return self.size
+
+    def append(self, sample):
+        state_int, who_move, probs, result = sample
+        self.states[self.pos] = state_int
+        self.who_moves[self.pos] = who_move
+        self.probs[self.pos] = probs
+        self.results[self.pos] = result
+        self.pos = (self.pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def extend(self, samples):
+        for sample in samples:
+            self.append(sample)
+
+    def sample(self, batch_size):
+        """
+        Sample random batch (with replacement). Returned arrays are reused by the next call
+        :return: tuple of arrays (states, who_moves, probs, results)
+        """
+        assert self.size > 0
+        if self._batch_size != batch_size:
+            self._batch_size = batch_size
+            self._batch = (np.zeros(batch_size, dtype=self.states.dtype),
+                           np.zeros(batch_size, dtype=self.who_moves.dtype),
+                           np.zeros((batch_size, game.GAME_COLS), dtype=self.probs.dtype),
+                           np.zeros(batch_size, dtype=self.results.dtype))
+        indices = np.random.randint(0, self.size, size=batch_size)
+        for src, dst in zip((self.states, self.who_moves, self.probs, self.results), self._batch):
+            np.take(src, indices, axis=0, out=dst)
+        return self._batch
+
+    def _ordered_indices(self):
+        """
+        Indices of the samples from the oldest to the newest
+        """
+        if self.size < self.capacity:
+            return np.arange(self.size)
+        return np.arange(self.pos, self.pos + self.capacity) % self.capacity
+
+    def save(self, file_name):
+        """
+        Save the buffer's content into the file (written atomically)
+        """
+        indices = self._ordered_indices()
+        tmp_name = file_name + ".tmp"
+        with open(tmp_name, "wb") as fd:
+            np.savez(fd, states=self.states[indices], who_moves=self.who_moves[indices],
+                     probs=self.probs[indices], results=self.results[indices])
+        os.replace(tmp_name, file_name)
+
+    def load(self, file_name):
+        """
+        Load samples saved by save(), if there are more samples than capacity, the oldest are dropped
+        """
+        data = np.load(file_name)
+        count = min(len(data['states']), self.capacity)
+        self.states[:count] = data['states'][-count:]
+        self.who_moves[:count] = data['who_moves'][-count:]
+        self.probs[:count] = data['probs'][-count:]
+        self.results[:count] = data['results'][-count:]
+        self.size = count
+        self.pos = count % self.capacity
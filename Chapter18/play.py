@@ -1,15 +1,130 @@
 #!/usr/bin/env python3
 import sys
+import math
 import time
 import argparse
+import itertools
+import concurrent.futures
 
-from lib import game, model
+from lib import game, model, mcts, inference
 
 import torch
+import torch.multiprocessing as mp
 
 
 MCTS_SEARCHES = 10
 MCTS_BATCH_SIZE = 8
+EVAL_CACHE_SIZE = 100000
+# count of games of the pair played at the same time, their leaves are evaluated in one batch
+PARALLEL_GAMES = 32
+INFERENCE_MAX_LATENCY = 0.002
+
+ELO_INITIAL = 1500
+ELO_ITERATIONS = 500
+
+# state of the process playing pairs, initialized by init_player()
+_nets = None
+_device = None
+_caches = None
+
+
+def init_player(nets, device):
+    """
+    Initialize the process to play games, nets are shared between processes
+    """
+    global _nets, _device, _caches
+    if mp.current_process().name != 'MainProcess':
+        torch.set_num_threads(1)
+    _nets = nets
+    _device = device
+    # every model plays many games, cache evaluations of positions it has seen
+    _caches = [inference.EvalCache(EVAL_CACHE_SIZE) for _ in nets]
+
+
+def play_pair(idx1, idx2, rounds):
+    """
+    Play the set of games between two models. Games are played concurrently, leaves of all the games are
+    evaluated by one server per model
+    :return: tuple (idx1, idx2, wins, losses, draws, speed_games)
+    """
+    ts = time.time()
+    servers = []
+    for idx in (idx1, idx2):
+        server = inference.InferenceServer(_nets[idx], device=_device, max_batch=PARALLEL_GAMES * MCTS_BATCH_SIZE,
+                                           max_latency=INFERENCE_MAX_LATENCY)
+        server.start()
+        servers.append(server)
+
+    def play_one():
+        # clients can't be shared between concurrent searches, every game gets its own
+        clients = [server.client() for server in servers]
+        net1 = inference.CachedEvaluator(clients[0], _caches[idx1])
+        net2 = inference.CachedEvaluator(clients[1], _caches[idx2])
+        r, _ = model.play_game(mcts_stores=[mcts.MCTS(), mcts.MCTS()], replay_buffer=None, net1=net1, net2=net2,
+                               steps_before_tau_0=0, mcts_searches=MCTS_SEARCHES,
+                               mcts_batch_size=MCTS_BATCH_SIZE, reuse_tree=True)
+        for server, client in zip(servers, clients):
+            server.release(client)
+        return r
+
+    wins, losses, draws = 0, 0, 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(rounds, PARALLEL_GAMES)) as executor:
+            for r in executor.map(lambda _: play_one(), range(rounds)):
+                if r > 0.5:
+                    wins += 1
+                elif r < -0.5:
+                    losses += 1
+                else:
+                    draws += 1
+    finally:
+        for server in servers:
+            server.stop()
+    return idx1, idx2, wins, losses, draws, rounds / (time.time() - ts)
+
+
+def play_pair_task(task):
+    return play_pair(*task)
+
+
+def elo_ratings(pair_counts, names):
+    """
+    Calculate Elo ratings which fit the results of played games best (draw counts as half of the win)
+    :param pair_counts: dict (name_1, name_2) -> (wins, losses, draws) of name_1
+    :param names: list of names
+    :return: dict name -> rating
+    """
+    ratings = {name: 0.0 for name in names}
+    games = {name: 0 for name in names}
+    for (name_1, name_2), (wins, losses, draws) in pair_counts.items():
+        games[name_1] += wins + losses + draws
+        games[name_2] += wins + losses + draws
+    for _ in range(ELO_ITERATIONS):
+        delta = {name: 0.0 for name in names}
+        for (name_1, name_2), (wins, losses, draws) in pair_counts.items():
+            count = wins + losses + draws
+            expected = count / (1 + math.pow(10, (ratings[name_2] - ratings[name_1]) / 400))
+            score = wins + draws / 2
+            delta[name_1] += score - expected
+            delta[name_2] -= score - expected
+        for name in names:
+            if games[name] > 0:
+                ratings[name] += 32 * delta[name] / games[name]
+        mean = sum(ratings.values()) / len(ratings)
+        for name in names:
+            ratings[name] -= mean
+    return {name: ELO_INITIAL + rating for name, rating in ratings.items()}
+
+
+def print_elo(total_agent, total_pairs, names, stream=sys.stdout):
+    elo = elo_ratings(total_pairs, names)
+    total_leaders = list(total_agent.items())
+    total_leaders.sort(reverse=True, key=lambda p: elo[p[0]])
+
+    stream.write("Elo ratings:\n")
+    for name, (wins, losses, draws) in total_leaders:
+        stream.write("%s: \t elo=%.0f, w=%d, l=%d, d=%d\n" % (name, elo[name], wins, losses, draws))
+    stream.flush()
 
 
 if __name__ == "__main__":
@@ -17,6 +132,10 @@ if __name__ == "__main__":
     parser.add_argument("models", nargs='+', help="The list of models (at least 2) to play against each other")
     parser.add_argument("-r", "--rounds", type=int, default=2, help="Count of rounds to perform for every pair")
     parser.add_argument("--cuda", default=False, action="store_true", help="Enable CUDA")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="Count of processes to play pairs, default=0 (play in this process)")
+    parser.add_argument("--progress", default=False, action="store_true",
+                        help="Print intermediate Elo ratings to stderr after every pair")
     args = parser.parse_args()
     device = torch.device("cuda" if args.cuda else "cpu")
 
@@ -25,34 +144,38 @@ if __name__ == "__main__":
         net = model.Net(model.OBS_SHAPE, game.GAME_COLS)
         net.load_state_dict(torch.load(fname, map_location=lambda storage, loc: storage))
         net = net.to(device)
-        nets.append((fname, net))
+        net.share_memory()
+        nets.append(net)
 
     total_agent = {}
     total_pairs = {}
+    tasks = [(idx1, idx2, args.rounds) for idx1, idx2 in itertools.permutations(range(len(nets)), 2)]
 
-    for idx1, n1 in enumerate(nets):
-        for idx2, n2 in enumerate(nets):
-            if idx1 == idx2:
-                continue
-            wins, losses, draws = 0, 0, 0
-            ts = time.time()
-            for _ in range(args.rounds):
-                r, _ = model.play_game(mcts_stores=None, replay_buffer=None, net1=n1[1], net2=n2[1], steps_before_tau_0=0,
-                                    mcts_searches=MCTS_SEARCHES, mcts_batch_size=MCTS_BATCH_SIZE, device=device)
-                if r > 0.5:
-                    wins += 1
-                elif r < -0.5:
-                    losses += 1
-                else:
-                    draws += 1
-            speed_games = args.rounds / (time.time() - ts)
-            name_1, name_2 = n1[0], n2[0]
-            print("%s vs %s -> w=%d, l=%d, d=%d" % (name_1, name_2, wins, losses, draws))
-            sys.stderr.write("Speed %.2f games/s\n" % speed_games)
-            sys.stdout.flush()
-            game.update_counts(total_agent, name_1, (wins, losses, draws))
-            game.update_counts(total_agent, name_2, (losses, wins, draws))
-            game.update_counts(total_pairs, (name_1, name_2), (wins, losses, draws))
+    if args.workers > 0:
+        ctx = mp.get_context('spawn')
+        pool = ctx.Pool(args.workers, initializer=init_player, initargs=(nets, device))
+        results = pool.imap_unordered(play_pair_task, tasks)
+    else:
+        pool = None
+        init_player(nets, device)
+        results = map(play_pair_task, tasks)
+
+    for idx1, idx2, wins, losses, draws, speed_games in results:
+        name_1, name_2 = args.models[idx1], args.models[idx2]
+        print("%s vs %s -> w=%d, l=%d, d=%d" % (name_1, name_2, wins, losses, draws))
+        sys.stderr.write("Speed %.2f games/s\n" % speed_games)
+        sys.stdout.flush()
+        game.update_counts(total_agent, name_1, (wins, losses, draws))
+        game.update_counts(total_agent, name_2, (losses, wins, draws))
+        game.update_counts(total_pairs, (name_1, name_2), (wins, losses, draws))
+        if args.progress:
+            print_elo(total_agent, total_pairs, args.models, stream=sys.stderr)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print_elo(total_agent, total_pairs, args.models)
 
     # leaderboard by total wins
     total_leaders = list(total_agent.items())
@@ -8,14 +8,26 @@ import time
 import datetime
 import random
 import logging
+import sqlite3
+import threading
+import concurrent.futures
 import numpy as np
 import configparser
 import argparse
 
-from lib import game, model, mcts
+from lib import game, model, mcts, inference
 
 MCTS_SEARCHES = 20
 MCTS_BATCH_SIZE = 4
+# limit of nodes kept by every session
+MCTS_CAPACITY = 20000
+# evaluations cache size for every model
+EVAL_CACHE_SIZE = 50000
+# count of threads making bot moves, leaves of concurrent searches are evaluated in one batch
+BOT_WORKERS = 8
+# time limit for the bot's move, seconds
+BOT_MOVE_TIME = 5.0
+INFERENCE_MAX_LATENCY = 0.005
 
 try:
     import telegram.ext
@@ -33,21 +45,114 @@ CONFIG_DEFAULT = "~/.config/rl_ch18_bot.ini"
 
 log = logging.getLogger("telegram")
 
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+def is_json_log(file_name):
+    """
+    Check that file is the JSON-lines games log written by the previous versions of the bot
+    """
+    if not os.path.isfile(file_name) or os.path.getsize(file_name) == 0:
+        return False
+    with open(file_name, 'rb') as fd:
+        return fd.read(len(SQLITE_HEADER)) != SQLITE_HEADER
+
+
+def score_counts(bot_score):
+    """
+    Convert game result into (wins, losses, draws) increments
+    :param bot_score: 1 if bot won, -1 if lost, 0 for draw
+    :return: tuple of (bot_counts, user_counts)
+    """
+    if bot_score > 0.5:
+        return (1, 0, 0), (0, 1, 0)
+    elif bot_score < -0.5:
+        return (0, 1, 0), (1, 0, 0)
+    return (0, 0, 1), (0, 0, 1)
+
+
+class GameStore:
+    """
+    Append-only log of played games kept in the SQLite database. Aggregated counts of every player are updated in the
+    same transaction with game insertion, so, leaderboard is loaded without scanning the games
+    """
+    def __init__(self, db_file):
+        # games are saved from bot's worker threads, access is serialized by the PlayerBot's lock
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS games (id INTEGER PRIMARY KEY, ts REAL, bot_name TEXT, "
+                              "user_name TEXT, bot_score REAL, data TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS games_user_name ON games (user_name)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS leaderboard (name TEXT PRIMARY KEY, wins INTEGER, "
+                              "losses INTEGER, draws INTEGER)")
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    def _add_game(self, data):
+        bot_name = os.path.basename(data['model_file'])
+        user_name = data['player_id'].split(':')[0]
+        bot_score = data['bot_score']
+        self.conn.execute("INSERT INTO games (ts, bot_name, user_name, bot_score, data) VALUES (?, ?, ?, ?, ?)",
+                          (data['ts'], bot_name, user_name, bot_score, json.dumps(data, sort_keys=True)))
+        bot_counts, user_counts = score_counts(bot_score)
+        for name, counts in ((bot_name, bot_counts), (user_name, user_counts)):
+            self.conn.execute("INSERT OR IGNORE INTO leaderboard VALUES (?, 0, 0, 0)", (name, ))
+            self.conn.execute("UPDATE leaderboard SET wins = wins + ?, losses = losses + ?, draws = draws + ? "
+                              "WHERE name = ?", counts + (name, ))
+        return bot_name, user_name
+
+    def add_game(self, data):
+        """
+        Append the game
+        :param data: dict with game's data
+        :return: tuple of (bot_name, user_name)
+        """
+        with self.conn:
+            return self._add_game(data)
+
+    def import_log(self, log_file):
+        """
+        Import games from JSON-lines log written by the previous versions of the bot
+        :return: count of games imported
+        """
+        count = 0
+        with self.conn, open(log_file, 'rt', encoding='utf-8') as fd:
+            for l in fd:
+                self._add_game(json.loads(l))
+                count += 1
+        return count
+
+    def leaderboard(self):
+        """
+        :return: dict name -> (wins, losses, draws)
+        """
+        rows = self.conn.execute("SELECT name, wins, losses, draws FROM leaderboard")
+        return {name: (wins, losses, draws) for name, wins, losses, draws in rows}
+
 
 class Session:
     BOT_PLAYER = game.PLAYER_BLACK
     USER_PLAYER = game.PLAYER_WHITE
 
-    def __init__(self, model_file, player_moves_first, player_id):
+    def __init__(self, model_file, player_moves_first, player_id, server, cache):
         self.model_file = model_file
-        self.model = model.Net(input_shape=model.OBS_SHAPE, actions_n=game.GAME_COLS)
-        self.model.load_state_dict(torch.load(model_file, map_location=lambda storage, loc: storage))
+        # server is kept to stop it when no sessions use it anymore
+        self.server = server
+        self.client = server.client()
+        self.model = inference.CachedEvaluator(self.client, cache)
         self.state = game.INITIAL_STATE
         self.value = None
         self.player_moves_first = player_moves_first
         self.player_id = player_id
         self.moves = []
-        self.mcts_store = mcts.MCTS()
+        self.mcts_store = mcts.MCTS(capacity=MCTS_CAPACITY)
+
+    def close(self):
+        """
+        Release the server's client, session can't make bot moves after that
+        """
+        self.server.release(self.client)
 
     def move_player(self, col):
         self.moves.append(col)
@@ -55,7 +160,8 @@ class Session:
         return won
 
     def move_bot(self):
-        self.mcts_store.search_batch(MCTS_SEARCHES, MCTS_BATCH_SIZE, self.state, self.BOT_PLAYER, self.model)
+        self.mcts_store.search_batch(MCTS_SEARCHES, MCTS_BATCH_SIZE, self.state, self.BOT_PLAYER, self.model,
+                                     deadline=time.time() + BOT_MOVE_TIME)
         probs, values = self.mcts_store.get_policy_value(self.state, tau=0)
         action = np.random.choice(game.GAME_COLS, p=probs)
         self.value = values[action]
@@ -81,13 +187,21 @@ class Session:
 
 
 class PlayerBot:
-    def __init__(self, models_dir, log_file):
+    def __init__(self, models_dir, game_store):
         self.sessions = {}
         self.models_dir = models_dir
         self.models = self._read_models(models_dir)
-        self.log_file = log_file
-        self.leaderboard = {}
-        self._read_leaderboard(log_file)
+        # model file -> (mtime, InferenceServer, EvalCache), shared by all sessions playing with this model
+        self.model_servers = {}
+        # servers of replaced or removed models, stopped when their last session is finished
+        self.old_servers = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=BOT_WORKERS)
+        # protects sessions, busy sessions, servers, leaderboard and log from concurrent bot moves
+        self.lock = threading.Lock()
+        # sessions processing the move at the moment, they could be already removed from self.sessions
+        self.busy_sessions = set()
+        self.game_store = game_store
+        self.leaderboard = game_store.leaderboard()
 
     def _read_models(self, models_dir):
         result = {}
@@ -95,31 +209,50 @@ class PlayerBot:
             result[idx] = name
         return result
 
-    def _read_leaderboard(self, log_file):
-        if not os.path.exists(log_file):
-            return 
-        with open(log_file, 'rt', encoding='utf-8') as fd:
-            for l in fd:
-                data = json.loads(l)
-                bot_name = os.path.basename(data['model_file'])
-                user_name = data['player_id'].split(':')[0]
-                bot_score = data['bot_score']
-                self._update_leaderboard(bot_score, bot_name, user_name)
-
-    def _update_leaderboard(self, bot_score, bot_name, user_name):
-        if bot_score > 0.5:
-            game.update_counts(self.leaderboard, bot_name, (1, 0, 0))
-            game.update_counts(self.leaderboard, user_name, (0, 1, 0))
-        elif bot_score < -0.5:
-            game.update_counts(self.leaderboard, bot_name, (0, 1, 0))
-            game.update_counts(self.leaderboard, user_name, (1, 0, 0))
-        else:
-            game.update_counts(self.leaderboard, bot_name, (0, 0, 1))
-            game.update_counts(self.leaderboard, user_name, (0, 0, 1))
+    def _get_server(self, model_file):
+        """
+        Get server and cache for the new session. Model is loaded once and its server evaluates leaves of all
+        sessions. Has to be called under the lock
+        :return: tuple of (InferenceServer, EvalCache)
+        """
+        mtime = os.path.getmtime(model_file)
+        entry = self.model_servers.get(model_file)
+        # model file could be replaced, in that case it's loaded again. Old server is left running for
+        # sessions still using it
+        if entry is None or entry[0] != mtime:
+            if entry is not None:
+                self.old_servers.append(entry[1])
+            net = model.Net(input_shape=model.OBS_SHAPE, actions_n=game.GAME_COLS)
+            net.load_state_dict(torch.load(model_file, map_location=lambda storage, loc: storage))
+            net.eval()
+            server = inference.InferenceServer(net, max_batch=BOT_WORKERS * MCTS_BATCH_SIZE,
+                                               max_latency=INFERENCE_MAX_LATENCY)
+            server.start()
+            cache = inference.EvalCache(EVAL_CACHE_SIZE)
+            cache.set_version(mtime)
+            entry = (mtime, server, cache)
+            self.model_servers[model_file] = entry
+        _, server, cache = entry
+        return server, cache
+
+    def _unused_servers(self):
+        """
+        Remove old servers which are not used by any session. Has to be called under the lock
+        :return: list of servers to be stopped
+        """
+        used = {session.server for session in self.sessions.values()}
+        used.update(session.server for session in self.busy_sessions)
+        unused = [server for server in self.old_servers if server not in used]
+        self.old_servers = [server for server in self.old_servers if server in used]
+        return unused
+
+    def _stop_unused_servers(self):
+        with self.lock:
+            unused = self._unused_servers()
+        for server in unused:
+            server.stop()
 
     def _save_log(self, session, bot_score):
-        self._update_leaderboard(bot_score, os.path.basename(session.model_file),
-                                 session.player_id.split(':')[0])
         data = {
             "ts": time.time(),
             "time": datetime.datetime.utcnow().isoformat(),
@@ -130,8 +263,10 @@ class PlayerBot:
             "moves": session.moves,
             "state": session.state
         }
-        with open(self.log_file, "a+t", encoding='utf-8') as f:
-            f.write(json.dumps(data, sort_keys=True) + '\n')
+        bot_name, user_name = self.game_store.add_game(data)
+        bot_counts, user_counts = score_counts(bot_score)
+        game.update_counts(self.leaderboard, bot_name, bot_counts)
+        game.update_counts(self.leaderboard, user_name, user_counts)
 
     def command_help(self, bot, update):
         bot.send_message(chat_id=update.message.chat_id, parse_mode="HTML", disable_web_page_preview=True,
@@ -172,64 +307,123 @@ During the game, your moves are numbers of columns to drop the disk.
             bot.send_message(chat_id=chat_id, text="There is no such model, use /list command to get list of IDs")
             return
 
-        if chat_id in self.sessions:
+        with self.lock:
+            discarded = self.sessions.pop(chat_id, None)
+            # busy session is closed when its move is done
+            if discarded is not None and discarded not in self.busy_sessions:
+                discarded.close()
+
+            player_moves = random.choice([False, True])
+            model_file = self.models[model_id]
+            session = Session(model_file, player_moves, player_id, *self._get_server(model_file))
+            self.sessions[chat_id] = session
+            if not player_moves:
+                self.busy_sessions.add(session)
+        self._stop_unused_servers()
+        if discarded is not None:
             bot.send_message(chat_id=chat_id, text="You already have the game in progress, it will be discarded")
-            del self.sessions[chat_id]
-
-        player_moves = random.choice([False, True])
-        session = Session(self.models[model_id], player_moves, player_id)
-        self.sessions[chat_id] = session
         if player_moves:
             bot.send_message(chat_id=chat_id, text="Your move is first (you're playing with O), please give the column to put your checker - single number from 0 to 6")
+            bot.send_message(chat_id=chat_id, text=session.render(), parse_mode="HTML")
         else:
             bot.send_message(chat_id=chat_id, text="The first move is mine (I'm playing with X), moving...")
-            session.move_bot()
-        bot.send_message(chat_id=chat_id, text=session.render(), parse_mode="HTML")
+            self._start_bot_move(bot, chat_id, session)
+
+    def _start_bot_move(self, bot, chat_id, session):
+        """
+        Schedule bot's move on the worker pool, reply is sent when the move is done. Session has to be marked as
+        busy by the caller
+        """
+        self.executor.submit(self._bot_move, bot, chat_id, session)
+
+    def _bot_move(self, bot, chat_id, session):
+        try:
+            won = session.move_bot()
+            bot.send_message(chat_id=chat_id, text=session.render(), parse_mode="HTML")
+
+            if won:
+                bot.send_message(chat_id=chat_id, text="I won! Wheeee!")
+                self._finish_session(chat_id, session, bot_score=1)
+            # checking for a draw
+            elif session.is_draw():
+                bot.send_message(chat_id=chat_id, text="Draw position. That's unlikely, but possible. 1:1, see ya!")
+                self._finish_session(chat_id, session, bot_score=0)
+        except Exception:
+            log.exception("Bot move failed")
+        finally:
+            self._release_session(chat_id, session)
+
+    def _release_session(self, chat_id, session):
+        """
+        Mark session as not busy, so, it could accept the next move. Session which was finished or discarded
+        meanwhile is closed
+        """
+        with self.lock:
+            self.busy_sessions.discard(session)
+            if self.sessions.get(chat_id) is not session:
+                session.close()
+        self._stop_unused_servers()
+
+    def _finish_session(self, chat_id, session, bot_score):
+        with self.lock:
+            # session could be already replaced by the new game, discarded games are not logged
+            if self.sessions.get(chat_id) is session:
+                self._save_log(session, bot_score)
+                del self.sessions[chat_id]
 
     def text(self, bot, update):
         chat_id = update.message.chat_id
 
-        if chat_id not in self.sessions:
+        with self.lock:
+            session = self.sessions.get(chat_id)
+            busy = session in self.busy_sessions
+            # session is busy while the player's move is checked and until the bot's move is done
+            if session is not None and not busy:
+                self.busy_sessions.add(session)
+        if session is None:
             bot.send_message(chat_id=chat_id, text="You have no game in progress. Start it with <b>/play MODEL_ID</b> "
                                                    "(or use <b>/help</b> to see the list of commands)",
                              parse_mode='HTML')
             return
-        session = self.sessions[chat_id]
+        if busy:
+            bot.send_message(chat_id=chat_id, text="Wait a bit, I'm thinking on my move")
+            return
+        if not self._move_player(bot, chat_id, session, update.message.text):
+            self._release_session(chat_id, session)
+
+    def _move_player(self, bot, chat_id, session, text):
+        """
+        Perform player's move in the busy session and start bot's move
+        :return: True if bot's move was started
+        """
 
         try:
-            move_col = int(update.message.text)
+            move_col = int(text)
         except ValueError:
             bot.send_message(chat_id=chat_id, text="I don't understand. In play mode you can give a number "
                                                    "from 0 to 6 to specify your move.")
-            return
+            return False
 
         if move_col < 0 or move_col > game.GAME_COLS:
             bot.send_message(chat_id=chat_id, text="Wrong column specified! It must be in range 0-6")
-            return
+            return False
 
         if not session.is_valid_move(move_col):
             bot.send_message(chat_id=chat_id, text="Move %d is invalid!" % move_col)
-            return
+            return False
 
         won = session.move_player(move_col)
         if won:
             bot.send_message(chat_id=chat_id, text="You won! Congratulations!")
-            self._save_log(session, bot_score=-1)
-            del self.sessions[chat_id]
-            return
-
-        won = session.move_bot()
-        bot.send_message(chat_id=chat_id, text=session.render(), parse_mode="HTML")
-
-        if won:
-            bot.send_message(chat_id=chat_id, text="I won! Wheeee!")
-            self._save_log(session, bot_score=1)
-            del self.sessions[chat_id]
-        # checking for a draw
+            self._finish_session(chat_id, session, bot_score=-1)
+            return False
         if session.is_draw():
             bot.send_message(chat_id=chat_id, text="Draw position. That's unlikely, but possible. 1:1, see ya!")
-            self._save_log(session, bot_score=0)
-            del self.sessions[chat_id]
+            self._finish_session(chat_id, session, bot_score=0)
+            return False
+
+        self._start_bot_move(bot, chat_id, session)
+        return True
 
     def error(self, bot, update, error):
         try:
@@ -239,7 +433,8 @@ During the game, your moves are numbers of columns to drop the disk.
 
     def command_top(self, bot, update):
         res = ["Leader board"]
-        items = list(self.leaderboard.items())
+        with self.lock:
+            items = list(self.leaderboard.items())
         items.sort(reverse=True, key=lambda p: p[1][0])
         for user, (wins, losses, draws) in items:
             res.append("%20s: won=%d, lost=%d, draw=%d" % (user[:20], wins, losses, draws))
@@ -247,7 +442,13 @@ During the game, your moves are numbers of columns to drop the disk.
         bot.send_message(chat_id=update.message.chat_id, text="<pre>" + l + "</pre>", parse_mode="HTML")
 
     def command_refresh(self, bot, update):
-        self.models = self._read_models(self.models_dir)
+        models = self._read_models(self.models_dir)
+        with self.lock:
+            self.models = models
+            # servers of removed models are stopped when their sessions are finished
+            for model_file in set(self.model_servers) - set(models.values()):
+                self.old_servers.append(self.model_servers.pop(model_file)[1])
+        self._stop_unused_servers()
         bot.send_message(chat_id=update.message.chat_id, text="Models reloaded, %d files have found" % len(self.models))
 
 
@@ -257,7 +458,9 @@ if __name__ == "__main__":
     parser.add_argument("--config", default=CONFIG_DEFAULT,
                         help="Configuration file for the bot, default=" + CONFIG_DEFAULT)
     parser.add_argument("-m", "--models", required=True, help="Directory name with models to serve")
-    parser.add_argument("-l", "--log", required=True, help="Log name to keep the games and leaderboard")
+    parser.add_argument("-l", "--log", required=True, help="Database file to keep the games and leaderboard")
+    parser.add_argument("--import-log", help="JSON-lines games log of the old bot version to be imported into "
+                                             "the empty database")
     prog_args = parser.parse_args()
 
     conf = configparser.ConfigParser()
@@ -265,7 +468,18 @@ if __name__ == "__main__":
         log.error("Configuration file %s not found", prog_args.config)
         sys.exit()
 
-    player_bot = PlayerBot(prog_args.models, prog_args.log)
+    if is_json_log(prog_args.log):
+        log.error("%s is not a database, but the games log of the old bot version. Import it into the new "
+                  "database with '--log NEW_DB_FILE --import-log %s'", prog_args.log, prog_args.log)
+        sys.exit(1)
+    game_store = GameStore(prog_args.log)
+    if prog_args.import_log is not None:
+        if len(game_store) == 0:
+            log.info("Imported %d games from %s", game_store.import_log(prog_args.import_log), prog_args.import_log)
+        else:
+            log.warning("Database %s already has %d games, import of %s is skipped",
+                        prog_args.log, len(game_store), prog_args.import_log)
+    player_bot = PlayerBot(prog_args.models, game_store)
 
     updater = telegram.ext.Updater(conf['telegram']['api'])
     updater.dispatcher.add_handler(telegram.ext.CommandHandler('help', player_bot.command_help))
@@ -1,3 +1,4 @@
+import random
 import unittest
 
 from lib import game
@@ -131,4 +132,53 @@ class TestMoveFunctions(unittest.TestCase):
         self.assertTrue(won)
         self.assertEqual(s, 3531389463375529686)
 
+
+def _move_lists(state_int, col, player):
+    """
+    Reference implementation of the move working on the lists representation
+    """
+    field = game.decode_binary(state_int)
+    field[col].append(player)
+    row = len(field[col]) - 1
+    won = False
+    for d_col, d_row in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        total = 1
+        for sign in (1, -1):
+            c, r = col + sign * d_col, row + sign * d_row
+            while 0 <= c < game.GAME_COLS and 0 <= r < len(field[c]) and field[c][r] == player:
+                total += 1
+                c, r = c + sign * d_col, r + sign * d_row
+        won = won or total >= game.COUNT_TO_WIN
+    return game.encode_lists(field), won
+
+
+class TestMoves(unittest.TestCase):
+    def test_mirror(self):
+        field = [[0, 1, 1], [1, 0], [0, 1], [0, 0, 1], [0, 0], [1, 1, 1, 0], []]
+        f = game.encode_lists(field)
+        self.assertEqual(game.mirror(f), game.encode_lists(field[::-1]))
+        self.assertEqual(game.mirror(game.mirror(f)), f)
+        self.assertEqual(game.mirror(game.INITIAL_STATE), game.INITIAL_STATE)
+
+    def test_random_games(self):
+        rnd = random.Random(1234)
+        for _ in range(200):
+            state = game.INITIAL_STATE
+            player = rnd.choice([game.PLAYER_BLACK, game.PLAYER_WHITE])
+            while True:
+                moves = game.possible_moves(state)
+                self.assertEqual(moves, [idx for idx, col in enumerate(game.decode_binary(state))
+                                         if len(col) < game.GAME_ROWS])
+                if not moves:
+                    break
+                col = rnd.choice(moves)
+                ref_state, ref_won = _move_lists(state, col, player)
+                state, won = game.move(state, col, player)
+                self.assertEqual(state, ref_state)
+                self.assertEqual(won, ref_won)
+                if won:
+                    break
+                player = 1 - player
+
+
 pass
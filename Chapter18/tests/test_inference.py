@@ -0,0 +1,123 @@
+import unittest
+import threading
+
+import numpy as np
+import torch
+
+from lib import game, mcts, inference
+
+
+def count_net(batch_v):
+    """
+    Fake network returning amount of pieces on the board as a value
+    """
+    batch_size = batch_v.size()[0]
+    return torch.zeros(batch_size, game.GAME_COLS), batch_v.view(batch_size, -1).sum(dim=1, keepdim=True)
+
+
+class TestInferenceServer(unittest.TestCase):
+    def test_routing(self):
+        server = inference.InferenceServer(count_net, max_batch=64, max_latency=0.05)
+        server.start()
+        results = {}
+
+        def func(idx):
+            client = clients[idx]
+            state = game.INITIAL_STATE
+            for col in range(idx):
+                state, _ = game.move(state, col, game.PLAYER_BLACK)
+            results[idx] = client.evaluate([state] * (idx + 1), [game.PLAYER_WHITE] * (idx + 1))
+
+        clients = [server.client() for _ in range(6)]
+        threads = [threading.Thread(target=func, args=(idx, )) for idx in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        server.stop()
+
+        for idx in range(6):
+            probs, values = results[idx]
+            self.assertEqual(probs.shape, (idx + 1, game.GAME_COLS))
+            np.testing.assert_allclose(values, [idx] * (idx + 1))
+        self.assertEqual(server.states, sum(range(1, 7)))
+        self.assertLess(server.batches, 6)
+
+    def test_error(self):
+        def failing_net(batch_v):
+            if batch_v.size()[0] > 1:
+                raise ValueError("batch is too large")
+            return count_net(batch_v)
+
+        server = inference.InferenceServer(failing_net, max_latency=0.0)
+        server.start()
+        client = server.client()
+        with self.assertRaises(ValueError):
+            client.evaluate([game.INITIAL_STATE] * 2, [game.PLAYER_WHITE] * 2)
+        # server is still alive after the error
+        probs, values = client.evaluate([game.INITIAL_STATE], [game.PLAYER_WHITE])
+        server.stop()
+        np.testing.assert_allclose(values, [0])
+
+    def test_release(self):
+        server = inference.InferenceServer(count_net, max_latency=0.0)
+        server.start()
+        clients = [server.client() for _ in range(3)]
+        server.release(clients[0])
+        self.assertEqual(len(server._reply_queues), 2)
+        # ids are not reused after release
+        client = server.client()
+        self.assertNotIn(client.client_id, [c.client_id for c in clients])
+        probs, values = client.evaluate([game.INITIAL_STATE], [game.PLAYER_WHITE])
+        server.stop()
+        np.testing.assert_allclose(values, [0])
+
+    def test_search(self):
+        server = inference.InferenceServer(count_net)
+        server.start()
+        store = mcts.MCTS()
+        store.search_batch(5, 8, game.INITIAL_STATE, game.PLAYER_BLACK, server.client())
+        server.stop()
+        self.assertGreater(len(store), 1)
+        self.assertEqual(server.states, len(store))
+
+
+class TestEvalCache(unittest.TestCase):
+    def test_mirror(self):
+        cache = inference.EvalCache(capacity=2)
+        state, _ = game.move(game.INITIAL_STATE, 0, game.PLAYER_BLACK)
+        mirror_state = game.mirror(state)
+        cache.put(state, game.PLAYER_WHITE, np.arange(game.GAME_COLS), 0.5)
+        probs, value = cache.get(mirror_state, game.PLAYER_WHITE)
+        np.testing.assert_equal(probs, np.arange(game.GAME_COLS)[::-1])
+        self.assertEqual(value, 0.5)
+        self.assertIsNone(cache.get(state, game.PLAYER_BLACK))
+
+    def test_lru(self):
+        cache = inference.EvalCache(capacity=2)
+        states = [game.move(game.INITIAL_STATE, col, game.PLAYER_BLACK)[0] for col in range(3)]
+        cache.put(states[0], 0, np.zeros(game.GAME_COLS), 0.0)
+        cache.put(states[1], 0, np.zeros(game.GAME_COLS), 0.0)
+        cache.get(states[0], 0)
+        cache.put(states[2], 0, np.zeros(game.GAME_COLS), 0.0)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(states[1], 0))
+        self.assertIsNotNone(cache.get(states[0], 0))
+        cache.set_version(1)
+        self.assertEqual(len(cache), 0)
+
+    def test_evaluator(self):
+        cache = inference.EvalCache()
+        evaluator = inference.CachedEvaluator(count_net, cache)
+        state, _ = game.move(game.INITIAL_STATE, 1, game.PLAYER_BLACK)
+        states = [game.INITIAL_STATE, state, game.mirror(state)]
+        probs, values = evaluator.evaluate(states, [0, 0, 0])
+        np.testing.assert_allclose(values, [0, 1, 1])
+        self.assertEqual(cache.misses, 3)
+        self.assertEqual(len(cache), 2)
+        probs, values = evaluator.evaluate(states, [0, 0, 0])
+        np.testing.assert_allclose(values, [0, 1, 1])
+        self.assertEqual(cache.hits, 3)
+
+
+pass
@@ -0,0 +1,95 @@
+import unittest
+
+import numpy as np
+import torch
+
+from lib import game, mcts
+
+
+def uniform_net(batch_v):
+    batch_size = batch_v.size()[0]
+    return torch.zeros(batch_size, game.GAME_COLS), torch.zeros(batch_size, 1)
+
+
+class TestMCTS(unittest.TestCase):
+    def test_search(self):
+        store = mcts.MCTS()
+        store.search_batch(10, 8, game.INITIAL_STATE, game.PLAYER_BLACK, uniform_net)
+        self.assertGreater(len(store), 1)
+        self.assertFalse(store.is_leaf(game.INITIAL_STATE))
+        probs, values = store.get_policy_value(game.INITIAL_STATE)
+        self.assertAlmostEqual(sum(probs), 1.0, places=5)
+        self.assertEqual(len(values), game.GAME_COLS)
+        row = store.index[game.INITIAL_STATE]
+        # duplicate leaves in the minibatch are expanded and backed up only once
+        self.assertGreater(store.visit_count[row].sum(), 0)
+        self.assertLessEqual(store.visit_count[row].sum(), 10 * 8 - 1)
+
+    def test_backup(self):
+        store = mcts.MCTS()
+        store.search_minibatch(1, game.INITIAL_STATE, game.PLAYER_BLACK, uniform_net)
+        child, _ = game.move(game.INITIAL_STATE, 3, game.PLAYER_BLACK)
+        store.search_minibatch(1, child, game.PLAYER_WHITE, uniform_net)
+        store._backup([(1.0, [game.INITIAL_STATE, child], [3, 2]),
+                       (1.0, [game.INITIAL_STATE, child], [3, 2])])
+        root_row, child_row = store.index[game.INITIAL_STATE], store.index[child]
+        self.assertEqual(store.visit_count[child_row, 2], 2)
+        self.assertEqual(store.visit_count[root_row, 3], 2)
+        np.testing.assert_allclose(store.value_avg[child_row, 2], -1.0)
+        np.testing.assert_allclose(store.value_avg[root_row, 3], 1.0)
+
+    def test_full_column(self):
+        state = game.encode_lists([[0, 1] * 3] + [[]] * 6)
+        store = mcts.MCTS()
+        store.search_batch(5, 8, state, game.PLAYER_BLACK, uniform_net)
+        row = store.index[state]
+        self.assertEqual(store.visit_count[row, 0], 0)
+        self.assertFalse(store.legal[row, 0])
+
+    def test_capacity(self):
+        # root noise is generated once per root, so, searches of the minibatch often end in the same leaf and
+        # few nodes are created per minibatch. Capacity is small enough to trigger eviction anyway.
+        store = mcts.MCTS(initial_size=16, capacity=30)
+        state, player = game.INITIAL_STATE, game.PLAYER_BLACK
+        for col in [3, 3, 2, 4, 2]:
+            store.search_batch(10, 8, state, player, uniform_net)
+            self.assertLessEqual(len(store), 30)
+            self.assertFalse(store.is_leaf(state))
+            state, _ = game.move(state, col, player)
+            player = 1 - player
+        self.assertGreater(store.evictions, 0)
+        self.assertGreater(store.hits, 0)
+        self.assertEqual(store.misses - store.evictions, len(store))
+        self.assertEqual(len(store.index), int(store.used.sum()))
+        for state_int, row in store.index.items():
+            self.assertEqual(int(store.row_state[row]), state_int)
+
+    def test_prune(self):
+        store = mcts.MCTS()
+        store.search_batch(10, 8, game.INITIAL_STATE, game.PLAYER_BLACK, uniform_net)
+        row = store.index[game.INITIAL_STATE]
+        action = int(np.argmax(store.visit_count[row]))
+        child, _ = game.move(game.INITIAL_STATE, action, game.PLAYER_BLACK)
+        visits = store.root_visits(child)
+        self.assertGreater(visits, 0)
+        size = len(store)
+        dropped = store.prune(child, game.PLAYER_WHITE)
+        self.assertGreater(dropped, 0)
+        self.assertEqual(len(store), size - dropped)
+        self.assertTrue(store.is_leaf(game.INITIAL_STATE))
+        self.assertEqual(store.root_visits(child), visits)
+        for state_int in store.index:
+            # all remaining nodes have the root's move in the first column
+            self.assertGreater(len(game.decode_binary(state_int)[action]), 0)
+        store.search_batch(2, 8, child, game.PLAYER_WHITE, uniform_net)
+        self.assertGreater(store.root_visits(child), visits)
+
+    def test_root_noise(self):
+        store = mcts.MCTS()
+        noise = store._root_noise(game.INITIAL_STATE)
+        self.assertIs(store._root_noise(game.INITIAL_STATE), noise)
+        child, _ = game.move(game.INITIAL_STATE, 0, game.PLAYER_BLACK)
+        self.assertIsNot(store._root_noise(child), noise)
+
+
+pass
@@ -1,6 +1,7 @@
 import unittest
 
 import numpy as np
+import torch
 from lib import game, model
 
 
@@ -54,5 +55,24 @@ class TestEncoding(unittest.TestCase):
             ],
         ])
 
+    def test_ints_encoding(self):
+        fields = [
+            [[0, 1, 0], [0], [1, 1, 1], [], [1], [], []],
+            [[0, 1, 1], [1, 0], [0, 1], [0, 0, 1], [0, 0], [1, 1, 1, 0], []],
+            [[]] * game.GAME_COLS,
+            [[1] * game.GAME_ROWS] * game.GAME_COLS,
+            [[0] * game.GAME_ROWS] * game.GAME_COLS,
+        ]
+        states = [game.encode_lists(f) for f in fields] * 2
+        who_moves = [game.PLAYER_BLACK] * len(fields) + [game.PLAYER_WHITE] * len(fields)
+        ref = model.state_lists_to_batch(fields * 2, who_moves).data.numpy()
+        batch = model.state_ints_to_batch(states, who_moves).data.numpy()
+        np.testing.assert_equal(batch, ref)
+
+        out = torch.zeros((16, ) + model.OBS_SHAPE)
+        batch = model.state_ints_to_batch(states, who_moves, out=out).data.numpy()
+        np.testing.assert_equal(batch, ref)
+        np.testing.assert_equal(out[:len(states)].numpy(), ref)
+
 
 pass
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from lib import game, replay
+
+
+class TestReplayBuffer(unittest.TestCase):
+    def _sample(self, idx):
+        probs = [0.0] * game.GAME_COLS
+        probs[idx % game.GAME_COLS] = 1.0
+        return idx, idx % 2, probs, 1 if idx % 3 else -1
+
+    def test_ring(self):
+        buf = replay.ReplayBuffer(5)
+        buf.extend(self._sample(idx) for idx in range(7))
+        self.assertEqual(len(buf), 5)
+        self.assertEqual(sorted(buf.states.tolist()), [2, 3, 4, 5, 6])
+        states, who_moves, probs, results = buf.sample(16)
+        self.assertEqual(states.shape, (16, ))
+        self.assertEqual(probs.shape, (16, game.GAME_COLS))
+        for state, who_move, prob, result in zip(states, who_moves, probs, results):
+            ref = self._sample(int(state))
+            self.assertEqual(who_move, ref[1])
+            np.testing.assert_equal(prob, ref[2])
+            self.assertEqual(result, ref[3])
+
+    def test_save_load(self):
+        buf = replay.ReplayBuffer(5)
+        buf.extend(self._sample(idx) for idx in range(7))
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = os.path.join(dir_name, "replay.npz")
+            buf.save(file_name)
+            buf2 = replay.ReplayBuffer(3)
+            buf2.load(file_name)
+        self.assertEqual(len(buf2), 3)
+        self.assertEqual(buf2.states.tolist(), [4, 5, 6])
+        buf2.append(self._sample(7))
+        self.assertEqual(buf2.states.tolist(), [7, 5, 6])
+
+
+pass
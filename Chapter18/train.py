@@ -1,28 +1,35 @@
 #!/usr/bin/env python3
 import os
+import copy
 import time
 import ptan
-import random
+import queue
+import threading
 import argparse
 import collections
 
-from lib import game, model, mcts
+from lib import game, model, mcts, inference, replay
 
 from tensorboardX import SummaryWriter
 
 import torch
 import torch.optim as optim
 import torch.nn.functional as F
+import torch.multiprocessing as mp
 
 
 PLAY_EPISODES = 1  #25
 MCTS_SEARCHES = 10
 MCTS_BATCH_SIZE = 8
+MCTS_CAPACITY = 200000
+EVAL_CACHE_SIZE = 100000
 REPLAY_BUFFER = 5000 # 30000
 LEARNING_RATE = 0.1
 BATCH_SIZE = 256
 TRAIN_ROUNDS = 10
 MIN_REPLAY_TO_TRAIN = 2000 #10000
+# how frequently replay buffer is saved to be reused after restart
+SAVE_REPLAY_EVERY_STEP = 100
 
 BEST_NET_WIN_RATIO = 0.60
 
@@ -30,6 +37,50 @@ EVALUATE_EVERY_STEP = 100
 EVALUATION_ROUNDS = 20
 STEPS_BEFORE_TAU_0 = 10
 
+# size of the queue from self-play processes, in games per process
+PLAY_QUEUE_SIZE = 16
+# time to wait for more leaves from self-play processes in batch inference mode, seconds
+INFERENCE_MAX_LATENCY = 0.002
+
+# cumulative counters of MCTS store and evaluation cache logged every step
+COUNTER_NAMES = ("mcts_hits", "mcts_evictions", "eval_cache_hits")
+
+GameResult = collections.namedtuple('GameResult', field_names=('samples', 'steps', 'nodes'))
+
+
+def play_func(best_net, weights_lock, best_version, device, play_queue):
+    """
+    Self-play process: plays games with the best net (which is kept in shared memory and updated by the trainer)
+    and sends played samples to the trainer
+    :param best_net: best model with parameters in shared memory or inference client of the trainer's server
+    :param weights_lock: lock held by the trainer while the best net's weights are updated
+    :param best_version: shared counter incremented on every best net's update
+    :param play_queue: queue to send GameResult entries
+    """
+    torch.set_num_threads(1)
+    # shared weights are updated in place, so, games are played by the private copy refreshed on new version
+    private_copy = not isinstance(best_net, inference.Evaluator)
+    with weights_lock:
+        version = best_version.value
+        play_net = copy.deepcopy(best_net) if private_copy else best_net
+    mcts_store = mcts.MCTS(capacity=MCTS_CAPACITY)
+    eval_cache = inference.EvalCache(EVAL_CACHE_SIZE)
+    evaluator = inference.CachedEvaluator(play_net, eval_cache, device)
+    while True:
+        if version != best_version.value:
+            with weights_lock:
+                version = best_version.value
+                if private_copy:
+                    play_net.load_state_dict(best_net.state_dict())
+            mcts_store.clear()
+        eval_cache.set_version(version)
+        samples = collections.deque()
+        prev_nodes = mcts_store.misses
+        _, steps = model.play_game(mcts_store, samples, evaluator, evaluator,
+                                   steps_before_tau_0=STEPS_BEFORE_TAU_0, mcts_searches=MCTS_SEARCHES,
+                                   mcts_batch_size=MCTS_BATCH_SIZE, device=device, reuse_tree=True)
+        play_queue.put(GameResult(samples=list(samples), steps=steps, nodes=mcts_store.misses - prev_nodes))
+
 
 def evaluate(net1, net2, rounds, device="cpu"):
     n1_win, n2_win = 0, 0
@@ -38,7 +89,7 @@ def evaluate(net1, net2, rounds, device="cpu"):
     for r_idx in range(rounds):
         r, _ = model.play_game(mcts_stores=mcts_stores, replay_buffer=None, net1=net1, net2=net2,
                                steps_before_tau_0=0, mcts_searches=20, mcts_batch_size=16,
-                               device=device)
+                               device=device, reuse_tree=True)
         if r < -0.5:
             n2_win += 1
         elif r > 0.5:
@@ -50,6 +101,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-n", "--name", required=True, help="Name of the run")
     parser.add_argument("--cuda", default=False, action="store_true", help="Enable CUDA")
+    parser.add_argument("--play-processes", type=int, default=0,
+                        help="Count of self-play processes, default=0 (play in the training process)")
+    parser.add_argument("--batch-inference", default=False, action="store_true",
+                        help="Evaluate leaves of all self-play processes in batches by the trainer process")
     args = parser.parse_args()
     device = torch.device("cuda" if args.cuda else "cpu")
 
@@ -63,74 +118,145 @@ if __name__ == "__main__":
 
     optimizer = optim.SGD(net.parameters(), lr=LEARNING_RATE, momentum=0.9)
 
-    replay_buffer = collections.deque(maxlen=REPLAY_BUFFER)
-    mcts_store = mcts.MCTS()
+    replay_buffer = replay.ReplayBuffer(REPLAY_BUFFER)
+    replay_path = os.path.join(saves_path, "replay.npz")
+    if os.path.exists(replay_path):
+        replay_buffer.load(replay_path)
+        print("Loaded %d samples from %s" % (len(replay_buffer), replay_path))
+    mcts_store = mcts.MCTS(capacity=MCTS_CAPACITY)
+    best_cache = inference.EvalCache(EVAL_CACHE_SIZE)
+    best_evaluator = inference.CachedEvaluator(best_net.target_model, best_cache, device)
+    # buffer for training batches, pinned to speed up transfer to GPU
+    states_buf = torch.zeros((BATCH_SIZE, ) + model.OBS_SHAPE)
+    if args.cuda:
+        states_buf = states_buf.pin_memory()
     step_idx = 0
     best_idx = 0
 
-    with ptan.common.utils.TBMeanTracker(writer, batch_size=10) as tb_tracker:
-        while True:
-            t = time.time()
-            prev_nodes = len(mcts_store)
-            game_steps = 0
-            for _ in range(PLAY_EPISODES):
-                _, steps = model.play_game(mcts_store, replay_buffer, best_net.target_model, best_net.target_model,
-                                           steps_before_tau_0=STEPS_BEFORE_TAU_0, mcts_searches=MCTS_SEARCHES,
-                                           mcts_batch_size=MCTS_BATCH_SIZE, device=device)
-                game_steps += steps
-            game_nodes = len(mcts_store) - prev_nodes
-            dt = time.time() - t
-            speed_steps = game_steps / dt
-            speed_nodes = game_nodes / dt
-            tb_tracker.track("speed_steps", speed_steps, step_idx)
-            tb_tracker.track("speed_nodes", speed_nodes, step_idx)
-            print("Step %d, steps %3d, leaves %4d, steps/s %5.2f, leaves/s %6.2f, best_idx %d, replay %d" % (
-                step_idx, game_steps, game_nodes, speed_steps, speed_nodes, best_idx, len(replay_buffer)))
-            step_idx += 1
-
-            if len(replay_buffer) < MIN_REPLAY_TO_TRAIN:
-                continue
-
-            # train
-            sum_loss = 0.0
-            sum_value_loss = 0.0
-            sum_policy_loss = 0.0
-
-            for _ in range(TRAIN_ROUNDS):
-                batch = random.sample(replay_buffer, BATCH_SIZE)
-                batch_states, batch_who_moves, batch_probs, batch_values = zip(*batch)
-                batch_states_lists = [game.decode_binary(state) for state in batch_states]
-                states_v = model.state_lists_to_batch(batch_states_lists, batch_who_moves, device)
-
-                optimizer.zero_grad()
-                probs_v = torch.FloatTensor(batch_probs).to(device)
-                values_v = torch.FloatTensor(batch_values).to(device)
-                out_logits_v, out_values_v = net(states_v)
-
-                loss_value_v = F.mse_loss(out_values_v.squeeze(-1), values_v)
-                loss_policy_v = -F.log_softmax(out_logits_v, dim=1) * probs_v
-                loss_policy_v = loss_policy_v.sum(dim=1).mean()
-
-                loss_v = loss_policy_v + loss_value_v
-                loss_v.backward()
-                optimizer.step()
-                sum_loss += loss_v.item()
-                sum_value_loss += loss_value_v.item()
-                sum_policy_loss += loss_policy_v.item()
-
-            tb_tracker.track("loss_total", sum_loss / TRAIN_ROUNDS, step_idx)
-            tb_tracker.track("loss_value", sum_value_loss / TRAIN_ROUNDS, step_idx)
-            tb_tracker.track("loss_policy", sum_policy_loss / TRAIN_ROUNDS, step_idx)
-
-            # evaluate net
-            if step_idx % EVALUATE_EVERY_STEP == 0:
-                win_ratio = evaluate(net, best_net.target_model, rounds=EVALUATION_ROUNDS, device=device)
-                print("Net evaluated, win ratio = %.2f" % win_ratio)
-                writer.add_scalar("eval_win_ratio", win_ratio, step_idx)
-                if win_ratio > BEST_NET_WIN_RATIO:
-                    print("Net is better than cur best, sync")
-                    best_net.sync()
-                    best_idx += 1
-                    file_name = os.path.join(saves_path, "best_%03d_%05d.dat" % (best_idx, step_idx))
-                    torch.save(net.state_dict(), file_name)
-                    mcts_store.clear()
+    play_queue = None
+    play_proc_list = []
+    inference_server = None
+    # held while weights of the best net are updated in place by sync()
+    weights_lock = threading.Lock()
+    if args.play_processes > 0:
+        mp.set_start_method('spawn')
+        # play processes copy weights from shared memory when best_version changes
+        best_net.target_model.share_memory()
+        best_version = mp.Value('i', 0)
+        weights_lock = mp.Lock()
+        play_queue = mp.Queue(maxsize=PLAY_QUEUE_SIZE * args.play_processes)
+        if args.batch_inference:
+            inference_server = inference.InferenceServer(best_net.target_model, device=device,
+                                                         max_batch=args.play_processes * MCTS_BATCH_SIZE,
+                                                         max_latency=INFERENCE_MAX_LATENCY, mp_context=mp,
+                                                         lock=weights_lock)
+            inference_server.start()
+        for _ in range(args.play_processes):
+            play_net = best_net.target_model if inference_server is None else inference_server.client()
+            play_proc = mp.Process(target=play_func, args=(play_net, weights_lock, best_version, device,
+                                                           play_queue))
+            play_proc.start()
+            play_proc_list.append(play_proc)
+
+    prev_counters = (0, 0, 0)
+    try:
+        with ptan.common.utils.TBMeanTracker(writer, batch_size=10) as tb_tracker:
+            while True:
+                t = time.time()
+                prev_nodes = mcts_store.misses
+                game_steps = 0
+                game_nodes = 0
+                if play_queue is None:
+                    for _ in range(PLAY_EPISODES):
+                        _, steps = model.play_game(mcts_store, replay_buffer, best_evaluator, best_evaluator,
+                                                   steps_before_tau_0=STEPS_BEFORE_TAU_0,
+                                                   mcts_searches=MCTS_SEARCHES, mcts_batch_size=MCTS_BATCH_SIZE,
+                                                   device=device, reuse_tree=True)
+                        game_steps += steps
+                else:
+                    # wait for PLAY_EPISODES games and take all the others already played, so, play processes
+                    # don't stay blocked on the full queue during training
+                    games = [play_queue.get() for _ in range(PLAY_EPISODES)]
+                    while True:
+                        try:
+                            games.append(play_queue.get_nowait())
+                        except queue.Empty:
+                            break
+                    for game_res in games:
+                        replay_buffer.extend(game_res.samples)
+                        game_steps += game_res.steps
+                        game_nodes += game_res.nodes
+                game_nodes += mcts_store.misses - prev_nodes
+                dt = time.time() - t
+                speed_steps = game_steps / dt
+                speed_nodes = game_nodes / dt
+                tb_tracker.track("speed_steps", speed_steps, step_idx)
+                tb_tracker.track("speed_nodes", speed_nodes, step_idx)
+                tb_tracker.track("mcts_nodes", len(mcts_store), step_idx)
+                # counters are cumulative, so, only increments since the previous step are logged
+                counters = (mcts_store.hits, mcts_store.evictions, best_cache.hits)
+                for name, val, prev_val in zip(COUNTER_NAMES, counters, prev_counters):
+                    writer.add_scalar(name, val - prev_val, step_idx)
+                prev_counters = counters
+                print("Step %d, steps %3d, leaves %4d, steps/s %5.2f, leaves/s %6.2f, best_idx %d, replay %d" % (
+                    step_idx, game_steps, game_nodes, speed_steps, speed_nodes, best_idx, len(replay_buffer)))
+                step_idx += 1
+                if step_idx % SAVE_REPLAY_EVERY_STEP == 0:
+                    replay_buffer.save(replay_path)
+
+                if len(replay_buffer) < MIN_REPLAY_TO_TRAIN:
+                    continue
+
+                # train
+                sum_loss = 0.0
+                sum_value_loss = 0.0
+                sum_policy_loss = 0.0
+
+                for _ in range(TRAIN_ROUNDS):
+                    batch_states, batch_who_moves, batch_probs, batch_values = replay_buffer.sample(BATCH_SIZE)
+                    states_v = model.state_ints_to_batch(batch_states, batch_who_moves, device, out=states_buf)
+
+                    optimizer.zero_grad()
+                    probs_v = torch.from_numpy(batch_probs).to(device)
+                    values_v = torch.from_numpy(batch_values).float().to(device)
+                    out_logits_v, out_values_v = net(states_v)
+
+                    loss_value_v = F.mse_loss(out_values_v.squeeze(-1), values_v)
+                    loss_policy_v = -F.log_softmax(out_logits_v, dim=1) * probs_v
+                    loss_policy_v = loss_policy_v.sum(dim=1).mean()
+
+                    loss_v = loss_policy_v + loss_value_v
+                    loss_v.backward()
+                    optimizer.step()
+                    sum_loss += loss_v.item()
+                    sum_value_loss += loss_value_v.item()
+                    sum_policy_loss += loss_policy_v.item()
+
+                tb_tracker.track("loss_total", sum_loss / TRAIN_ROUNDS, step_idx)
+                tb_tracker.track("loss_value", sum_value_loss / TRAIN_ROUNDS, step_idx)
+                tb_tracker.track("loss_policy", sum_policy_loss / TRAIN_ROUNDS, step_idx)
+
+                # evaluate net
+                if step_idx % EVALUATE_EVERY_STEP == 0:
+                    # trained net changes every step, so, its cache is valid only during one evaluation
+                    net_evaluator = inference.CachedEvaluator(net, inference.EvalCache(EVAL_CACHE_SIZE), device)
+                    win_ratio = evaluate(net_evaluator, best_evaluator, rounds=EVALUATION_ROUNDS, device=device)
+                    print("Net evaluated, win ratio = %.2f" % win_ratio)
+                    writer.add_scalar("eval_win_ratio", win_ratio, step_idx)
+                    if win_ratio > BEST_NET_WIN_RATIO:
+                        print("Net is better than cur best, sync")
+                        with weights_lock:
+                            best_net.sync()
+                            if play_queue is not None:
+                                best_version.value += 1
+                        best_idx += 1
+                        best_cache.set_version(best_idx)
+                        file_name = os.path.join(saves_path, "best_%03d_%05d.dat" % (best_idx, step_idx))
+                        torch.save(net.state_dict(), file_name)
+                        mcts_store.clear()
+    finally:
+        for p in play_proc_list:
+            p.terminate()
+            p.join()
+        if inference_server is not None:
+            inference_server.stop()